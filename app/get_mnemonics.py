@@ -1,85 +1,93 @@
-from datetime import datetime
-from nicegui import app, ui
+import asyncio
+import logging
+import os
+import uuid
+import weakref
+from dataclasses import replace
+from nicegui import app, ui, Client
 from nicegui.events import ValueChangeEventArguments
 from dataclasses import dataclass, field
 from jinja2 import Environment, FileSystemLoader, Template
 from functools import partial
-from typing import Literal, Optional
+from typing import Callable, Literal, Optional
 
 from mysensei import text as ms_text
+from mysensei.annotations import ComponentConcept
 from mysensei import io as ms_io
-from mysensei.generation import generate_gpt4_simple
-
-
-# ===========
-# Annotations
-# ===========
-from typing import Annotated
-ComponentConcept = Annotated[str, "Concept used to recall the target concept"]
-TargetConcept = Annotated[str, "Concept to recall"]
-GeneratedText = Annotated[str, "Generated text"]
+from mysensei.fewshot import render_prompt
+from mysensei.generation import (agenerate_many, astream_gpt4_simple, get_backend,
+    GenerationTimeoutError, StreamStats, TCParams)
+from mysensei.jobs import Job, get_job_queue, register_job_queue, register_job_routes
+from mysensei.ui import cancel_on_disconnect, ThrottledMarkdown
+from mysensei.repository import get_engine
+from mysensei.metrics import get_registry, register_metrics_route
+from mysensei.settings import SettingsError, get_settings
+from mysensei.sync import SyncService, register_sync_routes
+from mysensei.users import get_user_id
+from mysensei.persistence import (GenerationRecord, WriteBehindQueue,
+    iter_stored_results, register_write_behind_queue)
+from mysensei.results import SessionStore, SpillStore, TCConcepts, TCResult, TCResults
+from mysensei.similarity import get_similarity_index
 
 
 # =========
 # Constants
 # =========
 N_COMPONENT_CONCEPTS = 4
-STORAGE_SECRET = ms_io.get_conf_toml("secrets.toml")["cookies"]["storage_secret"]
-# For testing (replaces GPT4 with some text)
-MOCK_GPT4 = False
+PURE_CONCEPTS_TEMPLATE_NAME = "pure_concepts"
+PURE_CONCEPTS_TEMPLATE_VERSION = 1
+REVISION_TEMPLATE_NAME = "pure_concepts_revision"
+REVISION_TEMPLATE_VERSION = 0
+# Max duration of a generation call, in seconds
+GENERATION_TIMEOUT_S = 120.
+# Min delay between two displays of a streamed mnemonic, in seconds
+STREAM_UPDATE_INTERVAL_S = 0.15
+# Max number of candidates requested by a single generation
+MAX_N_CANDIDATES = 5
+# Number of results per session kept in memory; older ones are spilled to disk
+RESULTS_WINDOW_SIZE = 20
+# Results of the sessions: spilled to a store of this process, or, with
+# several workers, all stored in the shared state (so that any worker can
+# restore a session)
+SHARED_STATE_PATH = get_settings().server.shared_state_path
+if SHARED_STATE_PATH is None:
+    SPILL_STORE = SpillStore(
+        path=os.path.join(ms_io.get_lib_path(), "cache", f"spilled_results_{os.getpid()}.sqlite")
+    )
+else:
+    SPILL_STORE = SessionStore(path=SHARED_STATE_PATH)
+# Interval between two prunings of the expired sessions of the shared state
+SESSION_PRUNE_INTERVAL_S = 3600.
+# Past mnemonics offered for concepts similar to the entered ones
+N_SIMILAR_RESULTS = 3
+# Max number of stored results indexed at startup (most recent first)
+MAX_INDEXED_STORED_RESULTS = 100_000
+# Live pages' results, for memory reports
+SESSIONS_RESULTS: weakref.WeakValueDictionary[str, TCResults] = weakref.WeakValueDictionary()
+
+
+logger = logging.getLogger(__name__)
+_SIMILAR_RESULTS_USED = get_registry().counter(
+    "mysensei_similar_results_used_total",
+    "Past results reused for similar concepts, instead of a generation",
+)
 
 
 # =========
 # Dataclass
 # =========
-@dataclass
-class TCConcepts:
-    """
-    Associate a Target concept (to learn,) with Component concepts (available
-    at the time of recall.)
-    """
-    target_concept: TargetConcept
-    component_concepts: list[ComponentConcept]
-
-    def no_target_concept(self)->bool:
-        return (self.target_concept == "")
-
-    def no_component_concept(self)->bool:
-        return all(c == "" for c in self.component_concepts)
-
-    def nonempty_component_concepts(self)->list[ComponentConcept]:
-        return [c  for c in self.component_concepts if c != ""]
-
-@dataclass
-class TCResult:
-    """Generation result for Target/Component mnemonic"""
-    tc_concepts: TCConcepts
-    mnemonic: GeneratedText
-    revisions: list[TCConcepts] = field(default_factory=list)
-
-@dataclass
-class TCResults:
-    """list of generation results"""
-    _tc_results: list[TCResult] = field(default_factory=list)
-
-    def add_result(self, tc_result: TCResult)->None:
-        """Add by reference"""
-        self._tc_results.append(tc_result)
-
-    def get_result(self, idx: int)->TCResult:
-        if len(self._tc_results) == 0:
-            return ""
-        else:
-            return self._tc_results[idx]
-
-    def len(self)->int:
-        return len(self._tc_results)
-
 @dataclass
 class SessionData:
     displayed_result_idx: int
     concepts: TCConcepts
     results: TCResults
+    # Browser session (cookie), which outlives the page: the key of its jobs
+    browser_id: str = ""
+    # Prompts already generated in this session. Generating one of them again
+    # means the user wants an alternative, so the completion cache is skipped.
+    generated_prompts: set[str] = field(default_factory=set)
+    # Indexes of the results to revise
+    selected_result_idxs: set[int] = field(default_factory=set)
 
     def set_displayed_result_idx(self, idx=int):
         self.displayed_result_idx = idx
@@ -90,11 +98,50 @@ class SessionData:
 # =============
 
 
+# =========
+# Functions
+# =========
+def _as_template_dict(component_concepts: list[ComponentConcept])->dict[str, ComponentConcept]:
+    """Component concepts as expected by the templates (see TCParams)"""
+    return {str(i): c for i, c in enumerate(component_concepts)}
+
+
+def _job_concepts(job: Job)->TCConcepts:
+    """Concepts a generation job was rendered from"""
+    params = job.prompt_params[0]
+    return TCConcepts(target_concept=params.target_concept,
+                      component_concepts=list(params.component_concepts.values()))
+
+
+async def index_stored_results()->None:
+    """Add the stored results to the similarity index, off the event loop"""
+    try:
+        await asyncio.to_thread(
+            get_similarity_index().add_many,
+            iter_stored_results(engine=get_engine(), limit=MAX_INDEXED_STORED_RESULTS),
+        )
+    except Exception:
+        logger.exception("Could not index the stored results")
+
+
+async def prune_sessions(session_store: SessionStore)->None:
+    """Drop the expired sessions of the shared state, periodically"""
+    while True:
+        try:
+            await asyncio.to_thread(session_store.prune,
+                                    max_age_s=get_settings().server.session_ttl_s)
+        except Exception:
+            logger.exception("Could not prune the sessions")
+        await asyncio.sleep(SESSION_PRUNE_INTERVAL_S)
+
+
 # ===============
 # Page components
 # ===============
-def concept_inputation_ui(session_data: SessionData)-> None:
-    """UI for inputing the Target and Related Concepts"""
+def concept_inputation_ui(session_data: SessionData,
+                          on_change: Callable[[], None])-> None:
+    """UI for inputing the Target and Related Concepts (`on_change` is called
+    after every change)"""
     # Defining update mechanism for concepts
     def update_concept(
         event: ValueChangeEventArguments,
@@ -116,6 +163,7 @@ def concept_inputation_ui(session_data: SessionData)-> None:
                 concepts.component_concepts[position] = event.value
         else:
             raise ValueError(f"{concept_type=} which is not expected.")
+        on_change()
 
     # Inputation of main concept
     ui.label("Target concept")
@@ -135,14 +183,15 @@ def mnemonic_generation_ui(
     session_data: SessionData,
     pure_concepts_template: Template,
     revision_template: Template,
-):
+)->Callable[[], None]:
     # TODO: docstr
     # Action on click
-    def act_on_click_generate(
+    async def act_on_click_generate(
         concepts: TCConcepts,
         results: TCResults,
         pure_concepts_template: Template,
     )->None:
+        """Generate one mnemonic (streamed), or several candidates at once"""
         # Check there is 1 target and 1+ component concepts. If not, display
         # error. Else, hide error in case was displayed.
         if concepts.no_target_concept():
@@ -156,25 +205,125 @@ def mnemonic_generation_ui(
         else:
             concept_error_label.set_visibility(False)
         # Generation
-        pure_concepts_prompt = pure_concepts_template.render(
-            target_concept = concepts.target_concept,
-            component_concepts = concepts.nonempty_component_concepts(),
+        pure_concepts_prompt = render_prompt(
+            template=pure_concepts_template,
+            prompt_params_dict={
+                "target_concept": concepts.target_concept,
+                "component_concepts": _as_template_dict(concepts.nonempty_component_concepts()),
+            },
+        ).prompt
+        fresh = pure_concepts_prompt in session_data.generated_prompts
+        n_candidates = min(max(int(n_candidates_input.value or 1), 1), MAX_N_CANDIDATES)
+        # OpenAI completion. Awaited so that other sessions are served in the
+        # meantime, and cancelled if the client leaves.
+        try:
+            if n_candidates == 1:
+                # Single mnemonic, streamed into the mnemonic area
+                stream_stats = StreamStats()
+                outputs = [await cancel_on_disconnect(
+                    client=concept_error_label.client,
+                    awaitable=stream_into_mnemonic_md(
+                        prompt=pure_concepts_prompt,
+                        stream_stats=stream_stats,
+                        fresh=fresh,
+                    ),
+                )]
+                if stream_stats.time_to_first_token is not None:
+                    ttft_label.set_text(
+                        f"First token after {stream_stats.time_to_first_token:.2f}s,"
+                        f" full mnemonic after {stream_stats.total_time:.2f}s"
+                    )
+            else:
+                # All candidates from one request, through the job queue: the
+                # job outlives the page, and is retried on transient errors
+                job = await JOB_QUEUE.aenqueue(
+                    session_id=session_data.browser_id,
+                    prompt=pure_concepts_prompt,
+                    prompt_params=[TCParams(
+                        target_concept=concepts.target_concept,
+                        component_concepts=_as_template_dict(
+                            concepts.nonempty_component_concepts()
+                        ),
+                    )],
+                    template_name=PURE_CONCEPTS_TEMPLATE_NAME,
+                    template_version=PURE_CONCEPTS_TEMPLATE_VERSION,
+                    n=n_candidates,
+                    fresh=fresh,
+                )
+                job = await cancel_on_disconnect(
+                    client=concept_error_label.client,
+                    awaitable=JOB_QUEUE.wait(job_id=job.job_id, on_update=show_job_progress),
+                )
+                if job.status == "dead":
+                    concept_error_label.set_visibility(True)
+                    concept_error_label.set_text(
+                        f"Generation failed after {job.n_attempts} attempts, please retry"
+                    )
+                    return
+                # Unless another page of the session got them first
+                if not await asyncio.to_thread(JOB_QUEUE.store.mark_delivered, job.job_id):
+                    return
+                outputs = job.outputs
+        except GenerationTimeoutError:
+            concept_error_label.set_visibility(True)
+            concept_error_label.set_text("Generation timed out, please retry")
+            return
+        session_data.generated_prompts.add(pure_concepts_prompt)
+        await store_outputs(concepts=concepts, outputs=outputs)
+
+    async def store_outputs(concepts: TCConcepts, outputs: list[str])->None:
+        """Add new results to the session, and display the first one"""
+        new_results = [TCResult.from_concepts(tc_concepts=concepts, mnemonic=output)
+                       for output in outputs]
+        # Off the event loop: a shared session store may wait for other workers
+        idxs = await asyncio.to_thread(
+            lambda: [session_data.results.add_result(r) for r in new_results]
         )
-        # OpenAI completion
-        if not MOCK_GPT4:
-            output = generate_gpt4_simple(prompt = pure_concepts_prompt)
-        else:
-            output = f"Hey there! It a TEST \o/ {datetime.today()}"
-        # Storing everything
-        result = TCResult(tc_concepts=concepts, mnemonic=output)
-        results.add_result(result)
-        # Display the last results
-        change_displayed_mnem_idx(session_data=session_data, new_idx=results.len() - 1)
+        for result, output in zip(new_results, outputs):
+            get_similarity_index().add(result)
+            # Persisted in the background
+            RESULTS_QUEUE.put(GenerationRecord(
+                session_id=session_data.browser_id,
+                target_concept=result.target_concept,
+                component_concepts=result.component_concepts,
+                template_name=PURE_CONCEPTS_TEMPLATE_NAME,
+                template_version=PURE_CONCEPTS_TEMPLATE_VERSION,
+                mnemonic=output,
+                revisions=result.revisions,
+            ))
+        # Display the first new result
+        change_displayed_mnem_idx(session_data=session_data, new_idx=idxs[0])
         # Dipslay prompt
         #prompt_md.set_content(ms_text.replace_linebreaks_w_br(pure_concepts_prompt))
         # Enable revision
         revision_button.set_visibility(True)
 
+    def show_job_progress(job: Job)->None:
+        """Display where a generation job stands (e.g., retried)"""
+        text = f"Generating {job.n} candidates..."
+        if job.n_attempts > 1 or (job.status == "queued" and job.error is not None):
+            text += f" (attempt {job.n_attempts}/{job.max_attempts}; last error: {job.error})"
+        mnemonic_md.set_content(text)
+
+    async def stream_into_mnemonic_md(prompt: str,
+                                      stream_stats: StreamStats,
+                                      fresh: bool)->str:
+        """Display the mnemonic as it is being generated, and return it"""
+        renderer = ThrottledMarkdown(
+            markdown=mnemonic_md,
+            min_interval_s=STREAM_UPDATE_INTERVAL_S,
+        )
+        async for delta in astream_gpt4_simple(
+            prompt=prompt,
+            timeout=GENERATION_TIMEOUT_S,
+            stats=stream_stats,
+            fresh=fresh,
+            template_name=PURE_CONCEPTS_TEMPLATE_NAME,
+            template_version=PURE_CONCEPTS_TEMPLATE_VERSION,
+        ):
+            renderer.append(delta)
+        return renderer.flush()
+
     def change_displayed_mnem_idx(session_data: SessionData, new_idx:
                                      int)->None:
         """
@@ -186,8 +335,14 @@ def mnemonic_generation_ui(
         assert (new_idx <= results_len - 1) & (new_idx >= 0), f"{new_idx=}"
         # Change the idx
         session_data.displayed_result_idx = new_idx
-        # Display the mnem
-        mnemonic_md.set_content(session_data.results.get_result(idx=new_idx).mnemonic)
+        # Display the mnem and its last revision
+        result = session_data.results.get_result(idx=new_idx)
+        mnemonic_md.set_content(result.mnemonic)
+        revision_md.set_content(
+            ms_text.replace_linebreaks_w_br(result.revisions[-1]) if result.revisions else ""
+        )
+        selected_checkbox.set_value(new_idx in session_data.selected_result_idxs)
+        results_count_label.set_text(f"{new_idx + 1}/{results_len}")
         # Disable/Enable arrows by cases
         if results_len in [0, 1]:
             back_mnem_icon.set_enabled(False)
@@ -204,10 +359,95 @@ def mnemonic_generation_ui(
             forward_mnem_icon.set_enabled(True)
 
 
-    def act_on_click_revise(results: TCResults):
-        pass
+    def act_on_select(event: ValueChangeEventArguments)->None:
+        """(Un)select the displayed result for revision"""
+        if session_data.displayed_result_idx < 0:
+            return
+        if event.value:
+            session_data.selected_result_idxs.add(session_data.displayed_result_idx)
+        else:
+            session_data.selected_result_idxs.discard(session_data.displayed_result_idx)
+
+    async def act_on_click_revise(results: TCResults)->None:
+        """Revise the selected results (or the displayed one), concurrently"""
+        idxs = sorted(session_data.selected_result_idxs) or [session_data.displayed_result_idx]
+        if idxs == [-1]:
+            return
+        to_revise = [results.get_result(idx=idx) for idx in idxs]
+        prompts = [
+            revision_template.render(
+                target_concept=result.target_concept,
+                component_concepts=_as_template_dict(result.component_concepts),
+                mnemonic=result.mnemonic,
+            )
+            for result in to_revise
+        ]
+        revision_md.set_content(f"Revising {len(prompts)} mnemonic(s)...")
+        try:
+            outputs = await cancel_on_disconnect(
+                client=concept_error_label.client,
+                awaitable=agenerate_many(prompts=prompts,
+                                         timeout=GENERATION_TIMEOUT_S,
+                                         fresh=True,
+                                         template_name=REVISION_TEMPLATE_NAME,
+                                         template_version=REVISION_TEMPLATE_VERSION),
+            )
+        except GenerationTimeoutError:
+            concept_error_label.set_visibility(True)
+            concept_error_label.set_text("Revision timed out, please retry")
+            revision_md.set_content("")
+            return
+        for idx, result, output in zip(idxs, to_revise, outputs):
+            revised = replace(result, revisions=result.revisions + (output,))
+            await asyncio.to_thread(results.set_result, idx=idx, tc_result=revised)
+            RESULTS_QUEUE.put(GenerationRecord(
+                session_id=session_data.browser_id,
+                target_concept=revised.target_concept,
+                component_concepts=revised.component_concepts,
+                template_name=REVISION_TEMPLATE_NAME,
+                template_version=REVISION_TEMPLATE_VERSION,
+                mnemonic=revised.mnemonic,
+                revisions=revised.revisions,
+            ))
+        session_data.selected_result_idxs.clear()
+        change_displayed_mnem_idx(session_data=session_data,
+                                  new_idx=session_data.displayed_result_idx)
+
 
+    def refresh_similar_results()->None:
+        """Offer the past mnemonics of concepts similar to the entered ones"""
+        concepts = session_data.concepts
+        similar_results = []
+        if not (concepts.no_target_concept() or concepts.no_component_concept()):
+            similar_results = get_similarity_index().query(concepts=concepts,
+                                                           k=N_SIMILAR_RESULTS)
+        if [s.result for s in similar_results] == shown_similar_results:
+            return  # Spare the updates of the page
+        shown_similar_results[:] = [s.result for s in similar_results]
+        similar_results_column.clear()
+        with similar_results_column:
+            if len(similar_results) > 0:
+                ui.label("Similar past mnemonics, ready to use:")
+            for similar in similar_results:
+                result = similar.result
+                with ui.row():
+                    ui.button("Use", on_click=partial(act_on_click_use, result=result))
+                    ui.markdown(
+                        f"**{result.target_concept}** ({', '.join(result.component_concepts)}),"
+                        f" {similar.similarity:.0%} similar<br>"
+                        + ms_text.replace_linebreaks_w_br(result.mnemonic)
+                    )
 
+    async def act_on_click_use(result: TCResult)->None:
+        """Add a past result to the session's, as if it had been generated"""
+        idx = await asyncio.to_thread(session_data.results.add_result, result)
+        _SIMILAR_RESULTS_USED.inc()
+        change_displayed_mnem_idx(session_data=session_data, new_idx=idx)
+        revision_button.set_visibility(True)
+
+    # Number of candidates per generation
+    n_candidates_input = ui.number(label="Candidates", value=1, min=1,
+                                   max=MAX_N_CANDIDATES, step=1, format="%.0f")
     # Button for generation
     ui.button(
         text="Generate",
@@ -218,15 +458,17 @@ def mnemonic_generation_ui(
     )
     # Slot for error if something is missing
     concept_error_label = ui.label()
+    # Past mnemonics of similar concepts
+    similar_results_column = ui.column()
+    shown_similar_results: list[TCResult] = []
     # Prompt
     prompt_md = ui.markdown()
-    prompt_md.bind_content_from(
-        target_object=session_data,
-        target_name="results",
-        backward=lambda obj, idx=session_data.displayed_result_idx: obj.get_result(idx=idx)
-    )
     # Generated mnemonic ; show the one pointed at in app.storage.user
     mnemonic_md = ui.markdown()
+    # Last revision of the displayed mnemonic
+    revision_md = ui.markdown()
+    # Streaming timings of the last generation
+    ttft_label = ui.label()
     #mnemonic_md.bind_content_from(
         #session_data,
         #"displayed_result_idx",
@@ -245,6 +487,9 @@ def mnemonic_generation_ui(
         on_click=lambda session_data=session_data: change_displayed_mnem_idx(session_data=session_data, new_idx=session_data.displayed_result_idx+1)
     )
     forward_mnem_icon.set_enabled(False)
+    results_count_label = ui.label()
+    # Selection of the results to revise together
+    selected_checkbox = ui.checkbox("Select for revision", on_change=act_on_select)
     # Button for revision...
     revision_button = ui.button(
         "Revise",
@@ -258,34 +503,115 @@ def mnemonic_generation_ui(
         "displayed_result_idx",
         backward=lambda idx: idx is not None
     )
+    # Results of the session's jobs that finished while it was away, once
+    # the page is connected
+    async def deliver_finished_jobs()->None:
+        jobs = await asyncio.to_thread(JOB_QUEUE.store.undelivered,
+                                       session_id=session_data.browser_id)
+        for job in jobs:
+            if await asyncio.to_thread(JOB_QUEUE.store.mark_delivered, job.job_id):
+                await store_outputs(concepts=_job_concepts(job), outputs=job.outputs)
+    ui.timer(0, deliver_finished_jobs, once=True)
+    # Restored session: display its last result
+    if session_data.results.len() > 0:
+        change_displayed_mnem_idx(session_data=session_data,
+                                  new_idx=session_data.results.len() - 1)
+    return refresh_similar_results
 
 
 # ================
 # Page composition
 # ================
 @ui.page("/")
-def main_ui()-> None:
-    # Load template
-    ## TODO: put the template at the direct module scope? (loaded only once per
-    ## server loading)
-    pure_concepts_template = ms_io.get_jinja_template(template_name="pure_concepts", version = 0)
-    revision_template = ms_io.get_jinja_template(template_name="pure_concepts_revision", version = 0)
+def main_ui(client: Optional[Client]=None)-> None:
+    # Load template (compiled once per process by the template registry)
+    pure_concepts_template = ms_io.get_jinja_template(
+        template_name=PURE_CONCEPTS_TEMPLATE_NAME,
+        version=PURE_CONCEPTS_TEMPLATE_VERSION,
+    )
+    revision_template = ms_io.get_jinja_template(
+        template_name=REVISION_TEMPLATE_NAME,
+        version=REVISION_TEMPLATE_VERSION,
+    )
+    if client is not None:
+        get_user_id(session=app.storage.browser)  # For the sync endpoint
     # Intialize session-specific data storage
+    session_id = uuid.uuid4().hex if client is None else client.id
+    browser_id = session_id if client is None else app.storage.browser["id"]
+    if isinstance(SPILL_STORE, SessionStore) and client is not None:
+        # Browser session (cookie), which outlives the page: a page reloaded
+        # on another worker gets its results back
+        session_id = browser_id
+        results = TCResults.restore(session_id=session_id, window_size=RESULTS_WINDOW_SIZE,
+                                    spill_store=SPILL_STORE)
+    else:
+        results = TCResults(
+            session_id=session_id,
+            window_size=RESULTS_WINDOW_SIZE,
+            spill_store=SPILL_STORE,
+        )
     session_data = SessionData(
         displayed_result_idx=-1,
         concepts = TCConcepts(
             target_concept="",
             component_concepts=["" for _ in range(N_COMPONENT_CONCEPTS)],
         ),
-        results = TCResults()
+        results = results,
+        browser_id=browser_id,
     )
+    # By page: the pages of a browser share their session
+    SESSIONS_RESULTS[session_id if client is None else client.id] = session_data.results
+    if client is not None and not isinstance(SPILL_STORE, SessionStore):
+        client.on_disconnect(session_data.results.close)
     # Display UI
-    concept_inputation_ui(session_data=session_data)
-    mnemonic_generation_ui(
+    concept_inputation_ui(session_data=session_data,
+                          on_change=lambda: refresh_similar_results())
+    refresh_similar_results = mnemonic_generation_ui(
         pure_concepts_template=pure_concepts_template,
         revision_template=revision_template,
         session_data=session_data,
     )
+# Memory report of the live sessions
+@app.get("/api/sessions/memory")
+def sessions_memory()->dict:
+    """In-memory size of the pages' results, aggregated (session ids are
+    browser cookies, not to be listed)"""
+    pages = list(SESSIONS_RESULTS.values())
+    memory_bytes = [results.memory_usage() for results in pages]
+    return {
+        "n_pages": len(pages),
+        "n_results": sum(results.len() for results in pages),
+        "n_results_in_memory": sum(min(results.len(), results.window_size)
+                                   for results in pages),
+        "total_memory_bytes": sum(memory_bytes),
+        "max_page_memory_bytes": max(memory_bytes, default=0),
+    }
+if isinstance(SPILL_STORE, SessionStore):
+    app.on_startup(partial(prune_sessions, session_store=SPILL_STORE))
+else:
+    app.on_shutdown(SPILL_STORE.destroy)
+# Generation backend (OpenAI, or a fake server for tests; see config.toml),
+# created now to fail early if misconfigured
+get_backend()
+# Write-behind persistence of the results
+RESULTS_QUEUE = WriteBehindQueue(engine=get_engine())
+register_write_behind_queue(app=app, queue=RESULTS_QUEUE)
+# Queue of generation jobs (run by this process, unless by dedicated ones)
+JOB_QUEUE = get_job_queue()
+register_job_queue(app=app, queue=JOB_QUEUE)
+register_job_routes(app=app, get_queue=lambda: JOB_QUEUE)
+# Similarity index of the past results (then updated as results come)
+app.on_startup(index_stored_results)
+# Prometheus metrics (generation latency, tokens, errors...)
+register_metrics_route(app=app)
+# Client-side cache synchronization
+register_sync_routes(app=app, get_service=lambda: SyncService(engine=get_engine()))
 # Rendering
+ms_io.get_template_registry()  # Compile all templates at startup
 main_ui()
-ui.run(storage_secret=STORAGE_SECRET)
+storage_secret = get_settings().cookies.storage_secret
+if storage_secret is None:
+    raise SettingsError("No [cookies] storage_secret setting (see secrets.toml)")
+server_settings = get_settings().server
+ui.run(storage_secret=storage_secret, host=server_settings.host, port=server_settings.port,
+       reload=server_settings.reload)
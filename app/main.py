@@ -1,16 +1,36 @@
 """
 Interface for creating prompts
 """
+from functools import partial
+from typing import Optional
 from nicegui import app, ui
+from nicegui.events import ValueChangeEventArguments
 
+from mysensei import io as ms_io
+from mysensei.metrics import register_metrics_route
 from mysensei.generation import PromptParams, TCParams, TCRevisionParams, TCSoundParams
+from mysensei.repository import ReadingAssociationsRepository, get_engine
+from mysensei.segmentation import Segment, SoundTrieIndex
+from mysensei.settings import SettingsError, get_settings
 from mysensei.ui import PromptUI
+from mysensei.users import get_user_id
 
 
 # ==========
 # Parameters
 # ==========
 N_CONCEPTS = 4
+_SOUND_TRIE_INDEX: Optional[SoundTrieIndex] = None
+
+
+def _get_sound_trie_index()->SoundTrieIndex:
+    """Index of the users' known sounds, created on first use"""
+    global _SOUND_TRIE_INDEX
+    if _SOUND_TRIE_INDEX is None:
+        _SOUND_TRIE_INDEX = SoundTrieIndex(
+            repository=ReadingAssociationsRepository(engine=get_engine())
+        )
+    return _SOUND_TRIE_INDEX
 
 
 # ==========
@@ -39,7 +59,8 @@ def display_target_component_ui():
     # Unit UI classes
     mnem_prompt_ui = PromptUI(prompt_params=tc_concepts,
                                  template_name="pure_concepts",
-                                 template_version=0)
+                                 template_version=1,
+                                 live_preview=True)
     mnem_revision_ui = PromptUI(prompt_params=mnem_revision,
                                 auxiliary_prompt_params_lst=[tc_concepts],
                                  template_name="pure_concepts_revision",
@@ -49,7 +70,29 @@ def display_target_component_ui():
     _displayer(sub_prompt_uis=[mnem_prompt_ui, mnem_revision_ui])
 
 
-def display_reading_ui():
+def prefill_component_concepts_sounds(
+    event: ValueChangeEventArguments,
+    component_concepts_sounds: dict[str, dict[str, str]],
+    user_id: int,
+)->None:
+    """Fill out the sound/concept/details subfields from the segmentation of
+    the inputed reading into known sounds. Unknown sounds only get their sound
+    filled out."""
+    reading = event.value or ""
+    segments = _get_sound_trie_index().segment(user_id=user_id, reading=reading)
+    if len(segments) > len(component_concepts_sounds):
+        dropped = "".join(s.sound for s in segments[len(component_concepts_sounds):])
+        ui.notify(f"Only the first {len(component_concepts_sounds)} sounds were "
+                  f"filled out: {dropped} left out", type="warning")
+    for i, subfields in enumerate(component_concepts_sounds.values()):
+        segment = segments[i] if i < len(segments) else Segment(sound="")
+        association = segment.associations[0] if segment.is_known() else None
+        subfields["sound"] = segment.sound
+        subfields["concept"] = "" if association is None else association.concept
+        subfields["details"] = "" if association is None else association.descriptor
+
+
+def display_reading_ui(user_id: int):
     # Init prompt parameters
     tc_sound_concepts = TCSoundParams(
         target_concept="",
@@ -62,8 +105,18 @@ def display_reading_ui():
     # Unit UI classes
     reading_ui = PromptUI(prompt_params=tc_sound_concepts,
                                  template_name="reading_mnem",
-                                 template_version=0,
-                                 multirow_fields=["meaning_mnemonic"])
+                                 template_version=1,
+                                 multirow_fields=["meaning_mnemonic"],
+                                 live_preview=True)
+    # Reading, to pre-fill the sounds with known associations
+    ui.input(
+        label="Reading (pre-fills the sounds)",
+        on_change=partial(
+            prefill_component_concepts_sounds,
+            component_concepts_sounds=tc_sound_concepts.component_concepts_sounds,
+            user_id=user_id,
+        ),
+    )
     # Display UI
     _displayer(sub_prompt_uis=[reading_ui])
 
@@ -71,11 +124,14 @@ def display_reading_ui():
 # ==========
 # Overall UI
 # ==========
-# List ui functions
-SUB_UI_FUNS = {"meaning": display_target_component_ui, "reading": display_reading_ui}
+# List ui functions, given the user id
+SUB_UI_FUNS = {"meaning": lambda user_id: display_target_component_ui(),
+               "reading": display_reading_ui}
 DEFAULT_TAB = "meaning"
 
+@ui.page("/")
 def display_ui():
+    user_id = get_user_id(session=app.storage.browser)
     tab_dict = {}
     with ui.tabs().classes('w-full') as tabs:
         for tab_name in SUB_UI_FUNS.keys():
@@ -84,8 +140,12 @@ def display_ui():
         for tab_name, tab in tab_dict.items():
             ui_fun = SUB_UI_FUNS[tab_name]
             with ui.tab_panel(tab):
-                ui_fun()
+                ui_fun(user_id=user_id)
 
 #display_target_component_ui()
-display_ui()
-ui.run()
+ms_io.get_template_registry()  # Compile all templates at startup
+register_metrics_route(app=app)
+storage_secret = get_settings().cookies.storage_secret
+if storage_secret is None:
+    raise SettingsError("No [cookies] storage_secret setting (see secrets.toml)")
+ui.run(storage_secret=storage_secret)
@@ -0,0 +1,90 @@
+"""
+Import time of the core modules, checked against budgets
+
+Each module is imported in a fresh interpreter (`python -X importtime`),
+several times; the best cumulative import time is compared to its budget. The
+imports must not pull in the heavy dependencies (OpenAI, FastAPI...), which
+are only imported on first use, nor read the configuration (they are run with
+a missing configuration folder.)
+
+Example:
+    python -m benchmarks.importtime
+"""
+import argparse
+import os
+import subprocess
+import sys
+from dataclasses import dataclass
+from typing import Optional
+
+import mysensei.io as ms_io
+
+# Max import time of each module, in seconds (a few times the measured one)
+IMPORT_BUDGETS_S = {
+    "mysensei.settings": 0.15,
+    "mysensei.io": 0.15,
+    "mysensei.metrics": 0.05,
+    "mysensei.cache": 0.05,
+    "mysensei.results": 0.05,
+    "mysensei.generation": 0.3,
+    "mysensei.fewshot": 0.15,
+    "mysensei.batch": 0.3,
+    "mysensei.pipeline": 0.3,
+    "mysensei.jobs": 0.3,
+}
+# Dependencies that the modules above must not import
+DEFERRED_IMPORTS = ("openai", "aiohttp", "fastapi", "starlette", "nicegui", "sqlalchemy")
+N_RUNS = 3
+
+
+@dataclass
+class ImportReport:
+    """Import of a module in a fresh interpreter"""
+    module: str
+    best_s: float
+    deferred_imports: list[str]  # DEFERRED_IMPORTS that were imported
+
+
+def _import_once(module: str)->tuple[float, list[str]]:
+    """Cumulative import time of `module`, and the deferred imports it did"""
+    code = (f"import sys, {module}\n"
+            f"print(' '.join(m for m in {DEFERRED_IMPORTS!r} if m in sys.modules))")
+    env = os.environ | {"PYTHONPATH": ms_io.get_lib_path(),
+                        "MYSENSEI_CONFIG_PATH": os.path.join(os.devnull, "config")}
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                             env=env, capture_output=True, text=True, check=True)
+    # Lines are "import time: <self us> | <cumulative us> | <indented name>"
+    for line in process.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == module and not fields[2].startswith("  "):
+            return int(fields[1]) / 1e6, process.stdout.split()
+    raise RuntimeError(f"No import time reported for {module}")
+
+
+def measure_import(module: str, n_runs: int=N_RUNS)->ImportReport:
+    """Best import time of `module` over `n_runs` fresh interpreters"""
+    runs = [_import_once(module) for _ in range(n_runs)]
+    return ImportReport(module=module, best_s=min(s for s, _ in runs),
+                        deferred_imports=sorted(set().union(*[d for _, d in runs])))
+
+
+def main(argv: Optional[list[str]]=None)->None:
+    """Command-line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--runs", type=int, default=N_RUNS)
+    args = parser.parse_args(argv)
+    n_failed = 0
+    for module, budget_s in IMPORT_BUDGETS_S.items():
+        report = measure_import(module, n_runs=args.runs)
+        failed = report.best_s > budget_s or len(report.deferred_imports) > 0
+        n_failed += failed
+        line = f"{module:<25} {report.best_s * 1e3:>8.1f} ms (budget {budget_s * 1e3:.0f} ms)"
+        if len(report.deferred_imports) > 0:
+            line += " imports " + ", ".join(report.deferred_imports)
+        print(line + (" FAILED" if failed else ""), file=sys.stderr)
+    if n_failed > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
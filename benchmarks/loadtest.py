@@ -0,0 +1,373 @@
+"""
+Load test of the NiceGUI pages with simulated browser sessions
+
+Each session does what a browser would: GET the page, connect its websocket,
+then send UI events (typing concepts, clicking "Generate", navigating the
+results) and wait for the resulting updates. Sessions are run concurrently,
+for growing numbers of sessions; for each number, the report gives the page
+build time, the handler latencies of clicks (event sent -> update received),
+the generation latencies, the server memory per session and the websocket
+traffic.
+
+By default, the fake generation backend (mysensei.fake_llm) and the app are
+started by the harness, so that no API call is made. With `--workers`, the app
+is run by that many workers sharing their state (see mysensei.launcher), on
+consecutive ports from that of `--url`, and sessions are spread over them as a
+sticky proxy would.
+
+Examples:
+    python -m benchmarks.loadtest --app app/get_mnemonics.py --sessions 1,10,50
+    python -m benchmarks.loadtest --app app/main.py --sessions 1,10
+    python -m benchmarks.loadtest --workers 4 --sessions 10,50
+    python -m benchmarks.loadtest --no-start --url http://127.0.0.1:8080 --server-pid 1234
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+import httpx
+import socketio
+
+import mysensei.io as ms_io
+
+SOCKET_PATH = "/_nicegui_ws/socket.io"
+# Condition on an updated element (as sent to the browser), or on a method
+# call (with "method" and "args" keys)
+ElementPredicate = Callable[[dict], bool]
+# Time given to an update to arrive, in seconds
+UPDATE_TIMEOUT_S = 30.
+FAKE_LLM_PORT = 8001
+# Pause after typing into an input, in seconds
+TYPING_PAUSE_S = 0.05
+
+
+# ========
+# Sessions
+# ========
+@dataclass
+class SessionStats:
+    """Measurements of a session"""
+    page_build_s: float = 0.
+    handler_latencies_s: list[float] = field(default_factory=list)
+    generation_latencies_s: list[float] = field(default_factory=list)
+    n_messages: int = 0
+    n_bytes: int = 0
+    n_errors: int = 0
+
+
+class BrowserSession:
+    """A simulated browser on a NiceGUI page"""
+
+    def __init__(self, url: str, stats: SessionStats)->None:
+        self.url = url
+        self.stats = stats
+        self.elements: dict[str, dict] = {}
+        self._sio = socketio.AsyncClient(reconnection=False)
+        self._updates: asyncio.Queue = asyncio.Queue()
+        self._sio.on("*", self._on_message)
+
+    async def open(self, http: httpx.AsyncClient)->None:
+        """Load the page and connect its websocket"""
+        started_at = time.perf_counter()
+        response = await http.get(self.url)
+        response.raise_for_status()
+        self.stats.page_build_s = time.perf_counter() - started_at
+        client_id = re.search(r'client_id: "(.*?)"', response.text).group(1)
+        self.elements = json.loads(
+            re.search(r"const elements = (.*);\n", response.text).group(1)
+        )
+        await self._sio.connect(f"{self.url}?client_id={client_id}",
+                                socketio_path=SOCKET_PATH, transports=["websocket"])
+        if not await self._sio.call("handshake", timeout=UPDATE_TIMEOUT_S):
+            raise RuntimeError("Handshake refused")
+
+    async def close(self)->None:
+        await self._sio.disconnect()
+
+    def find(self, tag: str, **props: Any)->list[dict]:
+        """Elements with `tag` and `props`"""
+        return [e for e in self.elements.values()
+                if e["tag"] == tag and all(e["props"].get(k) == v for k, v in props.items())]
+
+    async def send(self, element: dict, event_type: str, args: Any)->None:
+        """Send a UI event, as the browser would"""
+        listener = next(e for e in element["events"] if e["type"] == event_type)
+        await self._sio.emit("event", {"id": element["id"],
+                                       "listener_id": listener["listener_id"],
+                                       "args": args})
+
+    async def type(self, element: dict, value: str,
+                   wait_for: Optional[ElementPredicate]=None)->None:
+        """Type into an input, then pause for `TYPING_PAUSE_S`
+
+        Inputs do not echo their value back, so there is no update to time,
+        unless the handler changes the page: then, `wait_for` an update.
+        """
+        event_type = next(e["type"] for e in element["events"] if e["type"].startswith("update:"))
+        if wait_for is not None:
+            await self._timed(self.send(element, event_type, value),
+                              self.stats.handler_latencies_s, wait_for=wait_for)
+        else:
+            await self.send(element, event_type, value)
+            await asyncio.sleep(TYPING_PAUSE_S)
+
+    async def click(self, element: dict, wait_for: Optional[ElementPredicate]=None,
+                    is_generation: bool=False)->None:
+        """Click a button, and wait for an update (of an element satisfying
+        `wait_for`, if given)"""
+        latencies = (self.stats.generation_latencies_s if is_generation
+                     else self.stats.handler_latencies_s)
+        await self._timed(self.send(element, "click", {}), latencies, wait_for=wait_for)
+
+    async def _timed(self, sending, latencies: list[float],
+                     wait_for: Optional[ElementPredicate]=None)->None:
+        while not self._updates.empty():  # Updates of previous events
+            self._updates.get_nowait()
+        started_at = time.perf_counter()
+        await sending
+        try:
+            while True:
+                elements = await asyncio.wait_for(self._updates.get(),
+                                                  timeout=UPDATE_TIMEOUT_S)
+                if wait_for is None or any(wait_for(e) for e in elements):
+                    break
+        except asyncio.TimeoutError:
+            self.stats.n_errors += 1
+            return
+        latencies.append(time.perf_counter() - started_at)
+
+    async def _on_message(self, event: str, data: Any=None)->None:
+        self.stats.n_messages += 1
+        self.stats.n_bytes += len(json.dumps(data))
+        if event == "update":
+            for element in data.values():
+                self.elements[str(element["id"])] = element
+            self._updates.put_nowait(list(data.values()))
+        elif event == "run_method":
+            # E.g., new markdown content: reported as an element with the args
+            self._updates.put_nowait([{"id": data["id"], "props": {}, "text": None,
+                                       "method": data["name"], "args": data["args"]}])
+
+
+def _shows_result_position(element: dict)->bool:
+    """Is `element` the "<result>/<n results>" label of get_mnemonics.py?"""
+    return re.match(r"^\d+/\d+$", element.get("text") or "") is not None
+
+
+async def get_mnemonics_scenario(session: BrowserSession, n_generations: int)->None:
+    """Type concepts, generate mnemonics, navigate them"""
+    inputs = session.find("nicegui-input")
+    for element, value in zip(inputs, ["ignition", "departure", "fire"]):
+        await session.type(element, value)
+    generate_button = session.find("q-btn", label="Generate")[0]
+    for _ in range(n_generations):
+        await session.click(generate_button, wait_for=_shows_result_position,
+                            is_generation=True)
+    if n_generations > 1:
+        await session.click(session.find("q-btn", icon="arrow_back")[0])
+        await session.click(session.find("q-btn", icon="arrow_forward")[0])
+
+
+async def main_scenario(session: BrowserSession, n_generations: int)->None:
+    """Fill out the concepts of the meaning tab, until its prompt preview
+    shows up (the latency includes the preview debounce)
+
+    The page of app/main.py is shared by all browsers, so each session types
+    its own values (otherwise, the prompt would not change.)
+    """
+    token = uuid.uuid4().hex[:8]
+    target_input, *component_inputs = session.find("nicegui-input")[:3]
+    await session.type(target_input, f"ignition-{token}")
+    await session.type(component_inputs[0], f"departure-{token}")
+    await session.type(component_inputs[1], f"fire-{token}",
+                       wait_for=lambda e: f"fire-{token}" in str(e.get("args")))
+
+
+SCENARIOS = {
+    "get_mnemonics.py": get_mnemonics_scenario,
+    "main.py": main_scenario,
+}
+
+
+# ======
+# Server
+# ======
+def get_rss_bytes(pid: int)->int:
+    """Resident memory of a process and its descendants (Linux only)"""
+    total = 0
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                # Zombies have no VmRSS
+                total += next((int(l.split()[1]) * 1024 for l in f
+                               if l.startswith("VmRSS:")), 0)
+            for task in os.listdir(f"/proc/{pid}/task"):
+                with open(f"/proc/{pid}/task/{task}/children") as f:
+                    pids.extend(int(p) for p in f.read().split())
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+    return total
+
+
+def worker_urls(url: str, n_workers: int)->list[str]:
+    """URLs of the workers, on consecutive ports from that of `url`"""
+    parsed = httpx.URL(url)
+    return [str(parsed.copy_with(port=parsed.port + i)) for i in range(n_workers)]
+
+
+def start_servers(app_path: str, url: str, n_workers: int=1)->list[subprocess.Popen]:
+    """Start the fake LLM server and the app (using it; run by `n_workers`
+    workers if more than one), wait until the app answers"""
+    env = os.environ | {
+        "PYTHONPATH": ms_io.get_lib_path(),
+        # Settings overrides (see mysensei.settings)
+        "MYSENSEI__GENERATION__BACKEND": "fake",
+        "MYSENSEI__GENERATION__API_BASE": f"http://127.0.0.1:{FAKE_LLM_PORT}/v1",
+    }
+    processes = [
+        subprocess.Popen([sys.executable, "-m", "mysensei.fake_llm",
+                          "--port", str(FAKE_LLM_PORT)], env=env),
+    ]
+    if n_workers > 1:
+        shared_state_path = os.path.join(tempfile.mkdtemp(), "shared_state.sqlite")
+        command = [sys.executable, "-m", "mysensei.launcher", "--app", app_path,
+                   "--workers", str(n_workers), "--base-port", str(httpx.URL(url).port),
+                   "--shared-state-path", shared_state_path]
+    else:
+        command = [sys.executable, app_path]
+    processes.append(subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL,
+                                      stderr=subprocess.DEVNULL))
+    urls = worker_urls(url, n_workers)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            if all(httpx.get(u).status_code == 200 for u in urls):
+                return processes
+        except httpx.TransportError:
+            pass
+        time.sleep(0.5)
+    stop_servers(processes)
+    raise RuntimeError(f"{app_path} did not answer on {url}")
+
+
+def stop_servers(processes: list[subprocess.Popen])->None:
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.wait(timeout=30)
+
+
+# ===
+# Run
+# ===
+def _percentile(values: list[float], q: float)->float:
+    if len(values) == 0:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run_step(urls: list[str], scenario, n_sessions: int, n_generations: int,
+                   server_pid: Optional[int])->dict:
+    """Run `n_sessions` concurrent sessions, spread over `urls`, and summarize
+    them"""
+    rss_before = get_rss_bytes(server_pid) if server_pid else 0
+    all_stats = [SessionStats() for _ in range(n_sessions)]
+    sessions = [BrowserSession(url=urls[i % len(urls)], stats=s)
+                for i, s in enumerate(all_stats)]
+    # A client (cookie jar) per session, as with distinct browsers
+    https = [httpx.AsyncClient(timeout=UPDATE_TIMEOUT_S) for _ in sessions]
+    try:
+        await asyncio.gather(*[s.open(h) for s, h in zip(sessions, https)])
+        started_at = time.perf_counter()
+        await asyncio.gather(*[scenario(s, n_generations) for s in sessions])
+        elapsed_s = time.perf_counter() - started_at
+        # Memory while all sessions are alive
+        rss_after = get_rss_bytes(server_pid) if server_pid else 0
+        await asyncio.gather(*[s.close() for s in sessions])
+    finally:
+        await asyncio.gather(*[h.aclose() for h in https])
+    handler = [l for s in all_stats for l in s.handler_latencies_s]
+    generation = [l for s in all_stats for l in s.generation_latencies_s]
+    page = [s.page_build_s for s in all_stats]
+    return {
+        "n_sessions": n_sessions,
+        "page_build_p50_s": _percentile(page, 0.5),
+        "page_build_p99_s": _percentile(page, 0.99),
+        "handler_p50_s": _percentile(handler, 0.5),
+        "handler_p99_s": _percentile(handler, 0.99),
+        "generation_p50_s": _percentile(generation, 0.5),
+        "generation_p99_s": _percentile(generation, 0.99),
+        "generations_per_s": len(generation) / elapsed_s,
+        "rss_per_session_bytes": (rss_after - rss_before) / n_sessions if server_pid else None,
+        "messages_per_session": sum(s.n_messages for s in all_stats) / n_sessions,
+        "bytes_per_session": sum(s.n_bytes for s in all_stats) / n_sessions,
+        "n_timeouts": sum(s.n_errors for s in all_stats),
+    }
+
+
+def _print_report(steps: list[dict])->None:
+    print(f"{'sessions':>8} {'page p50':>9} {'page p99':>9} {'handler p50':>12}"
+          f" {'handler p99':>12} {'gen p50':>8} {'gen p99':>8} {'gen/s':>6} {'RSS/sess':>9}"
+          f" {'msgs/sess':>10} {'kB/sess':>8} {'timeouts':>8}")
+    for step in steps:
+        rss = step["rss_per_session_bytes"]
+        print(f"{step['n_sessions']:>8}"
+              f" {step['page_build_p50_s'] * 1e3:>7.1f}ms {step['page_build_p99_s'] * 1e3:>7.1f}ms"
+              f" {step['handler_p50_s'] * 1e3:>10.1f}ms {step['handler_p99_s'] * 1e3:>10.1f}ms"
+              f" {step['generation_p50_s']:>7.2f}s {step['generation_p99_s']:>7.2f}s"
+              f" {step['generations_per_s']:>6.1f}"
+              f" {'' if rss is None else f'{rss / 1024 ** 2:.2f}MB':>9}"
+              f" {step['messages_per_session']:>10.0f} {step['bytes_per_session'] / 1024:>8.1f}"
+              f" {step['n_timeouts']:>8}")
+
+
+def main(argv: Optional[list[str]]=None)->None:
+    """Command-line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--app", default="app/get_mnemonics.py", help="App to load test")
+    parser.add_argument("--url", default="http://127.0.0.1:8080/")
+    parser.add_argument("--sessions", default="1,5,10,25,50",
+                        help="Comma-separated numbers of concurrent sessions")
+    parser.add_argument("--generations", type=int, default=3,
+                        help="Generations per session (get_mnemonics.py)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Workers running the app (on consecutive ports from that of --url)")
+    parser.add_argument("--no-start", dest="start", action="store_false",
+                        help="Test an already running app")
+    parser.add_argument("--server-pid", type=int,
+                        help="Pid of the already running app, for memory measurements")
+    parser.add_argument("--output", help="Save the report to this JSON file")
+    args = parser.parse_args(argv)
+    scenario = SCENARIOS[os.path.basename(args.app)]
+    processes = start_servers(args.app, args.url, n_workers=args.workers) if args.start else []
+    urls = worker_urls(args.url, args.workers)
+    server_pid = processes[-1].pid if args.start else args.server_pid
+    try:
+        steps = [
+            asyncio.run(run_step(urls=urls, scenario=scenario, n_sessions=int(n),
+                                 n_generations=args.generations, server_pid=server_pid))
+            for n in args.sessions.split(",")
+        ]
+    finally:
+        if args.start:
+            stop_servers(processes)
+    _print_report(steps)
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(steps, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
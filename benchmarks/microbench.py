@@ -0,0 +1,252 @@
+"""
+Microbenchmarks of the core library paths
+
+Each case is timed over enough calls to last a few hundredths of a second,
+several times; the best per-call time is kept, as the least noisy estimate.
+Results can be saved as a JSON baseline, and later runs compared to it: the
+run fails if a case got slower than the baseline by more than the threshold.
+
+Examples:
+    python -m benchmarks.microbench --save benchmarks/baselines/main.json
+    python -m benchmarks.microbench --compare benchmarks/baselines/main.json --threshold 0.25
+    python -m benchmarks.microbench -k prompt_params
+"""
+import argparse
+import json
+import platform
+import random
+import string
+import sys
+import time
+from dataclasses import dataclass, make_dataclass
+from datetime import datetime, timezone
+from typing import Any, Callable, Optional
+
+import mysensei.fewshot as ms_fewshot
+import mysensei.io as ms_io
+from mysensei.generation import PromptParams, TCParams, TCRevisionParams, TCSoundParams
+from mysensei.results import TCConcepts, TCResult
+from mysensei.similarity import SimilarityIndex
+from mysensei.text import replace_linebreaks_w_br
+
+# Min duration of a timed run, in seconds
+MIN_RUN_S = 0.05
+N_RUNS = 5
+DEFAULT_THRESHOLD = 0.25
+
+
+# =====
+# Cases
+# =====
+def _flat_params(n_fields: int)->PromptParams:
+    """PromptParams with `n_fields` str fields, half of them empty"""
+    params_class = make_dataclass(
+        f"FlatParams{n_fields}", [(f"field{i}", str) for i in range(n_fields)],
+        bases=(PromptParams,),
+    )
+    return params_class(**{f"field{i}": "" if i % 2 else "value" for i in range(n_fields)})
+
+
+def _nested_value(depth: int, width: int=4)->Any:
+    """Dict nested `depth` levels, `width` keys per level, half the leaves empty"""
+    if depth == 0:
+        return "value"
+    value = {str(i): _nested_value(depth - 1, width) for i in range(width)}
+    if depth == 1:
+        value = {k: "" if int(k) % 2 else v for k, v in value.items()}
+    return value
+
+
+def _nested_params(depth: int)->PromptParams:
+    params_class = make_dataclass(f"NestedParams{depth}", [("field", dict)],
+                                  bases=(PromptParams,))
+    return params_class(field=_nested_value(depth))
+
+
+# Parameters to render each template with
+TEMPLATE_SAMPLE_PARAMS = {
+    "pure_concepts": {
+        "target_concept": "ignition",
+        "component_concepts": {"0": "departure", "1": "fire"},
+    },
+    "pure_concepts_revision": {
+        "target_concept": "ignition",
+        "component_concepts": {"0": "departure", "1": "fire"},
+        "mnemonic": "A DEPARTURE of FIRE from the flint: the fuse IGNITES!",
+    },
+    "reading_mnem": {
+        "target_concept": "ignition",
+        "component_concepts_sounds": {
+            "0": {"concept": "small hammer", "details": "a hammer", "sound": "はっ"},
+            "1": {"concept": "car", "details": "an old car", "sound": "か"},
+        },
+        "meaning_mnemonic": "A DEPARTURE of FIRE from the flint: the fuse IGNITES!",
+    },
+}
+
+
+def _text(n_bytes: int)->str:
+    """Text of about `n_bytes`, with single and double line breaks"""
+    paragraph = "A line of a generated mnemonic.\nAnother line.\n\n"
+    return paragraph * (n_bytes // len(paragraph))
+
+
+def _similarity_index(n_results: int)->SimilarityIndex:
+    """Index of `n_results` results with random concepts (and 40-word mnemonics)"""
+    rng = random.Random(0)
+    words = ["".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 9)))
+             for _ in range(3000)]
+    index = SimilarityIndex()
+    for _ in range(n_results):
+        index.add(TCResult(target_concept=rng.choice(words),
+                           component_concepts=tuple(rng.sample(words, 3)),
+                           mnemonic=" ".join(rng.sample(words, 40))))
+    return index
+
+
+def get_cases()->dict[str, Callable[[], Any]]:
+    """Benchmarked calls, by name (set-up done beforehand)"""
+    from mysensei.ui import PromptUI  # Pulls in nicegui
+
+    cases = {}
+    for n_fields in [4, 16, 64, 256]:
+        params = _flat_params(n_fields)
+        cases[f"prompt_params.non_filled_out_fields[fields={n_fields}]"] = \
+            params.non_filled_out_fields
+        cases[f"prompt_params.get_filled_out_fields_subfields[fields={n_fields}]"] = \
+            params.get_filled_out_fields_subfields
+    for depth in [1, 2, 3, 4]:
+        params = _nested_params(depth)
+        cases[f"prompt_params.non_filled_out_fields[depth={depth}]"] = \
+            params.non_filled_out_fields
+        cases[f"prompt_params.get_filled_out_fields_subfields[depth={depth}]"] = \
+            params.get_filled_out_fields_subfields
+    registry = ms_io.get_template_registry()
+    for template_name in registry.list_templates():
+        version = registry.list_versions(template_name=template_name)[-1]
+        cases[f"get_jinja_template[{template_name}]"] = (
+            lambda n=template_name, v=version: ms_io.get_jinja_template(template_name=n, version=v)
+        )
+        if template_name in TEMPLATE_SAMPLE_PARAMS:
+            template = ms_io.get_jinja_template(template_name=template_name, version=version)
+            cases[f"render[{template_name}]"] = (
+                lambda t=template, p=TEMPLATE_SAMPLE_PARAMS[template_name]:
+                    ms_fewshot.render_prompt(template=t, prompt_params_dict=p)
+            )
+    library = ms_fewshot.get_example_library("pure_concepts")
+    cases["example_library.select[pure_concepts]"] = lambda: library.select(
+        params=TEMPLATE_SAMPLE_PARAMS["pure_concepts"], k=2, max_tokens=512,
+    )
+    for n_bytes in [10_000, 1_000_000]:
+        text = _text(n_bytes)
+        cases[f"replace_linebreaks_w_br[bytes={n_bytes}]"] = \
+            lambda text=text: replace_linebreaks_w_br(text)
+    index = _similarity_index(n_results=10_000)
+    concepts = TCConcepts(target_concept="ignition",
+                          component_concepts=["departure", "fire", "", ""])
+    cases["similarity_index.query[results=10000]"] = lambda: index.query(concepts=concepts)
+    result = TCResult(target_concept="ignition", component_concepts=("departure", "fire"),
+                      mnemonic=" ".join(["word"] * 40))
+    cases["similarity_index.add"] = lambda: SimilarityIndex().add(result)
+    cases["prompt_ui.construction[pure_concepts]"] = lambda: PromptUI(
+        prompt_params=TCParams(target_concept="",
+                               component_concepts={str(i): "" for i in range(4)}),
+        template_name="pure_concepts", template_version=0,
+    )
+    cases["prompt_ui.construction[reading_mnem]"] = lambda: PromptUI(
+        prompt_params=TCSoundParams(
+            target_concept="",
+            component_concepts_sounds={
+                str(i): {"concept": "", "details": "", "sound": ""} for i in range(4)
+            },
+            meaning_mnemonic="",
+        ),
+        template_name="reading_mnem", template_version=0,
+    )
+    return cases
+
+
+# ======
+# Timing
+# ======
+@dataclass
+class Timing:
+    """Per-call time of a case, in seconds"""
+    best_s: float
+    median_s: float
+    n_calls: int
+
+
+def time_case(func: Callable[[], Any], min_run_s: float=MIN_RUN_S,
+              n_runs: int=N_RUNS)->Timing:
+    """Time `func` over `n_runs` runs of at least `min_run_s` each"""
+    n_calls = 1
+    while True:  # Calibration
+        started_at = time.perf_counter()
+        for _ in range(n_calls):
+            func()
+        if time.perf_counter() - started_at >= min_run_s:
+            break
+        n_calls *= 2
+    per_call_s = []
+    for _ in range(n_runs):
+        started_at = time.perf_counter()
+        for _ in range(n_calls):
+            func()
+        per_call_s.append((time.perf_counter() - started_at) / n_calls)
+    per_call_s.sort()
+    return Timing(best_s=per_call_s[0], median_s=per_call_s[len(per_call_s) // 2],
+                  n_calls=n_calls)
+
+
+def compare(baseline: dict[str, dict], current: dict[str, dict],
+            threshold: float)->dict[str, float]:
+    """Relative slowdown (e.g., 0.3 for 30% slower) of the cases slower than
+    their baseline by more than `threshold`"""
+    regressions = {}
+    for name, timing in current.items():
+        if name not in baseline:
+            continue
+        slowdown = timing["best_s"] / baseline[name]["best_s"] - 1
+        if slowdown > threshold:
+            regressions[name] = slowdown
+    return regressions
+
+
+def main(argv: Optional[list[str]]=None)->None:
+    """Command-line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("-k", dest="filter", default="",
+                        help="Only run the cases whose name contains this")
+    parser.add_argument("--save", help="Save the results to this JSON file")
+    parser.add_argument("--compare", help="JSON baseline to compare the results to")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="Max tolerated slowdown (0.25: 25%% slower)")
+    args = parser.parse_args(argv)
+    results = {}
+    for name, func in get_cases().items():
+        if args.filter not in name:
+            continue
+        timing = time_case(func)
+        results[name] = timing.__dict__
+        print(f"{name:<70} {timing.best_s * 1e6:>12.2f} us", file=sys.stderr)
+    if args.save is not None:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "results": results,
+            }, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(baseline=baseline, current=results, threshold=args.threshold)
+        for name, slowdown in regressions.items():
+            print(f"REGRESSION {name}: {slowdown:+.0%}", file=sys.stderr)
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""
+Bulk mnemonic generation from the command line
+
+Rows are read from a CSV or JSONL file, rendered with a template and sent for
+generation concurrently. Each finished row is appended to the output JSONL
+file straight away, which doubles as a checkpoint: running the same command
+again only generates the rows that are not in the output yet.
+
+Example:
+    python -m mysensei.batch words.jsonl mnemonics.jsonl \\
+        --template-name pure_concepts --template-version 0 --max-in-flight 8
+
+In CSV files, nested fields are spelled with dotted column names (e.g.,
+`component_concepts.0`, `component_concepts_sounds.0.sound`.) An optional `id`
+column identifies rows; the row number is used otherwise.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import sys
+from dataclasses import dataclass, fields
+from typing import Iterator, Optional
+
+from jinja2 import Template
+
+import mysensei.fewshot as ms_fewshot
+import mysensei.io as ms_io
+from mysensei.annotations import Prompt
+from mysensei.generation import (PromptParams, TCParams, TCRevisionParams,
+    TCSoundParams, agenerate_with_retries, DEFAULT_TIMEOUT_S)
+
+
+# =========
+# Constants
+# =========
+# Prompt parameters expected by each template
+TEMPLATE_PARAMS_CLASSES: dict[str, list[type[PromptParams]]] = {
+    "pure_concepts": [TCParams],
+    "pure_concepts_revision": [TCParams, TCRevisionParams],
+    "reading_mnem": [TCSoundParams],
+}
+ID_COLUMN = "id"
+
+
+class BatchInputError(Exception):
+    """An input row cannot be turned into prompt parameters"""
+    pass
+
+
+# =====
+# Input
+# =====
+def read_rows(path: str)->Iterator[tuple[str, dict]]:
+    """Lazily yield (row id, row) from a .csv or .jsonl file"""
+    extension = os.path.splitext(path)[1].lower()
+    with open(path, newline="", encoding="utf-8") as f:
+        if extension == ".csv":
+            lines = (_unflatten(row) for row in csv.DictReader(f))
+        elif extension == ".jsonl":
+            lines = (json.loads(line) for line in f if line.strip() != "")
+        else:
+            raise BatchInputError(f"Unsupported input format: {extension}")
+        for row_number, row in enumerate(lines):
+            row_id = str(row.pop(ID_COLUMN, row_number))
+            yield row_id, row
+
+
+def _unflatten(row: dict[str, str])->dict:
+    """Turn dotted keys into nested dicts ({"a.b": x} -> {"a": {"b": x}})"""
+    output = {}
+    for key, value in row.items():
+        *parents, leaf = key.split(".")
+        d = output
+        for parent in parents:
+            d = d.setdefault(parent, {})
+        d[leaf] = value
+    return output
+
+
+def build_prompt_params(
+    row: dict,
+    params_classes: list[type[PromptParams]],
+)->list[PromptParams]:
+    """Instantiate each of `params_classes` from the matching keys of `row`"""
+    prompt_params_lst = []
+    for params_class in params_classes:
+        field_names = [f.name for f in fields(params_class)]
+        missing = [n for n in field_names if n not in row]
+        if len(missing) > 0:
+            raise BatchInputError(
+                f"Missing {missing} for {params_class.__name__}"
+            )
+        prompt_params_lst.append(params_class(**{n: row[n] for n in field_names}))
+    return prompt_params_lst
+
+
+def render_prompt(template: Template, prompt_params_lst: list[PromptParams])->Prompt:
+    """Render `template` with the filled-out fields of all prompt parameters
+    (and few-shot examples, if it takes some)"""
+    prompt_params_dict = {}
+    for prompt_params in prompt_params_lst:
+        non_filled_out = prompt_params.non_filled_out_fields()
+        if len(non_filled_out) > 0:
+            raise BatchInputError(f"Fields {non_filled_out} are not filled out")
+        prompt_params_dict.update(prompt_params.get_filled_out_fields_subfields())
+    return ms_fewshot.render_prompt(template=template,
+                                    prompt_params_dict=prompt_params_dict).prompt
+
+
+# ======
+# Output
+# ======
+def read_checkpoint(path: str)->set[str]:
+    """Ids of the rows already present in the output file"""
+    if not os.path.exists(path):
+        return set()
+    done = set()
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                done.add(json.loads(line)[ID_COLUMN])
+            except (json.JSONDecodeError, KeyError):
+                # Line truncated by an interruption: the row will be redone
+                continue
+    return done
+
+
+def truncate_partial_line(path: str, chunk_size: int=4096)->None:
+    """Drop the end of the output file after its last newline (a line cut by
+    an interruption), so that appended rows start on a line of their own"""
+    if not os.path.exists(path):
+        return
+    with open(path, "r+b") as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(0, position - chunk_size)
+            f.seek(start)
+            newline_idx = f.read(position - start).rfind(b"\n")
+            if newline_idx >= 0:
+                position = start + newline_idx + 1
+                break
+            position = start
+        if position < end:
+            f.truncate(position)
+
+
+# ===
+# Run
+# ===
+@dataclass
+class BatchReport:
+    """Outcome of a batch run"""
+    n_skipped: int = 0
+    n_generated: int = 0
+    n_failed: int = 0
+
+
+async def run_batch(
+    rows: Iterator[tuple[str, dict]],
+    template: Template,
+    params_classes: list[type[PromptParams]],
+    output_path: str,
+    max_in_flight: int=4,
+    max_retries: int=5,
+    timeout: float=DEFAULT_TIMEOUT_S,
+    fresh: bool=False,
+    template_name: str="",
+    template_version: Optional[int]=None,
+)->BatchReport:
+    """Generate for every row not already in `output_path`
+
+    `max_in_flight` workers pull from `rows`, so that at most that many
+    generations are pending and the input is never loaded whole. The template
+    name and version label the generation metrics.
+    """
+    report = BatchReport()
+    truncate_partial_line(output_path)
+    done = read_checkpoint(output_path)
+    with open(output_path, "a", encoding="utf-8") as output_file:
+
+        async def worker()->None:
+            for row_id, row in rows:
+                if row_id in done:
+                    report.n_skipped += 1
+                    continue
+                try:
+                    prompt = render_prompt(
+                        template=template,
+                        prompt_params_lst=build_prompt_params(
+                            row=row, params_classes=params_classes
+                        ),
+                    )
+                    output = await agenerate_with_retries(
+                        prompt=prompt, timeout=timeout, max_retries=max_retries,
+                        fresh=fresh, template_name=template_name,
+                        template_version=template_version,
+                    )
+                except Exception as e:
+                    report.n_failed += 1
+                    print(f"Row {row_id} failed: {e!r}", file=sys.stderr)
+                    continue
+                output_file.write(json.dumps(
+                    {ID_COLUMN: row_id, "output": output}, ensure_ascii=False
+                ) + "\n")
+                output_file.flush()
+                report.n_generated += 1
+
+        await asyncio.gather(*[worker() for _ in range(max_in_flight)])
+    return report
+
+
+def main(argv: Optional[list[str]]=None)->None:
+    """Command-line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("input_path", help=".csv or .jsonl file of prompt parameters")
+    parser.add_argument("output_path", help=".jsonl file, appended to and used as checkpoint")
+    parser.add_argument("--template-name", required=True,
+                        choices=list(TEMPLATE_PARAMS_CLASSES.keys()))
+    parser.add_argument("--template-version", type=int, default=0)
+    parser.add_argument("--max-in-flight", type=int, default=4,
+                        help="Max number of concurrent generations")
+    parser.add_argument("--max-retries", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT_S,
+                        help="Timeout of each generation attempt, in seconds")
+    parser.add_argument("--fresh", action="store_true",
+                        help="Do not reuse cached completions")
+    args = parser.parse_args(argv)
+    template = ms_io.get_jinja_template(template_name=args.template_name,
+                                        version=args.template_version)
+    report = asyncio.run(run_batch(
+        rows=read_rows(args.input_path),
+        template=template,
+        params_classes=TEMPLATE_PARAMS_CLASSES[args.template_name],
+        output_path=args.output_path,
+        max_in_flight=args.max_in_flight,
+        max_retries=args.max_retries,
+        timeout=args.timeout,
+        fresh=args.fresh,
+        template_name=args.template_name,
+        template_version=args.template_version,
+    ))
+    print(f"{report.n_generated} generated, {report.n_skipped} already done,"
+          f" {report.n_failed} failed", file=sys.stderr)
+    if report.n_failed > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
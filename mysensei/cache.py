@@ -0,0 +1,233 @@
+"""
+Persistent cache for LLM completions
+
+Completions are keyed by a hash of the model, the sampling parameters and the
+prompt. Recently used entries are kept in memory; all entries are stored in a
+SQLite file, so that they are shared across sessions and restarts.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from mysensei.annotations import GeneratedText, Prompt
+
+# Share of `max_disk_bytes` left after an eviction, so that the entries that
+# follow do not trigger one each
+EVICTION_LOW_WATER_RATIO = 0.9
+
+
+@dataclass
+class CacheStats:
+    """Hit/miss counters of a CompletionCache"""
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    @property
+    def hits(self)->int:
+        return self.memory_hits + self.disk_hits
+
+    @property
+    def hit_rate(self)->float:
+        n_lookups = self.hits + self.misses
+        return 0. if n_lookups == 0 else self.hits / n_lookups
+
+
+class CompletionCache:
+    """Two-tier (in-memory LRU, then SQLite file) completion cache
+
+    Entries older than `ttl_s` are never returned. When the total size of the
+    stored completions exceeds `max_disk_bytes`, the least recently used ones
+    are evicted from the file, down to EVICTION_LOW_WATER_RATIO of it. Memory
+    hits are written back to the file's access times in batches (at the
+    latest, before an eviction.)
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_memory_entries: int=1024,
+        max_disk_bytes: int=256 * 1024 ** 2,
+        ttl_s: float=30 * 24 * 3600.,
+    )->None:
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl_s = ttl_s
+        self.stats = CacheStats()
+        self._memory: OrderedDict[str, tuple[GeneratedText, float]] = OrderedDict()
+        self._unsaved_accesses: dict[str, float] = {}  # Memory hits, by key
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False,
+                                           isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS completions ("
+            " key TEXT PRIMARY KEY,"
+            " completion TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS completions_accessed_at"
+            " ON completions (accessed_at)"
+        )
+        self._disk_bytes = self._stored_size()
+
+    @staticmethod
+    def make_key(model: str, prompt: Prompt, **sampling_params: Any)->str:
+        """Content address of a completion request"""
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        request = json.dumps(
+            {"model": model, "sampling_params": sampling_params, "prompt": prompt_hash},
+            sort_keys=True,
+        )
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def get(self, key: str)->Optional[GeneratedText]:
+        """Cached completion for `key`, or None if missing or expired"""
+        completion = self._get_from_memory(key)
+        return completion if completion is not None else self._get_from_disk(key)
+
+    async def aget(self, key: str)->Optional[GeneratedText]:
+        """`get` from the event loop: the file, shared with other processes
+        that may hold its lock, is read in a thread"""
+        import asyncio  # Slow to import, and only needed by async callers
+        completion = self._get_from_memory(key)
+        if completion is not None:
+            return completion
+        return await asyncio.to_thread(self._get_from_disk, key)
+
+    def set(self, key: str, completion: GeneratedText)->None:
+        """Store `completion` under `key`, replacing any previous one"""
+        now = time.time()
+        size = len(completion.encode("utf-8"))
+        with self._lock:
+            previous = self._connection.execute(
+                "SELECT size FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?)",
+                (key, completion, size, now, now),
+            )
+            self._disk_bytes += size - (0 if previous is None else previous[0])
+            self._remember(key=key, completion=completion, created_at=now)
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict()
+            else:
+                self._save_accesses_if_due()
+
+    async def aset(self, key: str, completion: GeneratedText)->None:
+        """`set` from the event loop (in a thread, see `aget`)"""
+        import asyncio
+        await asyncio.to_thread(self.set, key, completion)
+
+    def clear(self)->None:
+        """Drop all entries"""
+        with self._lock:
+            self._memory.clear()
+            self._unsaved_accesses.clear()
+            self._connection.execute("DELETE FROM completions")
+            self._disk_bytes = 0
+
+    def _get_from_memory(self, key: str)->Optional[GeneratedText]:
+        """Completion of the memory tier (None if not there), without touching
+        the file (which gets the access time with the next batch)"""
+        now = time.time()
+        with self._lock:
+            if key not in self._memory:
+                return None
+            completion, created_at = self._memory[key]
+            if now - created_at > self.ttl_s:
+                del self._memory[key]
+                return None
+            self._memory.move_to_end(key)
+            self._unsaved_accesses[key] = now
+            self.stats.memory_hits += 1
+            return completion
+
+    def _get_from_disk(self, key: str)->Optional[GeneratedText]:
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT completion, created_at FROM completions WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl_s:
+                if row is not None:
+                    self._connection.execute(
+                        "DELETE FROM completions WHERE key = ?", (key,)
+                    )
+                self.stats.misses += 1
+                return None
+            completion, created_at = row
+            self._connection.execute(
+                "UPDATE completions SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            self._remember(key=key, completion=completion, created_at=created_at)
+            self._save_accesses_if_due()
+            self.stats.disk_hits += 1
+            return completion
+
+    def _remember(self, key: str, completion: GeneratedText, created_at: float)->None:
+        """Put in the memory tier, dropping the least recently used entry if full"""
+        self._memory[key] = (completion, created_at)
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _save_accesses(self)->None:
+        """Write the access times of the memory hits to the file"""
+        self._connection.executemany(
+            "UPDATE completions SET accessed_at = MAX(accessed_at, ?) WHERE key = ?",
+            [(accessed_at, key) for key, accessed_at in self._unsaved_accesses.items()],
+        )
+        self._unsaved_accesses.clear()
+
+    def _save_accesses_if_due(self)->None:
+        if len(self._unsaved_accesses) >= self.max_memory_entries:
+            self._save_accesses()
+
+    def _stored_size(self)->int:
+        """Total size of the completions in the file, in bytes"""
+        return self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM completions"
+        ).fetchone()[0]
+
+    def _evict(self)->None:
+        """Delete expired entries, then least recently used ones until the
+        file holds at most EVICTION_LOW_WATER_RATIO of `max_disk_bytes` of
+        completions"""
+        self._connection.execute(
+            "DELETE FROM completions WHERE created_at < ?",
+            (time.time() - self.ttl_s,),
+        )
+        self._save_accesses()
+        total_size = self._stored_size()
+        low_water_bytes = int(self.max_disk_bytes * EVICTION_LOW_WATER_RATIO)
+        rows = self._connection.execute(
+            "SELECT key, size FROM completions ORDER BY accessed_at"
+        )
+        to_delete = []
+        for key, size in rows:
+            if total_size <= low_water_bytes:
+                break
+            to_delete.append(key)
+            total_size -= size
+        rows.close()
+        self._connection.executemany(
+            "DELETE FROM completions WHERE key = ?", [(k,) for k in to_delete]
+        )
+        for key in to_delete:
+            self._memory.pop(key, None)
+        self.stats.evictions += len(to_delete)
+        self._disk_bytes = total_size
@@ -0,0 +1,165 @@
+"""
+Local fake of the OpenAI chat completions API, for load tests and CI
+
+Completions are lorem-ipsum words, delivered with realistic timings: a
+log-normal time to first token, then tokens at a given rate (streamed as
+server-sent events if requested.) Server errors and rate-limit responses can
+be injected at random, or rate limits enforced for real.
+
+Example:
+    python -m mysensei.fake_llm --port 8001 --ttft-median-s 0.8 --error-rate 0.01
+
+then set `backend = "fake"` in the [generation] section of config.toml (or
+MYSENSEI__GENERATION__BACKEND=fake.)
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass, fields
+from typing import AsyncIterator, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+_WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod"
+          " tempor incididunt ut labore et dolore magna aliqua").split()
+
+
+@dataclass
+class FakeLLMConfig:
+    """Behaviour of the fake server"""
+    # Time to first token: log-normal with this median, and sigma of log
+    ttft_median_s: float = 0.8
+    ttft_sigma: float = 0.5
+    # Rate at which tokens come after the first one
+    tokens_per_s: float = 40.
+    # Completion length: uniform in [min, max] tokens
+    min_completion_tokens: int = 40
+    max_completion_tokens: int = 120
+    # Share of requests answered with a 500, or with a 429
+    error_rate: float = 0.
+    rate_limit_rate: float = 0.
+    # Requests beyond that many in the last minute get a 429 (no limit if None)
+    requests_per_minute: Optional[int] = None
+    seed: Optional[int] = None
+
+
+def _error(status_code: int, error_type: str, message: str)->JSONResponse:
+    headers = {"Retry-After": "1"} if status_code == 429 else {}
+    return JSONResponse(status_code=status_code, headers=headers, content={
+        "error": {"message": message, "type": error_type, "param": None, "code": None}
+    })
+
+
+def create_app(config: Optional[FakeLLMConfig]=None)->FastAPI:
+    """FastAPI app serving POST /v1/chat/completions"""
+    config = config or FakeLLMConfig()
+    rng = random.Random(config.seed)
+    request_times: deque[float] = deque()
+    app = FastAPI()
+    app.state.config = config
+    app.state.n_requests = 0
+
+    def rejection()->Optional[Response]:
+        """Injected or enforced error response, if any"""
+        now = time.monotonic()
+        if config.requests_per_minute is not None:
+            while request_times and request_times[0] < now - 60:
+                request_times.popleft()
+            if len(request_times) >= config.requests_per_minute:
+                return _error(429, "requests", "Rate limit reached for requests")
+            request_times.append(now)
+        draw = rng.random()
+        if draw < config.rate_limit_rate:
+            return _error(429, "requests", "Rate limit reached (injected)")
+        if draw < config.rate_limit_rate + config.error_rate:
+            return _error(500, "server_error", "Internal error (injected)")
+        return None
+
+    def completion_tokens()->list[str]:
+        n_tokens = rng.randint(config.min_completion_tokens, config.max_completion_tokens)
+        return [("" if i == 0 else " ") + rng.choice(_WORDS) for i in range(n_tokens)]
+
+    def ttft_s()->float:
+        return rng.lognormvariate(0, config.ttft_sigma) * config.ttft_median_s
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request)->Response:
+        app.state.n_requests += 1
+        body = await request.json()
+        if (response := rejection()) is not None:
+            return response
+        model = body.get("model", "fake")
+        n = body.get("n", 1)
+        prompt_tokens = sum(len(m.get("content", "")) for m in body.get("messages", [])) // 4
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        if body.get("stream", False):
+            return StreamingResponse(
+                _stream(completion_id=completion_id, created=created, model=model,
+                        tokens=completion_tokens(), ttft_s=ttft_s(),
+                        tokens_per_s=config.tokens_per_s),
+                media_type="text/event-stream",
+            )
+        choices_tokens = [completion_tokens() for _ in range(n)]
+        n_completion_tokens = sum(len(t) for t in choices_tokens)
+        await asyncio.sleep(ttft_s() + max(len(t) for t in choices_tokens) / config.tokens_per_s)
+        return JSONResponse({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [
+                {"index": i, "finish_reason": "stop",
+                 "message": {"role": "assistant", "content": "".join(tokens)}}
+                for i, tokens in enumerate(choices_tokens)
+            ],
+            "usage": {"prompt_tokens": prompt_tokens,
+                      "completion_tokens": n_completion_tokens,
+                      "total_tokens": prompt_tokens + n_completion_tokens},
+        })
+
+    return app
+
+
+async def _stream(completion_id: str, created: int, model: str, tokens: list[str],
+                  ttft_s: float, tokens_per_s: float)->AsyncIterator[str]:
+    """Server-sent events of a streamed completion"""
+    def event(delta: dict, finish_reason: Optional[str]=None)->str:
+        chunk = {"id": completion_id, "object": "chat.completion.chunk",
+                 "created": created, "model": model,
+                 "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+        return f"data: {json.dumps(chunk)}\n\n"
+
+    await asyncio.sleep(ttft_s)
+    yield event({"role": "assistant"})
+    for i, token in enumerate(tokens):
+        if i > 0:
+            await asyncio.sleep(1 / tokens_per_s)
+        yield event({"content": token})
+    yield event({}, finish_reason="stop")
+    yield "data: [DONE]\n\n"
+
+
+def main(argv: Optional[list[str]]=None)->None:
+    """Command-line entry point"""
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    for f in fields(FakeLLMConfig):
+        parser.add_argument(f"--{f.name.replace('_', '-')}", dest=f.name,
+                            type=int if "int" in str(f.type) else float,
+                            default=f.default)
+    args = parser.parse_args(argv)
+    config = FakeLLMConfig(**{f.name: getattr(args, f.name) for f in fields(FakeLLMConfig)})
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""
+Few-shot examples, picked for each prompt
+
+Templates that take examples (e.g., pure_concepts/1.jinja) loop over an
+`examples` variable. Their example library is templates/<name>/examples.jsonl:
+one example per line, with the same fields as the template parameters, plus
+the `mnemonic` written for them. Examples are rendered once, when the library
+is read, by the templates/<name>/example.jinja partial; templates get their
+text.
+
+For each prompt, the examples whose concepts (and sounds) are closest to the
+prompt parameters' are kept, up to `k` of them and as long as the whole prompt
+fits in `max_prompt_tokens` (give or take the template text introducing the
+examples): prompts only hold the examples that matter, and
+get shorter (hence faster and cheaper) than with hardcoded examples.
+"""
+import json
+import os
+import threading
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from jinja2 import Template, meta
+
+import mysensei.io as ms_io
+import mysensei.metrics as ms_metrics
+from mysensei.annotations import Prompt, PromptParamName
+from mysensei.settings import get_settings
+from mysensei.similarity import concepts_features, jaccard
+from mysensei.text import estimate_n_tokens
+
+EXAMPLES_FILENAME = "examples.jsonl"
+EXAMPLE_TEMPLATE_FILENAME = "example.jinja"
+
+_PROMPT_TOKENS_ESTIMATED = ms_metrics.get_registry().histogram(
+    "mysensei_prompt_tokens_estimated",
+    "Estimated prompt tokens per rendering, few-shot examples included",
+    ("template", "version"), buckets=ms_metrics.TOKEN_BUCKETS,
+)
+
+
+class ExampleLibraryError(Exception):
+    """An example library cannot be read"""
+    pass
+
+
+# ========
+# Examples
+# ========
+def params_features(params: dict[PromptParamName, Any])->set[str]:
+    """Features compared between prompt parameters and examples: n-grams of
+    the concepts, and sounds"""
+    components = [*params.get("component_concepts", {}).values(),
+                  *params.get("component_concepts_sounds", {}).values()]
+    concepts = [c if isinstance(c, str) else c.get("concept", "") for c in components]
+    features = concepts_features(params.get("target_concept", ""), concepts)
+    features.update("s" + c["sound"] for c in components
+                    if isinstance(c, dict) and c.get("sound", "") != "")
+    return features
+
+
+@dataclass(frozen=True)
+class Example:
+    """Prompt parameters, and the mnemonic written for them"""
+    fields: dict[str, Any]  # Template parameters, mnemonic included
+    text: str  # As displayed in prompts
+    n_tokens: int  # Estimate, separating line break included
+    features: frozenset[str]
+
+
+class ExampleLibrary:
+    """Examples of a template, and their selection"""
+
+    def __init__(self, example_template: Template,
+                 examples_fields: list[dict[str, Any]])->None:
+        self.examples = []
+        for example_fields in examples_fields:
+            text = example_template.render(example=example_fields)
+            self.examples.append(Example(
+                fields=example_fields, text=text,
+                n_tokens=estimate_n_tokens(text) + 1,
+                features=frozenset(params_features(example_fields)),
+            ))
+
+    def __len__(self)->int:
+        return len(self.examples)
+
+    def select(self, params: dict[PromptParamName, Any], k: int,
+               max_tokens: int)->list[Example]:
+        """Up to `k` of the examples closest to `params`, fitting in
+        `max_tokens` altogether; closest last, i.e., right before the prompt
+        parameters"""
+        features = params_features(params)
+        ranked = sorted(
+            range(len(self.examples)),
+            key=lambda i: (-jaccard(features, self.examples[i].features),
+                           self.examples[i].n_tokens, i),
+        )
+        selected = []
+        n_tokens = 0
+        for i in ranked:
+            if len(selected) == k:
+                break
+            example = self.examples[i]
+            if n_tokens + example.n_tokens <= max_tokens:
+                selected.append(example)
+                n_tokens += example.n_tokens
+        return selected[::-1]
+
+
+def load_example_library(template_dirpath: str, template_name: str)->Optional[ExampleLibrary]:
+    """Example library of `template_name`, None if it takes no examples"""
+    filepath = os.path.join(template_dirpath, template_name, EXAMPLES_FILENAME)
+    if not os.path.isfile(filepath):
+        return None
+    examples_fields = []
+    with open(filepath, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if line.strip() == "":
+                continue
+            try:
+                examples_fields.append(json.loads(line))
+            except json.JSONDecodeError as e:
+                raise ExampleLibraryError(f"{filepath}:{line_number}: {e}") from e
+    with open(os.path.join(template_dirpath, template_name, EXAMPLE_TEMPLATE_FILENAME),
+              encoding="utf-8") as f:
+        example_template = Template(f.read())
+    return ExampleLibrary(example_template=example_template,
+                          examples_fields=examples_fields)
+
+
+_LIBRARIES: dict[str, Optional[ExampleLibrary]] = {}
+_LIBRARIES_LOCK = threading.Lock()
+
+
+def get_example_library(template_name: str)->Optional[ExampleLibrary]:
+    """Process-wide example library of `template_name`, read on first call"""
+    with _LIBRARIES_LOCK:
+        if template_name not in _LIBRARIES:
+            _LIBRARIES[template_name] = load_example_library(
+                template_dirpath=ms_io.get_template_registry().template_dirpath,
+                template_name=template_name,
+            )
+        return _LIBRARIES[template_name]
+
+
+# =========
+# Rendering
+# =========
+_TAKES_EXAMPLES: dict[Template, bool] = {}
+
+
+def takes_examples(template: Template)->bool:
+    """Whether `template` uses the `examples` variable"""
+    if template not in _TAKES_EXAMPLES:
+        environment = template.environment
+        source, _, _ = environment.loader.get_source(environment, template.name)
+        _TAKES_EXAMPLES[template] = \
+            "examples" in meta.find_undeclared_variables(environment.parse(source))
+    return _TAKES_EXAMPLES[template]
+
+
+@dataclass(frozen=True)
+class RenderedPrompt:
+    """A rendered prompt, and its estimated size"""
+    prompt: Prompt
+    n_tokens: int  # Estimate (see mysensei.text.estimate_n_tokens)
+    n_examples: int
+
+
+def render_prompt(template: Template, prompt_params_dict: dict[PromptParamName, Any],
+                  k: Optional[int]=None,
+                  max_prompt_tokens: Optional[int]=None)->RenderedPrompt:
+    """Render `template` (templates/<name>/<version>.jinja) with
+    `prompt_params_dict`, and the examples selected for them if the template
+    has an example library. `k` and `max_prompt_tokens` default to the
+    [few_shot] settings."""
+    template_name, _, filename = template.name.rpartition("/")
+    version = os.path.splitext(filename)[0]
+    library = get_example_library(template_name) if takes_examples(template) else None
+    prompt = template.render(**prompt_params_dict)
+    n_tokens = estimate_n_tokens(prompt)
+    n_examples = 0
+    if library is not None:
+        settings = get_settings().few_shot
+        examples = library.select(
+            params=prompt_params_dict,
+            k=settings.k if k is None else k,
+            max_tokens=(settings.max_prompt_tokens if max_prompt_tokens is None
+                        else max_prompt_tokens) - n_tokens,
+        )
+        if len(examples) > 0:
+            prompt = template.render(**prompt_params_dict,
+                                     examples=[e.text for e in examples])
+            n_tokens = estimate_n_tokens(prompt)
+            n_examples = len(examples)
+    _PROMPT_TOKENS_ESTIMATED.observe(n_tokens, template=template_name, version=version)
+    return RenderedPrompt(prompt=prompt, n_tokens=n_tokens, n_examples=n_examples)
@@ -1,20 +1,39 @@
 """
 Tools for text generation
 """
-import openai
-from copy import deepcopy
-from dataclasses import dataclass, fields, Field
-from typing import Any, Union, Literal
+import asyncio
+import json
+import os
+import random
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field, fields, Field
+from typing import Any, AsyncIterator, Iterator, Optional, Union, Literal
 from jinja2 import Template
 
 import mysensei.io as ms_io
+import mysensei.metrics as ms_metrics
+from mysensei.settings import get_settings
+from mysensei.cache import CompletionCache
+from mysensei.ratelimit import (RateLimiter, RateLimitTimeoutError, SharedRateLimiter,
+    SingleFlight)
+from mysensei.text import estimate_n_tokens
 from mysensei.annotations import TargetConcept, ComponentConcept, PromptParamName, Prompt
 
 
 # =========
 # Constants
 # =========
-_API_KEY = ms_io.get_conf_toml("secrets.toml")["open_ai"]["api_key"]
+GPT4_MODEL = "gpt-4"
+DEFAULT_TIMEOUT_S = 120.
+COMPLETION_CACHE_PATH = os.path.join(ms_io.get_lib_path(), "cache", "completions.sqlite")
+_COMPLETION_CACHE: Optional[CompletionCache] = None
+# Default address of the local fake server (python -m mysensei.fake_llm)
+FAKE_LLM_API_BASE = "http://127.0.0.1:8001/v1"
+_BACKEND: Optional["GenerationBackend"] = None
+_RATE_LIMITER: Optional[RateLimiter] = None
+# Identical generations in flight (by cache key), shared by their callers
+_SINGLE_FLIGHT = SingleFlight()
 
 
 # =================
@@ -25,6 +44,81 @@ class PromptFieldTypeError(Exception):
     pass
 
 
+# Prompt field values: str, or dict (possibly nested) of str
+PromptFieldValue = Union[str, dict[str, str], dict[str, dict[str, str]]]
+
+
+def _field_error_message(field_name: str)->str:
+    """Return error msg for field type errors"""
+    error_msg = "Field {field_name} is not str, dict[str, str] or dict[str, dict[str, str]]"
+    return error_msg.format(field_name=field_name)
+
+
+def _filled_out_part(value: Any, field_name: PromptParamName)->Optional[PromptFieldValue]:
+    """Return `value` without its empty (nested) subfields, or None if nothing
+    is left
+
+    Values are str or dicts whose values are either all str or all dicts
+    (themselves following the same rule, at any depth.) A dict without any
+    empty subfield is returned as is rather than copied.
+    """
+    if isinstance(value, str):
+        return value if value != "" else None
+    if not isinstance(value, dict):
+        raise PromptFieldTypeError(_field_error_message(field_name=field_name))
+    filled_out = {}
+    has_str = has_dict = False
+    for subfield_name, subfield_value in value.items():
+        if isinstance(subfield_value, str):
+            has_str = True
+        elif isinstance(subfield_value, dict):
+            has_dict = True
+        else:
+            raise PromptFieldTypeError(_field_error_message(field_name=field_name))
+        part = _filled_out_part(value=subfield_value, field_name=field_name)
+        if part is not None:
+            filled_out[subfield_name] = part
+    if has_str and has_dict:
+        raise PromptFieldTypeError(_field_error_message(field_name=field_name))
+    if len(filled_out) == 0:
+        return None
+    if len(filled_out) == len(value) and all(
+        filled_out[k] is v for k, v in value.items()
+    ):
+        return value
+    return filled_out
+
+
+class _PromptParamsSchema:
+    """Field names of a PromptParams subclass, read once from
+    `dataclasses.fields`"""
+
+    def __init__(self, params_class: type["PromptParams"])->None:
+        self.field_names: tuple[PromptParamName, ...] = tuple(
+            f.name for f in fields(params_class)
+        )
+
+    def extract(
+        self,
+        prompt_params: "PromptParams",
+    )->tuple[dict[PromptParamName, PromptFieldValue], list[PromptParamName]]:
+        """Split fields into filled-out ones (without their empty subfields,)
+        and non-filled-out ones"""
+        filled_out = {}
+        non_filled_out = []
+        for field_name in self.field_names:
+            part = _filled_out_part(value=getattr(prompt_params, field_name),
+                                    field_name=field_name)
+            if part is None:
+                non_filled_out.append(field_name)
+            else:
+                filled_out[field_name] = part
+        return filled_out, non_filled_out
+
+
+_SCHEMAS: dict[type, _PromptParamsSchema] = {}
+
+
 @dataclass
 class PromptParams:
     """A generic dataclass for fromp parameters. 
@@ -37,75 +131,33 @@ class PromptParams:
         """Return non-optional fields that haven't been filled out.
 
         For dict fields, we need at least one element to be non-null."""
-        non_field_out = []
-        fields_names = self._get_fields_names()
-        for field_name in fields_names:
-            field_value = self._get_field_attribute(field_name=field_name)
-            if not self._field_is_filled_out(field_value=field_value,
-                                              field_name=field_name):
-                non_field_out.append(field_name)
-        return non_field_out
-
-    def get_filled_out_fields_subfields(self)->dict[PromptParamName, 
-        Union[str, dict[str, str], dict[str, dict[str, str]]]]:
-        """Return the dict of parameters, leaving out empty fields/subfields"""
-        # Drop the empty fields
-        filled_field_names = [n for n in self._get_fields_names() if n not in
-            self.non_filled_out_fields()]
-        output = {
-            n: deepcopy(self._get_field_attribute(field_name=n)) 
-            for n in filled_field_names
-        }
-        # Drop the empty subfields
-        for field_name, field_value in output.items():
-            if isinstance(field_value, dict):
-                subfields_to_drop = []
-                for subfield_name, subfield_value in field_value.items():
-                    if not self._field_is_filled_out(field_value=subfield_value, field_name=subfield_name):
-                        subfields_to_drop.append(subfield_name)
-                [field_value.pop(to_drop) for to_drop in subfields_to_drop]
-        return output
+        _, non_filled_out = self._get_schema().extract(prompt_params=self)
+        return non_filled_out
+
+    def get_filled_out_fields_subfields(self)->dict[PromptParamName, PromptFieldValue]:
+        """Return the dict of parameters, leaving out empty fields/subfields
+
+        Values are not copied: entirely filled-out dicts are the ones held by
+        self, and must not be modified."""
+        filled_out, _ = self._get_schema().extract(prompt_params=self)
+        return filled_out
+
+    @classmethod
+    def _get_schema(cls)->_PromptParamsSchema:
+        """Return the schema of the class, built on first call"""
+        schema = _SCHEMAS.get(cls)
+        if schema is None:
+            schema = _SCHEMAS[cls] = _PromptParamsSchema(params_class=cls)
+        return schema
 
     def _get_fields_names(self)->list[PromptParamName]:
         """Return all fields (class attributes)"""
-        return [f.name for f in fields(self)]
+        return list(self._get_schema().field_names)
 
-    def _get_field_attribute(self, field_name: str)->Union[str, dict[str, str], dict[str, dict[str, str]]]:
+    def _get_field_attribute(self, field_name: str)->PromptFieldValue:
         """Return value associated to a field"""
         return self.__getattribute__(field_name)
 
-    def _field_is_filled_out(self, field_value: str, field_name: str)->bool:
-        """Check if all fields are str or nested dict of str with at least one
-        non-null value"""
-        if isinstance(field_value, str):
-            return field_value != ""
-        elif isinstance(field_value, dict):
-            return self._is_nested_dict_nonempty_str(d=field_value,
-                                            field_name=field_value)
-        else:
-            raise PromptFieldTypeError(self._field_error_message(field_name=field_name))
-    
-    def _is_nested_dict_nonempty_str(self, d:dict, field_name: str)->bool:
-        """Is field a (nested or plain) dict of str, with some non-empty?"""
-        if len(d) == 0:
-            return False
-        elif all(isinstance(v, str) for v in d.values()):
-            if all(v == "" for v in d.values()):
-                return False
-        elif all(isinstance(v, dict) for v in d.values()):
-            for v in d.values():
-                self._is_nested_dict_nonempty_str(d=v, field_name=field_name)
-        else:
-            raise PromptFieldTypeError(self._field_error_message(field_name=field_name))
-        return True
-
-    @staticmethod
-    def _field_error_message(field_name: str)->str:
-        """Return error msg for field type errors"""
-        error_msg = "Field {field_name} is not str, dict[str, str] or dict[str, dict[str, str]]"
-        return error_msg.format(field_name=field_name)
-
-
 
 @dataclass
 class TCParams(PromptParams):
@@ -138,17 +190,583 @@ class TCSoundParams(PromptParams):
 # ======
 # OpenAI
 # ======
-# Set up API key
-openai.api_key = _API_KEY
+def get_retryable_errors()->tuple[type[Exception], ...]:
+    """Errors worth retrying (transient server-side or network issues)"""
+    import openai  # Slow to import: only when needed
+
+    return (
+        openai.error.RateLimitError,
+        openai.error.APIError,
+        openai.error.APIConnectionError,
+        openai.error.ServiceUnavailableError,
+        openai.error.Timeout,
+        openai.error.TryAgain,
+    )
+
+
+class GenerationTimeoutError(Exception):
+    """A generation call did not complete within its timeout"""
+    pass
+
+
+class GenerationBackendError(Exception):
+    """A generation backend is misconfigured"""
+    pass
 
 
-def generate_gpt4_simple(prompt: str)->str:
+def get_completion_cache()->CompletionCache:
+    """Process-wide completion cache, opened on first use"""
+    global _COMPLETION_CACHE
+    if _COMPLETION_CACHE is None:
+        _COMPLETION_CACHE = CompletionCache(path=COMPLETION_CACHE_PATH)
+    return _COMPLETION_CACHE
+
+
+# ========
+# Backends
+# ========
+class GenerationBackend:
+    """Where completions come from
+
+    Subclasses implement `create` and `acreate` with the arguments and return
+    values of openai.ChatCompletion.create and acreate (including `stream`.)
+    """
+    model: str = GPT4_MODEL
+
+    def cache_params(self)->dict[str, str]:
+        """Cache key parameters keeping this backend's completions apart"""
+        return {}
+
+    def create(self, **kwargs: Any)->Any:
+        raise NotImplementedError
+
+    async def acreate(self, **kwargs: Any)->Any:
+        raise NotImplementedError
+
+
+class OpenAIBackend(GenerationBackend):
+    """The OpenAI API, or an OpenAI-compatible server at `api_base` (e.g., a
+    local model, or mysensei.fake_llm)
+
+    Without `api_key`, the [open_ai] api_key setting is used.
+    """
+
+    def __init__(self, api_base: Optional[str]=None, api_key: Optional[str]=None,
+                 model: str=GPT4_MODEL)->None:
+        self.api_base = api_base
+        self.api_key = api_key
+        self.model = model
+
+    def cache_params(self)->dict[str, str]:
+        return {} if self.api_base is None else {"api_base": self.api_base}
+
+    def create(self, **kwargs: Any)->Any:
+        import openai
+
+        return openai.ChatCompletion.create(**self._connection_kwargs(), **kwargs)
+
+    async def acreate(self, **kwargs: Any)->Any:
+        import openai
+
+        return await openai.ChatCompletion.acreate(**self._connection_kwargs(), **kwargs)
+
+    def _connection_kwargs(self)->dict[str, str]:
+        """Per-request overrides of the module-level openai settings"""
+        kwargs = {}
+        if self.api_base is not None:
+            kwargs["api_base"] = self.api_base
+        api_key = self.api_key or get_settings().open_ai.api_key
+        if api_key is not None:
+            kwargs["api_key"] = api_key
+        return kwargs
+
+
+def backend_from_conf(conf: dict[str, Any])->GenerationBackend:
+    """Backend described by a [generation] configuration section
+
+    `backend` is "openai" (default), "openai_compatible" (requires `api_base`)
+    or "fake" (mysensei.fake_llm, at `api_base` or FAKE_LLM_API_BASE.)
+    """
+    kind = conf.get("backend", "openai")
+    model = conf.get("model", GPT4_MODEL)
+    api_base = conf.get("api_base") or None
+    if kind == "openai":
+        return OpenAIBackend(api_key=conf.get("api_key") or None, model=model)
+    elif kind == "openai_compatible":
+        if api_base is None:
+            raise GenerationBackendError("The openai_compatible backend requires api_base")
+        return OpenAIBackend(api_base=api_base, api_key=conf.get("api_key", "none"),
+                             model=model)
+    elif kind == "fake":
+        return OpenAIBackend(api_base=api_base or FAKE_LLM_API_BASE, api_key="fake",
+                             model=model)
+    raise GenerationBackendError(f"Unknown generation backend {kind}")
+
+
+def get_backend()->GenerationBackend:
+    """Backend of all generation calls (from the [generation] settings unless
+    set otherwise)"""
+    global _BACKEND
+    if _BACKEND is None:
+        _BACKEND = backend_from_conf(asdict(get_settings().generation))
+    return _BACKEND
+
+
+def set_backend(backend: GenerationBackend)->None:
+    """Send all generation calls to `backend`"""
+    global _BACKEND
+    _BACKEND = backend
+
+
+# =============
+# Rate limiting
+# =============
+def get_rate_limiter()->RateLimiter:
+    """Limiter of all generation calls of the process (from the [generation]
+    settings unless set otherwise), shared with the other workers if there is
+    a shared state ([server] shared_state_path)"""
+    global _RATE_LIMITER
+    if _RATE_LIMITER is None:
+        settings = get_settings()
+        quotas = {"requests_per_minute": settings.generation.requests_per_minute,
+                  "tokens_per_minute": settings.generation.tokens_per_minute}
+        if settings.server.shared_state_path is None or all(
+            q is None for q in quotas.values()
+        ):
+            _RATE_LIMITER = RateLimiter(**quotas)
+        else:
+            _RATE_LIMITER = SharedRateLimiter(path=settings.server.shared_state_path, **quotas)
+    return _RATE_LIMITER
+
+
+def set_rate_limiter(rate_limiter: RateLimiter)->None:
+    global _RATE_LIMITER
+    _RATE_LIMITER = rate_limiter
+
+
+def _estimate_request_tokens(prompt: str, n: int=1)->int:
+    """Tokens of a request, until its usage is known: the prompt, and `n`
+    completions of the expected length"""
+    return (estimate_n_tokens(prompt)
+            + n * get_settings().generation.expected_completion_tokens)
+
+
+async def _wait_for_rate_limit(n_tokens: int, timeout: float,
+                               labels: dict[str, str])->float:
+    """Wait until a request of `n_tokens` is allowed; return the wait. Raise
+    GenerationTimeoutError if that would take more than `timeout`."""
+    try:
+        wait_s = await get_rate_limiter().acquire(n_tokens=n_tokens, max_wait_s=timeout)
+    except RateLimitTimeoutError as e:
+        _REQUESTS.inc(outcome="rate_limited", **labels)
+        raise GenerationTimeoutError(str(e)) from e
+    _RATE_LIMIT_WAIT.observe(wait_s, **labels)
+    return wait_s
+
+
+def _used_tokens(completion: Any)->Optional[int]:
+    """Tokens used by a (non-streamed) completion, if reported"""
+    usage = completion.get("usage")
+    if usage is None:
+        return None
+    return usage["prompt_tokens"] + usage["completion_tokens"]
+
+
+def _correct_rate_limit(n_tokens_estimated: int, completion: Any)->None:
+    """Count the actual usage of a (non-streamed) completion against the
+    tokens/min quota"""
+    if (n_tokens := _used_tokens(completion)) is not None:
+        get_rate_limiter().correct(n_tokens_estimated=n_tokens_estimated, n_tokens=n_tokens)
+
+
+async def _acorrect_rate_limit(n_tokens_estimated: int, completion: Any)->None:
+    """Async counterpart of `_correct_rate_limit`"""
+    if (n_tokens := _used_tokens(completion)) is not None:
+        await get_rate_limiter().acorrect(n_tokens_estimated=n_tokens_estimated,
+                                          n_tokens=n_tokens)
+
+
+# ===============
+# Instrumentation
+# ===============
+_LABEL_NAMES = ("model", "template", "version")
+_REQUESTS = ms_metrics.get_registry().counter(
+    "mysensei_llm_requests_total",
+    "Generation calls, by outcome (success, cache_hit, coalesced, rate_limited,"
+    " error, timeout, cancelled)",
+    _LABEL_NAMES + ("outcome",),
+)
+_ERRORS = ms_metrics.get_registry().counter(
+    "mysensei_llm_errors_total", "Failed generation calls, by error type",
+    _LABEL_NAMES + ("error",),
+)
+_RETRIES = ms_metrics.get_registry().counter(
+    "mysensei_llm_retries_total", "Generation calls retried", _LABEL_NAMES,
+)
+_LATENCY = ms_metrics.get_registry().histogram(
+    "mysensei_llm_request_duration_seconds",
+    "Duration of generation calls to the model (cache hits excluded)", _LABEL_NAMES,
+)
+_RATE_LIMIT_WAIT = ms_metrics.get_registry().histogram(
+    "mysensei_llm_rate_limit_wait_seconds",
+    "Wait for the rate limit before generation calls", _LABEL_NAMES,
+)
+_TIME_TO_FIRST_TOKEN = ms_metrics.get_registry().histogram(
+    "mysensei_llm_time_to_first_token_seconds",
+    "Time to the first streamed token", _LABEL_NAMES,
+)
+_PROMPT_TOKENS = ms_metrics.get_registry().histogram(
+    "mysensei_llm_prompt_tokens", "Prompt tokens per call, as reported by the API",
+    _LABEL_NAMES, buckets=ms_metrics.TOKEN_BUCKETS,
+)
+_COMPLETION_TOKENS = ms_metrics.get_registry().histogram(
+    "mysensei_llm_completion_tokens",
+    "Completion tokens per call (streamed chunks, for streams)",
+    _LABEL_NAMES, buckets=ms_metrics.TOKEN_BUCKETS,
+)
+
+
+def _metric_labels(template_name: str, template_version: Optional[int])->dict[str, str]:
+    return {"model": get_backend().model, "template": template_name,
+            "version": "" if template_version is None else str(template_version)}
+
+
+@contextmanager
+def _observe_call(labels: dict[str, str])->Iterator[None]:
+    """Record the duration and outcome of the model call in the block"""
+    started_at = time.perf_counter()
+    outcome = "cancelled"
+    try:
+        yield
+    except (GenerationTimeoutError, asyncio.TimeoutError) as e:
+        outcome = "timeout"
+        _ERRORS.inc(error=type(e).__name__, **labels)
+        raise
+    except Exception as e:
+        outcome = "error"
+        _ERRORS.inc(error=type(e).__name__, **labels)
+        raise
+    else:
+        outcome = "success"
+    finally:
+        _LATENCY.observe(time.perf_counter() - started_at, **labels)
+        _REQUESTS.inc(outcome=outcome, **labels)
+
+
+def _observe_usage(completion: Any, labels: dict[str, str])->None:
+    """Record the token counts of a (non-streamed) completion"""
+    usage = completion.get("usage")
+    if usage is None:
+        return
+    _PROMPT_TOKENS.observe(usage["prompt_tokens"], **labels)
+    _COMPLETION_TOKENS.observe(usage["completion_tokens"], **labels)
+
+
+# ==========
+# Generation
+# ==========
+def generate_gpt4_simple(
+    prompt: str,
+    fresh: bool=False,
+    template_name: str="",
+    template_version: Optional[int]=None,
+)->str:
     """
     Straightforward prompt -> output generation with gpt4
+
+    Completions are cached; pass `fresh=True` to skip the cache lookup (the
+    new completion still replaces the cached one.) The template the prompt was
+    rendered from, if any, labels the call metrics.
     """
-    completion = openai.ChatCompletion.create(
-        model="gpt-4",
-        messages=[{"role": "user", "content": prompt},]
-    )
+    labels = _metric_labels(template_name=template_name, template_version=template_version)
+    backend = get_backend()
+    cache = get_completion_cache()
+    cache_key = cache.make_key(model=backend.model, prompt=prompt, **backend.cache_params())
+    if not fresh and (output := cache.get(cache_key)) is not None:
+        _REQUESTS.inc(outcome="cache_hit", **labels)
+        return output
+    n_tokens = _estimate_request_tokens(prompt)
+    _RATE_LIMIT_WAIT.observe(get_rate_limiter().acquire_blocking(n_tokens=n_tokens),
+                             **labels)
+    with _observe_call(labels=labels):
+        completion = backend.create(
+            model=backend.model,
+            messages=[{"role": "user", "content": prompt},]
+        )
+    _observe_usage(completion=completion, labels=labels)
+    _correct_rate_limit(n_tokens_estimated=n_tokens, completion=completion)
     output = completion.choices[0].message.content
+    cache.set(cache_key, output)
     return output
+
+
+async def agenerate_gpt4_simple(
+    prompt: str,
+    timeout: float=DEFAULT_TIMEOUT_S,
+    fresh: bool=False,
+    template_name: str="",
+    template_version: Optional[int]=None,
+)->str:
+    """
+    Non-blocking counterpart of `generate_gpt4_simple`
+
+    Raise GenerationTimeoutError if no completion is received after `timeout`
+    seconds (rate limit wait included.) Concurrent calls for the same prompt
+    share a single request (and its timeout); cancelling all the awaiting
+    tasks aborts it.
+    """
+    labels = _metric_labels(template_name=template_name, template_version=template_version)
+    backend = get_backend()
+    cache = get_completion_cache()
+    cache_key = cache.make_key(model=backend.model, prompt=prompt, **backend.cache_params())
+    if not fresh and (output := await cache.aget(cache_key)) is not None:
+        _REQUESTS.inc(outcome="cache_hit", **labels)
+        return output
+    if _SINGLE_FLIGHT.is_in_flight(cache_key):
+        _REQUESTS.inc(outcome="coalesced", **labels)
+
+    async def generate()->str:
+        n_tokens = _estimate_request_tokens(prompt)
+        remaining_s = timeout - await _wait_for_rate_limit(n_tokens=n_tokens,
+                                                           timeout=timeout, labels=labels)
+        with _observe_call(labels=labels):
+            try:
+                completion = await asyncio.wait_for(
+                    backend.acreate(
+                        model=backend.model,
+                        messages=[{"role": "user", "content": prompt},],
+                        request_timeout=remaining_s,
+                    ),
+                    timeout=remaining_s,
+                )
+            except asyncio.TimeoutError as e:
+                raise GenerationTimeoutError(
+                    f"No completion received after {timeout}s"
+                ) from e
+        _observe_usage(completion=completion, labels=labels)
+        await _acorrect_rate_limit(n_tokens_estimated=n_tokens, completion=completion)
+        output = completion.choices[0].message.content
+        await cache.aset(cache_key, output)
+        return output
+
+    return await _SINGLE_FLIGHT.run(key=cache_key, func=generate)
+
+
+async def agenerate_with_retries(
+    prompt: str,
+    timeout: float=DEFAULT_TIMEOUT_S,
+    fresh: bool=False,
+    max_retries: int=5,
+    base_delay_s: float=1.,
+    max_delay_s: float=60.,
+    template_name: str="",
+    template_version: Optional[int]=None,
+)->str:
+    """
+    `agenerate_gpt4_simple`, retried on transient errors and timeouts
+
+    Wait between attempts grows exponentially from `base_delay_s` (capped at
+    `max_delay_s`), with full jitter so that concurrent callers do not retry
+    in lockstep. The last error is raised once `max_retries` is exhausted.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return await agenerate_gpt4_simple(prompt=prompt, timeout=timeout,
+                                               fresh=fresh, template_name=template_name,
+                                               template_version=template_version)
+        except (GenerationTimeoutError, *get_retryable_errors()):
+            if attempt == max_retries:
+                raise
+            _RETRIES.inc(**_metric_labels(template_name=template_name,
+                                          template_version=template_version))
+            delay = min(max_delay_s, base_delay_s * 2 ** attempt)
+            await asyncio.sleep(random.uniform(0, delay))
+
+
+async def agenerate_gpt4_candidates(
+    prompt: str,
+    n: int,
+    timeout: float=DEFAULT_TIMEOUT_S,
+    fresh: bool=False,
+    template_name: str="",
+    template_version: Optional[int]=None,
+)->list[str]:
+    """
+    `n` alternative completions of `prompt`, from a single request
+
+    The prompt is billed once, and all candidates arrive after one wait. The
+    candidates are cached together (so that a cached set is only reused for
+    the same `n`.) Concurrent identical calls share a single request.
+    """
+    labels = _metric_labels(template_name=template_name, template_version=template_version)
+    backend = get_backend()
+    cache = get_completion_cache()
+    cache_key = cache.make_key(model=backend.model, prompt=prompt, n=n,
+                               **backend.cache_params())
+    if not fresh and (output := await cache.aget(cache_key)) is not None:
+        _REQUESTS.inc(outcome="cache_hit", **labels)
+        return json.loads(output)
+    if _SINGLE_FLIGHT.is_in_flight(cache_key):
+        _REQUESTS.inc(outcome="coalesced", **labels)
+
+    async def generate()->list[str]:
+        n_tokens = _estimate_request_tokens(prompt, n=n)
+        remaining_s = timeout - await _wait_for_rate_limit(n_tokens=n_tokens,
+                                                           timeout=timeout, labels=labels)
+        with _observe_call(labels=labels):
+            try:
+                completion = await asyncio.wait_for(
+                    backend.acreate(
+                        model=backend.model,
+                        messages=[{"role": "user", "content": prompt},],
+                        n=n,
+                        request_timeout=remaining_s,
+                    ),
+                    timeout=remaining_s,
+                )
+            except asyncio.TimeoutError as e:
+                raise GenerationTimeoutError(
+                    f"No completion received after {timeout}s"
+                ) from e
+        _observe_usage(completion=completion, labels=labels)
+        await _acorrect_rate_limit(n_tokens_estimated=n_tokens, completion=completion)
+        choices = sorted(completion.choices, key=lambda c: c.index)
+        outputs = [c.message.content for c in choices]
+        await cache.aset(cache_key, json.dumps(outputs, ensure_ascii=False))
+        return outputs
+
+    # Callers get their own list
+    return list(await _SINGLE_FLIGHT.run(key=cache_key, func=generate))
+
+
+async def agenerate_many(
+    prompts: list[str],
+    timeout: float=DEFAULT_TIMEOUT_S,
+    fresh: bool=False,
+    max_retries: int=5,
+    max_concurrency: int=8,
+    template_name: str="",
+    template_version: Optional[int]=None,
+)->list[str]:
+    """
+    Completions of `prompts` (in the same order), requested concurrently
+
+    At most `max_concurrency` requests are in flight at once. Each request is
+    retried as in `agenerate_with_retries`; the first error that survives its
+    retries is raised once all requests are done.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def generate(prompt: str)->str:
+        async with semaphore:
+            return await agenerate_with_retries(prompt=prompt, timeout=timeout,
+                                                fresh=fresh, max_retries=max_retries,
+                                                template_name=template_name,
+                                                template_version=template_version)
+
+    outputs = await asyncio.gather(*[generate(p) for p in prompts],
+                                   return_exceptions=True)
+    for output in outputs:
+        if isinstance(output, BaseException):
+            raise output
+    return outputs
+
+
+@dataclass
+class StreamStats:
+    """Timings of a streamed generation, in seconds since `started_at`"""
+    started_at: float = field(default_factory=time.perf_counter)
+    time_to_first_token: Optional[float] = None
+    total_time: Optional[float] = None
+
+
+async def astream_gpt4_simple(
+    prompt: str,
+    timeout: float=DEFAULT_TIMEOUT_S,
+    stats: Optional[StreamStats]=None,
+    fresh: bool=False,
+    template_name: str="",
+    template_version: Optional[int]=None,
+)->AsyncIterator[str]:
+    """
+    Streaming counterpart of `agenerate_gpt4_simple`, yielding text deltas
+
+    `timeout` bounds the whole stream, not each delta. If `stats` is passed,
+    it is filled out with the time-to-first-token and total time. A cached
+    completion is yielded as a single delta. Concurrent streams of the same
+    prompt share a single request: later ones start with the deltas received
+    so far.
+    """
+    if stats is None:
+        stats = StreamStats()
+    labels = _metric_labels(template_name=template_name, template_version=template_version)
+    backend = get_backend()
+    cache = get_completion_cache()
+    cache_key = cache.make_key(model=backend.model, prompt=prompt, **backend.cache_params())
+    if not fresh and (output := await cache.aget(cache_key)) is not None:
+        _REQUESTS.inc(outcome="cache_hit", **labels)
+        stats.time_to_first_token = time.perf_counter() - stats.started_at
+        yield output
+        stats.total_time = time.perf_counter() - stats.started_at
+        return
+    if _SINGLE_FLIGHT.is_in_flight(cache_key):
+        _REQUESTS.inc(outcome="coalesced", **labels)
+    deltas = _SINGLE_FLIGHT.stream(key=cache_key, func=lambda: _astream_completion(
+        prompt=prompt, deadline=stats.started_at + timeout, timeout=timeout,
+        cache_key=cache_key, labels=labels,
+    ))
+    async for delta in deltas:
+        if stats.time_to_first_token is None:
+            stats.time_to_first_token = time.perf_counter() - stats.started_at
+        yield delta
+    stats.total_time = time.perf_counter() - stats.started_at
+
+
+async def _astream_completion(prompt: str, deadline: float, timeout: float,
+                              cache_key: str, labels: dict[str, str])->AsyncIterator[str]:
+    """Deltas of a completion streamed from the backend, which is then cached
+    under `cache_key`"""
+    backend = get_backend()
+    started_at = time.perf_counter()
+    n_tokens = _estimate_request_tokens(prompt)
+    await _wait_for_rate_limit(n_tokens=n_tokens, timeout=deadline - started_at,
+                               labels=labels)
+    deltas = []
+    with _observe_call(labels=labels):
+        try:
+            response = await asyncio.wait_for(
+                backend.acreate(
+                    model=backend.model,
+                    messages=[{"role": "user", "content": prompt},],
+                    request_timeout=deadline - time.perf_counter(),
+                    stream=True,
+                ),
+                timeout=deadline - time.perf_counter(),
+            )
+            chunks = response.__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(
+                        chunks.__anext__(),
+                        timeout=deadline - time.perf_counter(),
+                    )
+                except StopAsyncIteration:
+                    break
+                delta = chunk["choices"][0]["delta"].get("content")
+                if not delta:
+                    continue
+                if len(deltas) == 0:
+                    _TIME_TO_FIRST_TOKEN.observe(time.perf_counter() - started_at, **labels)
+                deltas.append(delta)
+                yield delta
+        except asyncio.TimeoutError as e:
+            raise GenerationTimeoutError(
+                f"Completion not fully received after {timeout}s"
+            ) from e
+    # Each streamed chunk holds one token
+    _COMPLETION_TOKENS.observe(len(deltas), **labels)
+    await get_rate_limiter().acorrect(
+        n_tokens_estimated=get_settings().generation.expected_completion_tokens,
+        n_tokens=len(deltas),
+    )
+    await get_completion_cache().aset(cache_key, "".join(deltas))
@@ -0,0 +1,291 @@
+"""
+Bulk import of vocabulary notes and reading associations
+
+Rows are streamed from CSV and TSV files (Anki plain-text exports included)
+and from Anki collections (.anki2/.anki21 SQLite files, or .apkg/.colpkg
+packages), so that files are never loaded whole. Each row is normalised into
+a vocabulary note (lemma, reading, meanings) and/or a reading association
+(sound, concept, descriptor), depending on its fields. Rows are written
+`chunk_size` at a time, with one transaction per chunk: notes whose lemma the
+user already has are skipped, reading associations are upserted (see
+mysensei.repository.)
+
+Example:
+    python -m mysensei.importer deck.tsv --user-id 1 --chunk-size 5000
+
+Field names are matched case-insensitively against FIELD_ALIASES (e.g., the
+`Expression` field of Anki notes is the lemma.) Files without a header line
+need `--columns`.
+"""
+import argparse
+import csv
+import html
+import itertools
+import json
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import unicodedata
+import zipfile
+from dataclasses import dataclass
+from typing import Callable, Iterable, Iterator, Optional
+
+from mysensei.repository import (ReadingAssociation, ReadingAssociationsRepository,
+    VocabNote, VocabNotesRepository, get_engine, init_db)
+
+# Names under which each field may appear in the imported files
+FIELD_ALIASES = {
+    "lemma": ("lemma", "word", "expression", "vocab", "vocabulary", "kanji", "front"),
+    "reading": ("reading", "kana", "furigana", "pronunciation"),
+    "meanings": ("meanings", "meaning", "english", "definition", "glossary", "back"),
+    "count": ("count", "frequency", "freq"),
+    "sound": ("sound",),
+    "concept": ("concept",),
+    "descriptor": ("descriptor", "details"),
+}
+_FIELD_NAMES = {alias: name for name, aliases in FIELD_ALIASES.items() for alias in aliases}
+# Separators of the meanings within a field
+_MEANINGS_SEPARATORS = re.compile(r"[;,、；]")
+_HTML_LINE_BREAKS = re.compile(r"<br\s*/?>|</div>", re.IGNORECASE)
+_HTML_TAGS = re.compile(r"<[^>]*>")
+# Separators of Anki plain-text exports (#separator:<name> header)
+_ANKI_SEPARATORS = {"tab": "\t", "comma": ",", "semicolon": ";", "space": " ",
+                    "pipe": "|", "colon": ":"}
+# Collections in Anki packages, by preference
+_ANKI_COLLECTIONS = ("collection.anki21", "collection.anki2")
+_ANKI_FIELD_SEPARATOR = "\x1f"
+DEFAULT_CHUNK_SIZE = 2000
+
+
+class VocabImportError(Exception):
+    """A file cannot be imported"""
+    pass
+
+
+# ======
+# Input
+# ======
+def read_delimited(path: str, columns: Optional[list[str]]=None)->Iterator[dict[str, str]]:
+    """Lazily yield the rows of a .csv, .tsv or .txt (tab-separated) file
+
+    Anki headers (`#separator:...`, `#columns:...` lines) are honoured. The
+    first line is the header, unless `columns` are given.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    delimiter = "," if extension == ".csv" else "\t"
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        lines = iter(f)
+        first_line = next(lines, "")
+        while first_line.startswith("#"):
+            key, _, value = first_line[1:].rstrip("\r\n").partition(":")
+            if key == "separator":
+                delimiter = _ANKI_SEPARATORS.get(value, value)
+            elif key == "columns" and columns is None:
+                columns = next(csv.reader([value], delimiter=delimiter))
+            first_line = next(lines, "")
+        reader = csv.reader(itertools.chain([first_line], lines), delimiter=delimiter)
+        if columns is None:
+            columns = next(reader, [])
+        for values in reader:
+            if len(values) > 0:
+                yield dict(zip(columns, values))
+
+
+def _anki_field_names(connection: sqlite3.Connection)->dict[int, list[str]]:
+    """Field names of each note type, by note type id"""
+    has_fields_table = connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'fields'"
+    ).fetchone() is not None
+    field_names: dict[int, list[str]] = {}
+    if has_fields_table:  # Schema of Anki >= 2.1.28
+        for note_type_id, _, name in connection.execute(
+            "SELECT ntid, ord, name FROM fields ORDER BY ntid, ord"
+        ):
+            field_names.setdefault(note_type_id, []).append(name)
+    else:
+        (models,) = connection.execute("SELECT models FROM col").fetchone()
+        for note_type_id, model in json.loads(models).items():
+            field_names[int(note_type_id)] = [
+                f["name"] for f in sorted(model["flds"], key=lambda f: f["ord"])
+            ]
+    return field_names
+
+
+def read_anki_collection(path: str)->Iterator[dict[str, str]]:
+    """Lazily yield the notes of an Anki collection (SQLite file), by field
+    name"""
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        field_names = _anki_field_names(connection)
+        for note_type_id, fields in connection.execute("SELECT mid, flds FROM notes"):
+            yield dict(zip(field_names.get(note_type_id, []),
+                           fields.split(_ANKI_FIELD_SEPARATOR)))
+    except sqlite3.DatabaseError as e:
+        raise VocabImportError(f"{path} is not an Anki collection: {e}") from e
+    finally:
+        connection.close()
+
+
+def read_anki_package(path: str)->Iterator[dict[str, str]]:
+    """Lazily yield the notes of an .apkg/.colpkg package (its collection is
+    extracted to a temporary file)"""
+    with zipfile.ZipFile(path) as package:
+        names = set(package.namelist())
+        name = next((n for n in _ANKI_COLLECTIONS if n in names), None)
+        if name is None:
+            raise VocabImportError(
+                f"No collection in {path} (packages of recent Anki versions need the"
+                " 'Support older Anki versions' export option)"
+            )
+        with tempfile.TemporaryDirectory() as dirpath:
+            collection_path = os.path.join(dirpath, name)
+            with package.open(name) as source, open(collection_path, "wb") as target:
+                shutil.copyfileobj(source, target)
+            yield from read_anki_collection(collection_path)
+
+
+def read_file(path: str, columns: Optional[list[str]]=None)->Iterator[dict[str, str]]:
+    """Lazily yield the rows of `path`, whatever its format"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".csv", ".tsv", ".txt"):
+        return read_delimited(path, columns=columns)
+    if extension in (".anki2", ".anki21"):
+        return read_anki_collection(path)
+    if extension in (".apkg", ".colpkg"):
+        return read_anki_package(path)
+    raise VocabImportError(f"Unsupported input format: {extension}")
+
+
+# =============
+# Normalisation
+# =============
+def clean_value(value: str)->str:
+    """Text of a field: without HTML, NFKC-normalised (e.g., half-width kana
+    to full-width), on a single line"""
+    if "<" in value or "&" in value:
+        value = html.unescape(_HTML_TAGS.sub("", _HTML_LINE_BREAKS.sub(" ", value)))
+    return " ".join(unicodedata.normalize("NFKC", value).split())
+
+
+def normalize_row(row: dict[str, str])->tuple[Optional[VocabNote], Optional[ReadingAssociation]]:
+    """The note (if the row has a lemma) and reading association (if it has
+    a sound and concept) of a row"""
+    fields = {}
+    for key, value in row.items():
+        name = _FIELD_NAMES.get((key or "").strip().lower())
+        if name is not None and name not in fields and value is not None:
+            fields[name] = clean_value(value)
+    note = None
+    if fields.get("lemma", "") != "":
+        count = fields.get("count", "")
+        note = VocabNote(
+            lemma=fields["lemma"],
+            reading=fields.get("reading", ""),
+            meanings=tuple(m.strip() for m in _MEANINGS_SEPARATORS.split(fields.get("meanings", ""))
+                           if m.strip() != ""),
+            count=int(count) if count.isdigit() else None,
+        )
+    association = None
+    if fields.get("sound", "") != "" and fields.get("concept", "") != "":
+        association = ReadingAssociation(sound=fields["sound"], concept=fields["concept"],
+                                         descriptor=fields.get("descriptor", ""))
+    return note, association
+
+
+# ======
+# Import
+# ======
+@dataclass
+class ImportReport:
+    """Progress of an import"""
+    n_rows: int = 0
+    n_notes: int = 0  # Inserted
+    n_duplicate_notes: int = 0  # Lemma already imported, or repeated
+    n_associations: int = 0  # Upserted
+    n_skipped: int = 0  # Rows with neither a note nor an association
+    elapsed_s: float = 0.
+
+
+def _chunks(rows: Iterable[dict[str, str]], chunk_size: int)->Iterator[list[dict[str, str]]]:
+    iterator = iter(rows)
+    while len(chunk := list(itertools.islice(iterator, chunk_size))) > 0:
+        yield chunk
+
+
+def import_rows(
+    rows: Iterable[dict[str, str]],
+    user_id: int,
+    notes_repository: VocabNotesRepository,
+    associations_repository: ReadingAssociationsRepository,
+    chunk_size: int=DEFAULT_CHUNK_SIZE,
+    on_progress: Optional[Callable[[ImportReport], None]]=None,
+)->ImportReport:
+    """Import `rows` for `user_id`, `chunk_size` at a time (one transaction
+    each, so both repositories must share an engine), calling `on_progress`
+    after each chunk"""
+    report = ImportReport()
+    started_at = time.perf_counter()
+    for chunk in _chunks(rows, chunk_size=chunk_size):
+        notes = []
+        associations = []
+        for row in chunk:
+            note, association = normalize_row(row)
+            if note is not None:
+                notes.append(note)
+            if association is not None:
+                associations.append(association)
+            report.n_skipped += note is None and association is None
+        with notes_repository.sessionmaker.begin() as session:
+            n_inserted = notes_repository.insert_new(user_id=user_id, notes=notes,
+                                                     session=session)
+            if len(associations) > 0:
+                report.n_associations += associations_repository.upsert(
+                    user_id=user_id, associations=associations, session=session
+                )
+        report.n_rows += len(chunk)
+        report.n_notes += n_inserted
+        report.n_duplicate_notes += len(notes) - n_inserted
+        report.elapsed_s = time.perf_counter() - started_at
+        if on_progress is not None:
+            on_progress(report)
+    return report
+
+
+def _print_progress(report: ImportReport)->None:
+    print(f"{report.n_rows} rows: {report.n_notes} notes imported,"
+          f" {report.n_duplicate_notes} duplicates, {report.n_associations} reading"
+          f" associations, {report.n_skipped} skipped ({report.elapsed_s:.1f}s)",
+          file=sys.stderr)
+
+
+def main(argv: Optional[list[str]]=None)->None:
+    """Command-line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("input_path",
+                        help=".csv, .tsv, .txt (Anki notes export), .anki2, .anki21, .apkg"
+                             " or .colpkg file")
+    parser.add_argument("--user-id", type=int, required=True)
+    parser.add_argument("--columns", help="Comma-separated field names, for files"
+                                          " without header line")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="Rows written per transaction")
+    args = parser.parse_args(argv)
+    engine = get_engine()
+    init_db(engine)
+    import_rows(
+        rows=read_file(args.input_path,
+                       columns=None if args.columns is None else args.columns.split(",")),
+        user_id=args.user_id,
+        notes_repository=VocabNotesRepository(engine=engine),
+        associations_repository=ReadingAssociationsRepository(engine=engine),
+        chunk_size=args.chunk_size,
+        on_progress=_print_progress,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,8 @@
 import mysensei
 import os
 import tomllib
-from jinja2 import Template, Environment, FileSystemLoader
+from typing import Optional
+from jinja2 import Template, Environment, FileSystemLoader, FileSystemBytecodeCache
 
 def get_lib_path() -> str:
     """Path to current library"""
@@ -12,7 +13,9 @@ def get_lib_path() -> str:
 
 
 def get_config_path() -> str:
-    """Path to conf folder"""
+    """Path to conf folder ($MYSENSEI_CONFIG_PATH if set, e.g. for test setups)"""
+    if (path := os.environ.get("MYSENSEI_CONFIG_PATH")) is not None:
+        return path
     return os.path.join(
         get_lib_path(),
         "config",
@@ -34,12 +37,80 @@ def _get_template_dirpath() -> str:
         "templates",
     )
 
-_TEMPLATE_LOADER = FileSystemLoader(_get_template_dirpath())
+def _get_template_bytecode_cache_dirpath() -> str:
+    """Get path to the folder of compiled templates"""
+    return os.path.join(
+        get_lib_path(),
+        "cache",
+        "jinja",
+    )
+
+
+class TemplateRegistry:
+    """Process-wide store of compiled templates
+
+    Templates live in `<template_dirpath>/<name>/<version>.jinja`. Each of
+    them is compiled once, with the bytecode cached on disk so that restarts
+    skip compilation too, and recompiled only if its file has been modified
+    since.
+    """
+
+    def __init__(self, template_dirpath: str, bytecode_cache_dirpath: str) -> None:
+        self.template_dirpath = template_dirpath
+        os.makedirs(bytecode_cache_dirpath, exist_ok=True)
+        self.environment = Environment(
+            loader=FileSystemLoader(template_dirpath),
+            bytecode_cache=FileSystemBytecodeCache(bytecode_cache_dirpath),
+            auto_reload=True,  # Reload based on mtime
+            cache_size=-1,  # Never drop compiled templates
+        )
+
+    def discover(self) -> None:
+        """Compile every available template"""
+        for template_name in self.list_templates():
+            for version in self.list_versions(template_name=template_name):
+                self.get(template_name=template_name, version=version)
+
+    def list_templates(self) -> list[str]:
+        """Names of the available templates"""
+        return sorted(
+            name for name in os.listdir(self.template_dirpath)
+            if len(self.list_versions(template_name=name)) > 0
+        )
+
+    def list_versions(self, template_name: str) -> list[int]:
+        """Available versions of `template_name`, in increasing order"""
+        dirpath = os.path.join(self.template_dirpath, template_name)
+        if not os.path.isdir(dirpath):
+            return []
+        return sorted(
+            int(stem) for stem, extension in map(os.path.splitext, os.listdir(dirpath))
+            if extension == ".jinja" and stem.isdigit()
+        )
+
+    def get(self, template_name: str, version: int) -> Template:
+        """Get the compiled template, recompiling it if its file changed"""
+        filename = template_name + "/" + str(version) + ".jinja"  # /" is the path
+            # separator for jinja, even on Windows
+        return self.environment.get_template(filename)
+
+
+_TEMPLATE_REGISTRY: Optional[TemplateRegistry] = None
+
+
+def get_template_registry() -> TemplateRegistry:
+    """Get the process-wide template registry, compiling all templates on
+    first call"""
+    global _TEMPLATE_REGISTRY
+    if _TEMPLATE_REGISTRY is None:
+        _TEMPLATE_REGISTRY = TemplateRegistry(
+            template_dirpath=_get_template_dirpath(),
+            bytecode_cache_dirpath=_get_template_bytecode_cache_dirpath(),
+        )
+        _TEMPLATE_REGISTRY.discover()
+    return _TEMPLATE_REGISTRY
+
 
 def get_jinja_template(template_name: str, version: int) -> Template:
-    """Get templates/`filename`"""
-    template_environment = Environment(loader=_TEMPLATE_LOADER)
-    filename = template_name + "/" + str(version) + ".jinja"  # /" is the path 
-        # separator for jinja, even on Windows
-    template = template_environment.get_template(filename)
-    return template
+    """Get templates/`template_name`/`version`.jinja"""
+    return get_template_registry().get(template_name=template_name, version=version)
@@ -0,0 +1,654 @@
+"""
+Durable queue of generation jobs
+
+A job is a rendered prompt, with the prompt parameters it was rendered from
+and the session that asked for it. Jobs are stored in a local SQLite file, so
+that they survive restarts and can be shared by several processes (see
+mysensei.launcher): each process running a JobQueue with workers claims jobs
+under a lease, and a job whose worker died is taken over once its lease
+expires.
+
+Failed attempts (transient errors and timeouts) are retried with exponential
+backoff, up to `max_attempts`; the last error and the number of attempts stay
+visible on the job. Jobs that fail for good are dead-lettered: kept with their
+error, until retried by hand:
+    python -m mysensei.jobs list --status dead
+    python -m mysensei.jobs retry <job id>
+
+Results are pushed to the waiting session (`JobQueue.wait`), or polled from
+`GET /api/jobs/{job_id}`. Results of sessions that left are delivered when
+they come back (`JobStore.undelivered`.) Workers can also run in dedicated
+processes:
+    python -m mysensei.jobs work --workers 8
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import signal
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from typing import TYPE_CHECKING, Any, Callable, Literal, Optional
+
+import mysensei.io as ms_io
+import mysensei.metrics as ms_metrics
+from mysensei.annotations import GeneratedText, Prompt
+from mysensei.generation import (DEFAULT_TIMEOUT_S, GenerationTimeoutError, PromptParams,
+    TCParams, TCRevisionParams, TCSoundParams, agenerate_gpt4_candidates,
+    agenerate_gpt4_simple, get_retryable_errors)
+from mysensei.ratelimit import RateLimitTimeoutError
+from mysensei.settings import get_settings
+
+if TYPE_CHECKING:
+    from fastapi import FastAPI
+    from nicegui.app import App
+
+JOBS_FILENAME = "jobs.sqlite"
+JobStatus = Literal["queued", "running", "done", "dead"]
+TERMINAL_STATUSES = ("done", "dead")
+# Prompt parameters that jobs can hold, by class name
+PROMPT_PARAMS_CLASSES: dict[str, type[PromptParams]] = {
+    c.__name__: c for c in (TCParams, TCRevisionParams, TCSoundParams)
+}
+MAX_RETRY_DELAY_S = 60.
+
+logger = logging.getLogger(__name__)
+_JOBS = ms_metrics.get_registry().counter(
+    "mysensei_generation_jobs_total",
+    "Generation job events (enqueued, done, retried, dead)",
+    label_names=("event",),
+)
+_JOB_WAIT = ms_metrics.get_registry().histogram(
+    "mysensei_generation_job_wait_seconds",
+    "Time from enqueuing to first claim of the generation jobs",
+)
+
+
+class UnknownJobError(Exception):
+    """No job has this id"""
+    pass
+
+
+def get_default_jobs_path()->str:
+    """The [jobs] path, or the state shared by the workers, or a local file"""
+    settings = get_settings()
+    if settings.jobs.path is not None:
+        return settings.jobs.path
+    if settings.server.shared_state_path is not None:
+        return settings.server.shared_state_path
+    return os.path.join(ms_io.get_lib_path(), "cache", JOBS_FILENAME)
+
+
+# ====
+# Jobs
+# ====
+def _params_to_json(prompt_params: list[PromptParams])->str:
+    return json.dumps([{"class": type(p).__name__, "fields": asdict(p)} for p in prompt_params],
+                      ensure_ascii=False)
+
+
+def _params_from_json(s: str)->list[PromptParams]:
+    return [PROMPT_PARAMS_CLASSES[p["class"]](**p["fields"]) for p in json.loads(s)]
+
+
+@dataclass(frozen=True)
+class Job:
+    """A generation job, as stored"""
+    job_id: str
+    session_id: str
+    prompt: Prompt
+    prompt_params: list[PromptParams]
+    template_name: str = ""
+    template_version: Optional[int] = None
+    n: int = 1  # Candidates
+    fresh: bool = False  # Skip the completion cache
+    status: JobStatus = "queued"
+    n_attempts: int = 0
+    max_attempts: int = 3
+    outputs: list[GeneratedText] = field(default_factory=list)
+    error: Optional[str] = None  # Of the last attempt
+    created_at: float = 0.
+    updated_at: float = 0.
+
+    def to_dict(self)->dict[str, Any]:
+        """What clients see of the job"""
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "n_attempts": self.n_attempts,
+            "max_attempts": self.max_attempts,
+            "outputs": self.outputs,
+            "error": self.error,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+
+_COLUMNS = ("job_id, session_id, prompt, prompt_params, template_name, template_version, n,"
+            " fresh, status, n_attempts, max_attempts, outputs, error, created_at, updated_at")
+
+
+def _job_from_row(row: tuple)->Job:
+    (job_id, session_id, prompt, prompt_params, template_name, template_version, n, fresh,
+     status, n_attempts, max_attempts, outputs, error, created_at, updated_at) = row
+    return Job(job_id=job_id, session_id=session_id, prompt=prompt,
+               prompt_params=_params_from_json(prompt_params), template_name=template_name,
+               template_version=template_version, n=n, fresh=bool(fresh), status=status,
+               n_attempts=n_attempts, max_attempts=max_attempts,
+               outputs=[] if outputs is None else json.loads(outputs), error=error,
+               created_at=created_at, updated_at=updated_at)
+
+
+# =====
+# Store
+# =====
+class JobStore:
+    """SQLite store of the generation jobs, shared by the processes using the
+    same file"""
+
+    def __init__(self, path: str)->None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False,
+                                           isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA busy_timeout=30000")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS generation_jobs ("
+            " job_id TEXT PRIMARY KEY,"
+            " session_id TEXT NOT NULL,"
+            " prompt TEXT NOT NULL,"
+            " prompt_params TEXT NOT NULL,"
+            " template_name TEXT NOT NULL,"
+            " template_version INTEGER,"
+            " n INTEGER NOT NULL,"
+            " fresh INTEGER NOT NULL,"
+            " status TEXT NOT NULL,"
+            " n_attempts INTEGER NOT NULL,"
+            " max_attempts INTEGER NOT NULL,"
+            " outputs TEXT,"
+            " error TEXT,"
+            " created_at REAL NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            # Queued jobs: not before; running jobs: lease expiry
+            " available_at REAL NOT NULL,"
+            " worker_id TEXT,"
+            " delivered INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS generation_jobs_status"
+            " ON generation_jobs (status, available_at)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS generation_jobs_session"
+            " ON generation_jobs (session_id, status)"
+        )
+
+    def add(self, session_id: str, prompt: Prompt, prompt_params: list[PromptParams],
+            template_name: str="", template_version: Optional[int]=None, n: int=1,
+            fresh: bool=False, max_attempts: int=3)->Job:
+        """Queue a new job"""
+        now = time.time()
+        job = Job(job_id=uuid.uuid4().hex, session_id=session_id, prompt=prompt,
+                  prompt_params=prompt_params, template_name=template_name,
+                  template_version=template_version, n=n, fresh=fresh,
+                  max_attempts=max_attempts, created_at=now, updated_at=now)
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO generation_jobs VALUES"
+                " (?, ?, ?, ?, ?, ?, ?, ?, 'queued', 0, ?, NULL, NULL, ?, ?, ?, NULL, 0)",
+                (job.job_id, session_id, prompt, _params_to_json(prompt_params), template_name,
+                 template_version, n, fresh, max_attempts, now, now, now),
+            )
+        return job
+
+    def get(self, job_id: str)->Job:
+        with self._lock:
+            row = self._connection.execute(
+                f"SELECT {_COLUMNS} FROM generation_jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            raise UnknownJobError(job_id)
+        return _job_from_row(row)
+
+    def claim(self, worker_id: str, lease_s: float)->Optional[Job]:
+        """The next job due (queued, or whose lease expired), now running
+        under `worker_id` for `lease_s` seconds; None if there is none
+
+        A job whose lease expired after its last attempt is dead-lettered.
+        """
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                while True:
+                    now = time.time()
+                    row = self._connection.execute(
+                        "SELECT job_id, status, n_attempts, max_attempts FROM generation_jobs"
+                        " WHERE status IN ('queued', 'running') AND available_at <= ?"
+                        " ORDER BY available_at LIMIT 1",
+                        (now,),
+                    ).fetchone()
+                    if row is None:
+                        self._connection.execute("COMMIT")
+                        return None
+                    job_id, status, n_attempts, max_attempts = row
+                    if status == "running" and n_attempts >= max_attempts:
+                        self._connection.execute(
+                            "UPDATE generation_jobs SET status = 'dead', updated_at = ?,"
+                            " error = 'Worker lost' WHERE job_id = ?",
+                            (now, job_id),
+                        )
+                        _JOBS.inc(event="dead")
+                        continue
+                    self._connection.execute(
+                        "UPDATE generation_jobs SET status = 'running',"
+                        " n_attempts = n_attempts + 1, worker_id = ?, available_at = ?,"
+                        " updated_at = ? WHERE job_id = ?",
+                        (worker_id, now + lease_s, now, job_id),
+                    )
+                    job = _job_from_row(self._connection.execute(
+                        f"SELECT {_COLUMNS} FROM generation_jobs WHERE job_id = ?", (job_id,)
+                    ).fetchone())
+                    self._connection.execute("COMMIT")
+                    return job
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+
+    def complete(self, job_id: str, worker_id: str, outputs: list[GeneratedText])->bool:
+        """Record the outputs of a job; False if `worker_id` lost its lease"""
+        return self._finish(job_id=job_id, worker_id=worker_id,
+                            assignments="status = 'done', outputs = ?, error = NULL",
+                            values=(json.dumps(outputs, ensure_ascii=False),))
+
+    def fail(self, job_id: str, worker_id: str, error: str,
+             retry_delay_s: Optional[float])->bool:
+        """Record a failed attempt: the job is retried after `retry_delay_s`,
+        or dead-lettered if None or out of attempts; False if `worker_id`
+        lost its lease"""
+        if retry_delay_s is None:
+            return self._finish(job_id=job_id, worker_id=worker_id,
+                                assignments="status = 'dead', error = ?", values=(error,))
+        return self._finish(
+            job_id=job_id, worker_id=worker_id,
+            assignments="status = CASE WHEN n_attempts >= max_attempts"
+                        " THEN 'dead' ELSE 'queued' END, error = ?, available_at = ?",
+            values=(error, time.time() + retry_delay_s),
+        )
+
+    def release(self, job_id: str, worker_id: str)->bool:
+        """Queue a job again, without counting its attempt (e.g., its worker
+        is shutting down)"""
+        return self._finish(
+            job_id=job_id, worker_id=worker_id,
+            assignments="status = 'queued', n_attempts = n_attempts - 1, available_at = ?",
+            values=(time.time(),),
+        )
+
+    def _finish(self, job_id: str, worker_id: str, assignments: str, values: tuple)->bool:
+        with self._lock:
+            cursor = self._connection.execute(
+                f"UPDATE generation_jobs SET {assignments}, worker_id = NULL, updated_at = ?"
+                " WHERE job_id = ? AND status = 'running' AND worker_id = ?",
+                (*values, time.time(), job_id, worker_id),
+            )
+        return cursor.rowcount == 1
+
+    def retry(self, job_id: str)->bool:
+        """Queue a dead-lettered job again, with all its attempts; False if
+        it is not dead"""
+        now = time.time()
+        with self._lock:
+            cursor = self._connection.execute(
+                "UPDATE generation_jobs SET status = 'queued', n_attempts = 0,"
+                " available_at = ?, updated_at = ? WHERE job_id = ? AND status = 'dead'",
+                (now, now, job_id),
+            )
+        return cursor.rowcount == 1
+
+    def undelivered(self, session_id: str)->list[Job]:
+        """Done jobs of the session whose outputs were not delivered yet,
+        oldest first"""
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT {_COLUMNS} FROM generation_jobs WHERE session_id = ?"
+                " AND status = 'done' AND delivered = 0 ORDER BY created_at",
+                (session_id,),
+            ).fetchall()
+        return [_job_from_row(row) for row in rows]
+
+    def mark_delivered(self, job_id: str)->bool:
+        """Mark the outputs of a job delivered; False if they already were
+        (e.g., by another page of the same session)"""
+        with self._lock:
+            cursor = self._connection.execute(
+                "UPDATE generation_jobs SET delivered = 1 WHERE job_id = ? AND delivered = 0",
+                (job_id,),
+            )
+        return cursor.rowcount == 1
+
+    def recent(self, status: Optional[JobStatus]=None, limit: int=100)->list[Job]:
+        """Most recently updated jobs (with `status`, if given)"""
+        where = "" if status is None else "WHERE status = ?"
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT {_COLUMNS} FROM generation_jobs {where}"
+                " ORDER BY updated_at DESC LIMIT ?",
+                (() if status is None else (status,)) + (limit,),
+            ).fetchall()
+        return [_job_from_row(row) for row in rows]
+
+    def counts(self)->dict[str, int]:
+        """Number of jobs by status"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT status, COUNT(*) FROM generation_jobs GROUP BY status"
+            ).fetchall()
+        return dict(rows)
+
+    def prune(self, max_age_s: float)->int:
+        """Drop the done and dead jobs not updated for `max_age_s` seconds;
+        return their number"""
+        with self._lock:
+            cursor = self._connection.execute(
+                "DELETE FROM generation_jobs WHERE status IN ('done', 'dead')"
+                " AND updated_at < ?",
+                (time.time() - max_age_s,),
+            )
+        return cursor.rowcount
+
+    def close(self)->None:
+        with self._lock:
+            self._connection.close()
+
+
+# =====
+# Queue
+# =====
+def _is_retryable(error: Exception)->bool:
+    return isinstance(error, (GenerationTimeoutError, RateLimitTimeoutError,
+                              *get_retryable_errors()))
+
+
+class JobQueue:
+    """Queue of generation jobs, processed by `n_workers` concurrent tasks of
+    this process (none: other processes run the jobs)
+
+    Call `start` and `stop` from the event loop (see register_job_queue for a
+    nicegui app.) Jobs still running on `stop` are queued again.
+    """
+
+    def __init__(
+        self,
+        store: JobStore,
+        n_workers: int=0,
+        max_attempts: int=3,
+        retry_delay_s: float=2.,
+        lease_s: float=2 * DEFAULT_TIMEOUT_S,
+        poll_interval_s: float=0.5,
+        timeout_s: float=DEFAULT_TIMEOUT_S,
+        retention_s: Optional[float]=None,
+    )->None:
+        self.store = store
+        self.n_workers = n_workers
+        self.max_attempts = max_attempts
+        self.retry_delay_s = retry_delay_s
+        self.lease_s = lease_s
+        self.poll_interval_s = poll_interval_s
+        self.timeout_s = timeout_s
+        self.retention_s = retention_s
+        self._tasks: list[asyncio.Task] = []
+        self._new_jobs: Optional[asyncio.Event] = None
+        self._updated: dict[str, asyncio.Event] = {}
+
+    def enqueue(self, session_id: str, prompt: Prompt, prompt_params: list[PromptParams],
+                template_name: str="", template_version: Optional[int]=None, n: int=1,
+                fresh: bool=False)->Job:
+        job = self.store.add(session_id=session_id, prompt=prompt, prompt_params=prompt_params,
+                             template_name=template_name, template_version=template_version,
+                             n=n, fresh=fresh, max_attempts=self.max_attempts)
+        self._on_enqueued()
+        return job
+
+    async def aenqueue(self, session_id: str, prompt: Prompt,
+                       prompt_params: list[PromptParams], template_name: str="",
+                       template_version: Optional[int]=None, n: int=1,
+                       fresh: bool=False)->Job:
+        """`enqueue` from the event loop: the write, which may wait for other
+        processes, runs in a thread"""
+        job = await asyncio.to_thread(
+            self.store.add, session_id=session_id, prompt=prompt, prompt_params=prompt_params,
+            template_name=template_name, template_version=template_version, n=n, fresh=fresh,
+            max_attempts=self.max_attempts,
+        )
+        self._on_enqueued()
+        return job
+
+    def _on_enqueued(self)->None:
+        _JOBS.inc(event="enqueued")
+        if self._new_jobs is not None:
+            self._new_jobs.set()
+
+    async def wait(self, job_id: str,
+                   on_update: Optional[Callable[[Job], None]]=None)->Job:
+        """The job, once done or dead; `on_update` is called on each change
+        of its status or attempts in the meantime
+
+        Jobs run by this process are reported as soon as they change, others
+        every `poll_interval_s`.
+        """
+        event = self._updated.setdefault(job_id, asyncio.Event())
+        last_seen = None
+        try:
+            while True:
+                event.clear()
+                job = await asyncio.to_thread(self.store.get, job_id)
+                if job.status in TERMINAL_STATUSES:
+                    return job
+                if on_update is not None and (job.status, job.n_attempts) != last_seen:
+                    on_update(job)
+                last_seen = (job.status, job.n_attempts)
+                try:
+                    await asyncio.wait_for(event.wait(), timeout=self.poll_interval_s)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._updated.pop(job_id, None)
+
+    async def start(self)->None:
+        """Drop the jobs older than `retention_s` (if set), start the workers"""
+        if self.retention_s is not None:
+            try:
+                await asyncio.to_thread(self.store.prune, max_age_s=self.retention_s)
+            except sqlite3.Error:
+                logger.exception("Could not prune the generation jobs")
+        self._new_jobs = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._run(worker_id=f"{os.getpid()}-{i}"))
+                       for i in range(self.n_workers)]
+
+    async def stop(self)->None:
+        """Stop the workers, queueing their running jobs again"""
+        for task in self._tasks:
+            task.cancel()
+        results = await asyncio.gather(*self._tasks, return_exceptions=True)
+        for result in results:
+            if (isinstance(result, BaseException)
+                    and not isinstance(result, asyncio.CancelledError)):
+                logger.error("Generation job worker failed", exc_info=result)
+        self._tasks = []
+
+    async def _run(self, worker_id: str)->None:
+        """Claim jobs and run them, until cancelled"""
+        while True:
+            try:
+                job = await asyncio.to_thread(self.store.claim, worker_id=worker_id,
+                                              lease_s=self.lease_s)
+            except sqlite3.Error:
+                logger.exception("Could not claim a generation job")
+                job = None
+            if job is None:
+                self._new_jobs.clear()
+                try:
+                    await asyncio.wait_for(self._new_jobs.wait(), timeout=self.poll_interval_s)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            if job.n_attempts == 1:
+                _JOB_WAIT.observe(time.time() - job.created_at)
+            self._notify(job.job_id)
+            try:
+                await self._process(job=job, worker_id=worker_id)
+            except sqlite3.Error:
+                # Left to its lease: it is claimed again once the lease expires
+                logger.exception("Could not record the outcome of generation job %s",
+                                 job.job_id)
+            except asyncio.CancelledError:
+                try:
+                    await asyncio.to_thread(self.store.release, job_id=job.job_id,
+                                            worker_id=worker_id)
+                except sqlite3.Error:
+                    logger.exception("Could not release generation job %s", job.job_id)
+                raise
+            self._notify(job.job_id)
+
+    async def _process(self, job: Job, worker_id: str)->None:
+        """Run an attempt of `job`, and record its outcome"""
+        try:
+            if job.n == 1:
+                outputs = [await agenerate_gpt4_simple(
+                    prompt=job.prompt, timeout=self.timeout_s, fresh=job.fresh,
+                    template_name=job.template_name, template_version=job.template_version,
+                )]
+            else:
+                outputs = await agenerate_gpt4_candidates(
+                    prompt=job.prompt, n=job.n, timeout=self.timeout_s, fresh=job.fresh,
+                    template_name=job.template_name, template_version=job.template_version,
+                )
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if _is_retryable(e) and job.n_attempts < job.max_attempts:
+                delay = min(MAX_RETRY_DELAY_S, self.retry_delay_s * 2 ** (job.n_attempts - 1))
+                logger.warning("Generation job %s failed (attempt %d/%d), retrying: %s",
+                               job.job_id, job.n_attempts, job.max_attempts, error)
+                _JOBS.inc(event="retried")
+                await asyncio.to_thread(self.store.fail, job_id=job.job_id, worker_id=worker_id,
+                                        error=error, retry_delay_s=random.uniform(0, delay))
+            else:
+                logger.error("Generation job %s dead-lettered after %d attempts: %s",
+                             job.job_id, job.n_attempts, error)
+                _JOBS.inc(event="dead")
+                await asyncio.to_thread(self.store.fail, job_id=job.job_id, worker_id=worker_id,
+                                        error=error, retry_delay_s=None)
+            return
+        if await asyncio.to_thread(self.store.complete, job_id=job.job_id, worker_id=worker_id,
+                                   outputs=outputs):
+            _JOBS.inc(event="done")
+        else:
+            logger.warning("Generation job %s was taken over, its outputs are dropped",
+                           job.job_id)
+
+    def _notify(self, job_id: str)->None:
+        event = self._updated.get(job_id)
+        if event is not None:
+            event.set()
+
+
+def get_job_queue(n_workers: Optional[int]=None, path: Optional[str]=None)->JobQueue:
+    """Queue on the jobs file `path` (by default, from the settings), with
+    `n_workers` (by default, the [jobs] workers, unless they run in dedicated
+    processes)"""
+    settings = get_settings().jobs
+    if n_workers is None:
+        n_workers = settings.workers if settings.processes == 0 else 0
+    return JobQueue(
+        store=JobStore(path=get_default_jobs_path() if path is None else path),
+        n_workers=n_workers,
+        max_attempts=settings.max_attempts,
+        retry_delay_s=settings.retry_delay_s,
+        lease_s=settings.lease_s,
+        poll_interval_s=settings.poll_interval_s,
+        retention_s=settings.retention_s,
+    )
+
+
+def register_job_queue(app: "App", queue: JobQueue)->None:
+    """Start the workers of `queue` with `app` (nicegui.app), and stop them
+    when `app` shuts down"""
+    app.on_startup(queue.start)
+    app.on_shutdown(queue.stop)
+
+
+def register_job_routes(app: "FastAPI", get_queue: Callable[[], JobQueue],
+                        path: str="/api/jobs")->None:
+    """Add the job endpoints to `app` (e.g., nicegui.app)
+
+    `GET <path>/{job_id}` returns the job (status, attempts, last error,
+    outputs once done); `GET <path>` the number of jobs by status.
+    """
+    from fastapi import HTTPException
+
+    @app.get(path + "/{job_id}")
+    def get_job(job_id: str)->dict:
+        try:
+            return get_queue().store.get(job_id).to_dict()
+        except UnknownJobError:
+            raise HTTPException(status_code=404, detail=f"No job {job_id}")
+
+    @app.get(path)
+    def get_job_counts()->dict:
+        return get_queue().store.counts()
+
+
+# ===
+# CLI
+# ===
+async def _work(queue: JobQueue)->None:
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopped.set)
+    await queue.start()
+    try:
+        await stopped.wait()
+    finally:
+        await queue.stop()
+
+
+def main(argv: Optional[list[str]]=None)->None:
+    """Command-line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--path", help="Jobs file (by default, from the settings)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    work_parser = subparsers.add_parser("work", help="Run jobs, until interrupted")
+    work_parser.add_argument("--workers", type=int, default=get_settings().jobs.workers,
+                             help="Jobs run concurrently")
+    list_parser = subparsers.add_parser("list", help="Print the jobs, most recent first")
+    list_parser.add_argument("--status", choices=["queued", "running", "done", "dead"])
+    list_parser.add_argument("--limit", type=int, default=20)
+    retry_parser = subparsers.add_parser("retry", help="Queue dead-lettered jobs again")
+    retry_parser.add_argument("job_ids", nargs="+")
+    args = parser.parse_args(argv)
+    queue = get_job_queue(n_workers=args.workers if args.command == "work" else 0,
+                          path=args.path)
+    if args.command == "work":
+        logging.basicConfig(level=logging.INFO)
+        asyncio.run(_work(queue))
+    elif args.command == "list":
+        print(json.dumps(queue.store.counts()))
+        for job in queue.store.recent(status=args.status, limit=args.limit):
+            print(json.dumps(job.to_dict(), ensure_ascii=False))
+    else:
+        for job_id in args.job_ids:
+            if not queue.store.retry(job_id):
+                print(f"{job_id} is not dead-lettered", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
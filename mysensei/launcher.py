@@ -0,0 +1,170 @@
+"""
+Multi-worker launcher of the web app
+
+NiceGUI pages keep their elements and websocket in the process that built
+them, so workers are separate processes, each listening on its own port,
+behind a reverse proxy with sticky sessions (see the README.) What they share
+lives in local SQLite files: the sessions' results and the rate limits (the
+[server] shared_state_path), the generation jobs, and the completion cache.
+With [jobs] processes, dedicated processes run the generation jobs (see
+mysensei.jobs) instead of the app workers. Processes that exit unexpectedly
+are restarted.
+
+Example:
+    python -m mysensei.launcher --workers 4 --base-port 8081
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+import mysensei.io as ms_io
+from mysensei.settings import ENV_PREFIX, get_settings
+
+DEFAULT_APP_PATH = os.path.join("app", "get_mnemonics.py")
+DEFAULT_SHARED_STATE_FILENAME = "shared_state.sqlite"
+# Delay before restarting a worker, doubled on each consecutive crash
+MIN_RESTART_DELAY_S = 1.
+MAX_RESTART_DELAY_S = 30.
+# A worker that ran for that long is considered healthy again
+HEALTHY_AFTER_S = 60.
+POLL_INTERVAL_S = 0.5
+
+
+def get_default_shared_state_path()->str:
+    return os.path.join(ms_io.get_lib_path(), "cache", DEFAULT_SHARED_STATE_FILENAME)
+
+
+def worker_env(port: Optional[int], shared_state_path: str,
+               n_job_workers: int=0)->dict[str, str]:
+    """Environment of a worker, serving the app on `port` or running jobs if
+    None (settings overrides, see mysensei.settings)"""
+    env = os.environ | {
+        "PYTHONPATH": ms_io.get_lib_path(),
+        f"{ENV_PREFIX}SERVER__RELOAD": "false",
+        f"{ENV_PREFIX}SERVER__SHARED_STATE_PATH": shared_state_path,
+        # The app workers run the jobs only if no process is dedicated to it
+        f"{ENV_PREFIX}JOBS__PROCESSES": str(n_job_workers),
+    }
+    if port is not None:
+        env[f"{ENV_PREFIX}SERVER__PORT"] = str(port)
+    return env
+
+
+@dataclass
+class Worker:
+    port: Optional[int]  # None for job workers
+    process: Optional[subprocess.Popen] = None
+    started_at: float = 0.
+    restart_delay_s: float = MIN_RESTART_DELAY_S
+    restart_at: Optional[float] = None
+
+
+class WorkerPool:
+    """Worker processes of `app_path`, on consecutive ports from `base_port`,
+    and `n_job_workers` processes running generation jobs"""
+
+    def __init__(self, app_path: str, n_workers: int, base_port: int,
+                 shared_state_path: str, n_job_workers: int=0)->None:
+        self.app_path = app_path
+        self.shared_state_path = shared_state_path
+        self.n_job_workers = n_job_workers
+        self.workers = [Worker(port=base_port + i) for i in range(n_workers)] \
+            + [Worker(port=None) for _ in range(n_job_workers)]
+        self._stopping = False
+
+    def _start(self, worker: Worker)->None:
+        command = [sys.executable, self.app_path] if worker.port is not None \
+            else [sys.executable, "-m", "mysensei.jobs", "work"]
+        worker.process = subprocess.Popen(
+            command,
+            env=worker_env(port=worker.port, shared_state_path=self.shared_state_path,
+                           n_job_workers=self.n_job_workers),
+        )
+        worker.started_at = time.monotonic()
+        worker.restart_at = None
+
+    def start(self)->None:
+        for worker in self.workers:
+            self._start(worker)
+
+    def check(self)->None:
+        """Schedule the restart of the workers that exited, and restart those
+        due"""
+        now = time.monotonic()
+        for worker in self.workers:
+            if self._stopping or worker.process is None or worker.process.poll() is None:
+                continue
+            if worker.restart_at is None:
+                if now - worker.started_at >= HEALTHY_AFTER_S:
+                    worker.restart_delay_s = MIN_RESTART_DELAY_S
+                name = "Job worker" if worker.port is None else f"Worker on port {worker.port}"
+                print(f"{name} exited with code"
+                      f" {worker.process.returncode}, restarting in"
+                      f" {worker.restart_delay_s:.0f}s", file=sys.stderr)
+                worker.restart_at = now + worker.restart_delay_s
+                worker.restart_delay_s = min(2 * worker.restart_delay_s, MAX_RESTART_DELAY_S)
+            elif now >= worker.restart_at:
+                self._start(worker)
+
+    def stop(self, timeout_s: float=30.)->None:
+        """Terminate the workers, killing those still running after
+        `timeout_s`"""
+        self._stopping = True
+        processes = [w.process for w in self.workers if w.process is not None]
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        deadline = time.monotonic() + timeout_s
+        for process in processes:
+            try:
+                process.wait(timeout=max(0., deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+
+def _interrupt(*_)->None:
+    raise KeyboardInterrupt
+
+
+def main(argv: Optional[list[str]]=None)->None:
+    """Command-line entry point"""
+    settings = get_settings().server
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--app", default=os.path.join(ms_io.get_lib_path(), DEFAULT_APP_PATH),
+                        help="App run by each worker")
+    parser.add_argument("--workers", type=int, default=settings.workers)
+    parser.add_argument("--base-port", type=int, default=settings.port,
+                        help="Port of the first worker (the others follow)")
+    parser.add_argument("--job-workers", type=int, default=get_settings().jobs.processes,
+                        help="Processes running the generation jobs (if 0, the app workers"
+                             " run them)")
+    parser.add_argument("--shared-state-path",
+                        default=settings.shared_state_path or get_default_shared_state_path(),
+                        help="SQLite file of the state shared by the workers")
+    args = parser.parse_args(argv)
+    pool = WorkerPool(app_path=args.app, n_workers=args.workers, base_port=args.base_port,
+                      shared_state_path=args.shared_state_path, n_job_workers=args.job_workers)
+    # Stop on SIGTERM as on Ctrl+C
+    signal.signal(signal.SIGTERM, _interrupt)
+    pool.start()
+    print(f"{args.workers} workers on ports {args.base_port}-{args.base_port + args.workers - 1}"
+          f" (to be proxied with sticky sessions), {args.job_workers} job workers",
+          file=sys.stderr)
+    try:
+        while True:
+            time.sleep(POLL_INTERVAL_S)
+            pool.check()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+In-process metrics, exposed in the Prometheus text format
+
+Metrics are counters and histograms with labels, kept in a process-wide
+registry. `register_metrics_route` serves them from a FastAPI app (e.g.,
+nicegui.app) for scraping.
+"""
+import bisect
+import threading
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:  # fastapi is only imported to serve the metrics
+    from fastapi import FastAPI
+
+# Latency buckets of LLM calls, in seconds
+LATENCY_BUCKETS_S = (0.1, 0.25, 0.5, 1., 2., 5., 10., 20., 30., 60., 120.)
+# Token count buckets
+TOKEN_BUCKETS = (16, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+CONTENT_TYPE = "text/plain; version=0.0.4"  # charset added by the response
+
+
+class MetricError(Exception):
+    """A metric is declared or used inconsistently"""
+    pass
+
+
+# =======
+# Metrics
+# =======
+def _format_labels(label_names: tuple[str, ...], label_values: tuple[str, ...],
+                   extra: str="")->str:
+    pairs = [
+        f'{n}="{_escape(v)}"' for n, v in zip(label_names, label_values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str)->str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float)->str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str,
+                 label_names: tuple[str, ...]=())->None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict[str, str])->tuple[str, ...]:
+        if labels.keys() != set(self.label_names):
+            raise MetricError(
+                f"{self.name} expects labels {self.label_names}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[n]) for n in self.label_names)
+
+    def render(self)->list[str]:
+        return [f"# HELP {self.name} {self.documentation}",
+                f"# TYPE {self.name} {self.type_name}"] + self._render_samples()
+
+    def _render_samples(self)->list[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Monotonically increasing value, per label values"""
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str,
+                 label_names: tuple[str, ...]=())->None:
+        super().__init__(name=name, documentation=documentation, label_names=label_names)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float=1., **labels: str)->None:
+        if amount < 0:
+            raise MetricError(f"{self.name} cannot decrease")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.) + amount
+
+    def get(self, **labels: str)->float:
+        return self._values.get(self._key(labels), 0.)
+
+    def _render_samples(self)->list[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.label_names, k)} {_format_value(v)}"
+                for k, v in values]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets, per label values"""
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str,
+                 label_names: tuple[str, ...]=(),
+                 buckets: tuple[float, ...]=LATENCY_BUCKETS_S)->None:
+        super().__init__(name=name, documentation=documentation, label_names=label_names)
+        self.buckets = tuple(sorted(buckets))
+        # Per label values: non-cumulative bucket counts (+Inf last), sum
+        self._values: dict[tuple[str, ...], tuple[list[int], float]] = {}
+
+    def observe(self, value: float, **labels: str)->None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def get_count(self, **labels: str)->int:
+        counts, _ = self._values.get(self._key(labels), ([0], 0.))
+        return sum(counts)
+
+    def _render_samples(self)->list[str]:
+        with self._lock:
+            values = sorted((k, (list(c), s)) for k, (c, s) in self._values.items())
+        lines = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                labels = _format_labels(self.label_names, key, extra=f'le="{le}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+# ========
+# Registry
+# ========
+class MetricsRegistry:
+    """Named metrics of the process"""
+
+    def __init__(self)->None:
+        self._metrics: dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, documentation: str,
+                label_names: tuple[str, ...]=())->Counter:
+        """Counter `name`, created if needed"""
+        return self._get_or_create(Counter, name=name, documentation=documentation,
+                                   label_names=label_names)
+
+    def histogram(self, name: str, documentation: str,
+                  label_names: tuple[str, ...]=(),
+                  buckets: tuple[float, ...]=LATENCY_BUCKETS_S)->Histogram:
+        """Histogram `name`, created if needed"""
+        return self._get_or_create(Histogram, name=name, documentation=documentation,
+                                   label_names=label_names, buckets=buckets)
+
+    def render(self)->str:
+        """All metrics, in the Prometheus text format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(line for m in metrics for line in m.render()) + "\n"
+
+    def _get_or_create(self, metric_class: type[_Metric], name: str, **kwargs)->_Metric:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_class(name=name, **kwargs)
+            elif (type(metric) is not metric_class
+                  or metric.label_names != kwargs["label_names"]):
+                raise MetricError(f"{name} is already declared differently")
+            return metric
+
+
+_REGISTRY: Optional[MetricsRegistry] = None
+
+
+def get_registry()->MetricsRegistry:
+    """Process-wide metrics registry"""
+    global _REGISTRY
+    if _REGISTRY is None:
+        _REGISTRY = MetricsRegistry()
+    return _REGISTRY
+
+
+def register_metrics_route(app: "FastAPI", path: str="/metrics")->None:
+    """Serve the process metrics from `app` (e.g., nicegui.app)"""
+    from fastapi.responses import PlainTextResponse
+
+    @app.get(path, response_class=PlainTextResponse)
+    def metrics()->PlainTextResponse:
+        return PlainTextResponse(content=get_registry().render(), media_type=CONTENT_TYPE)
@@ -0,0 +1,270 @@
+"""
+Write-behind persistence of generation results
+
+Records are queued in memory and inserted by a background task, in batches:
+a batch is written once it holds `max_batch_size` records or once its oldest
+record has waited `flush_interval_s` seconds, whichever comes first. Callers
+never wait on the database; a crash loses at most the batch being gathered.
+Batches that fail while the database is unavailable are retried whole with the
+next one; other failures are retried record by record, and a record that still
+fails after MAX_WRITE_ATTEMPTS is dropped (and logged.)
+"""
+import asyncio
+import json
+import logging
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, Iterator, Optional
+
+from sqlalchemy import Engine, insert, select
+from sqlalchemy.exc import InterfaceError, OperationalError, TimeoutError as PoolTimeoutError
+
+from mysensei.annotations import ComponentConcept, GeneratedText, TargetConcept
+from mysensei.repository import init_db
+from mysensei.results import TCResult
+from mysensei.sql import GenerationResults
+
+if TYPE_CHECKING:
+    from nicegui.app import App
+
+logger = logging.getLogger(__name__)
+# Errors of an unavailable database, rather than of the records written
+TRANSIENT_ERRORS = (OperationalError, InterfaceError, PoolTimeoutError)
+# Writes of a record failing for another reason, before it is dropped
+MAX_WRITE_ATTEMPTS = 3
+
+
+@dataclass(frozen=True)
+class GenerationRecord:
+    """A generation result, with what it was generated from"""
+    session_id: str
+    target_concept: TargetConcept
+    component_concepts: tuple[ComponentConcept, ...]
+    template_name: str
+    template_version: int
+    mnemonic: GeneratedText
+    revisions: tuple[GeneratedText, ...] = ()
+    user_id: Optional[int] = None
+    created_at: datetime = field(default_factory=lambda: datetime.now(timezone.utc))
+
+    def to_row(self)->dict:
+        """Row of the generation_results table"""
+        return {
+            "session_id": self.session_id,
+            "user_id": self.user_id,
+            "target_concept": self.target_concept,
+            "component_concepts": json.dumps(list(self.component_concepts), ensure_ascii=False),
+            "template_name": self.template_name,
+            "template_version": self.template_version,
+            "mnemonic": self.mnemonic,
+            "revisions": json.dumps(list(self.revisions), ensure_ascii=False),
+            "created_at": self.created_at,
+        }
+
+
+_STOP = object()
+
+
+class WriteBehindQueue:
+    """Queue of GenerationRecord, inserted in batches by a background task
+
+    Call `start` and `stop` from the event loop (see register_write_behind_queue
+    for a nicegui app.) `stop` writes everything still queued.
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        max_batch_size: int=100,
+        flush_interval_s: float=1.,
+        max_pending: int=100_000,
+    )->None:
+        self.engine = engine
+        self.max_batch_size = max_batch_size
+        self.flush_interval_s = flush_interval_s
+        self.max_pending = max_pending
+        self.n_written = 0
+        self.n_dropped = 0
+        self._queue: asyncio.Queue = asyncio.Queue()
+        # To be retried with the next batch, with their failed writes so far
+        self._failed: list[tuple[GenerationRecord, int]] = []
+        self._batch: list[GenerationRecord] = []  # Being gathered
+        self._task: Optional[asyncio.Task] = None
+
+    def put(self, record: GenerationRecord)->None:
+        """Queue `record` for writing; never blocks"""
+        if self._queue.qsize() + len(self._failed) >= self.max_pending:
+            # Database unavailable for too long: drop rather than run out of memory
+            self.n_dropped += 1
+            logger.warning("Write-behind queue full, dropping a generation record")
+            return
+        self._queue.put_nowait(record)
+
+    async def start(self)->None:
+        """Create missing tables, then start the background writer"""
+        try:
+            await asyncio.to_thread(init_db, self.engine)
+        except Exception:
+            logger.exception("Could not initialize the database")
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self)->None:
+        """Write all queued records, then stop the background writer"""
+        if self._task is None:
+            return
+        self._queue.put_nowait(_STOP)
+        await self._task
+        self._task = None
+
+    async def _run(self)->None:
+        """Gather batches and write them, until _STOP is received
+
+        If cancelled instead (nicegui does not wait for its shutdown handlers,
+        so `stop` may not get to the end before the event loop is closed),
+        what is left is written synchronously.
+        """
+        try:
+            await self._gather_and_flush()
+        except asyncio.CancelledError:
+            self._write_remaining()
+            raise
+
+    async def _gather_and_flush(self)->None:
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            first = await self._queue.get()
+            if first is _STOP:
+                break
+            self._batch = [first]
+            deadline = loop.time() + self.flush_interval_s
+            while len(self._batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                try:
+                    record = await asyncio.wait_for(self._queue.get(), timeout=max(timeout, 0))
+                except asyncio.TimeoutError:
+                    break
+                if record is _STOP:
+                    stopping = True
+                    break
+                self._batch.append(record)
+            batch, self._batch = self._batch, []
+            await self._flush(batch)
+        # Shutting down: write whatever is left
+        await self._flush(self._dequeue_all())
+
+    def _dequeue_all(self)->list[GenerationRecord]:
+        records = []
+        while not self._queue.empty():
+            record = self._queue.get_nowait()
+            if record is not _STOP:
+                records.append(record)
+        return records
+
+    def _write_remaining(self)->None:
+        """Write the records not handed to a write yet, blocking the event
+        loop (which is shutting down)"""
+        records = [record for record, _ in self._failed] + self._batch + self._dequeue_all()
+        self._failed, self._batch = [], []
+        if len(records) == 0:
+            return
+        try:
+            self._write(records)
+        except Exception:
+            self.n_dropped += len(records)
+            logger.exception("Could not write %d generation records at shutdown", len(records))
+        else:
+            self.n_written += len(records)
+
+    async def _flush(self, batch: list[GenerationRecord])->None:
+        """Write `batch` and the previously failed records, off the event loop"""
+        attempted = self._failed + [(record, 0) for record in batch]
+        self._failed = []
+        if len(attempted) == 0:
+            return
+        try:
+            await self._write_in_thread([record for record, _ in attempted])
+        except TRANSIENT_ERRORS:
+            logger.exception("Could not write %d generation records", len(attempted))
+            self._failed = attempted
+        except Exception:
+            logger.exception("Could not write %d generation records, writing them one"
+                             " by one", len(attempted))
+            await self._flush_one_by_one(attempted)
+        else:
+            self.n_written += len(attempted)
+
+    async def _flush_one_by_one(self, attempted: list[tuple[GenerationRecord, int]])->None:
+        """Write records separately, to set apart those that cannot be written"""
+        for i, (record, n_failures) in enumerate(attempted):
+            try:
+                await self._write_in_thread([record])
+            except asyncio.CancelledError:
+                self._failed.extend(attempted[i + 1:])  # See _write_remaining
+                raise
+            except TRANSIENT_ERRORS:
+                logger.exception("Could not write a generation record")
+                self._failed.extend(attempted[i:])
+                return
+            except Exception:
+                if n_failures + 1 < MAX_WRITE_ATTEMPTS:
+                    self._failed.append((record, n_failures + 1))
+                else:
+                    self.n_dropped += 1
+                    logger.exception("Dropping generation record %r after %d failed writes",
+                                     record, MAX_WRITE_ATTEMPTS)
+            else:
+                self.n_written += 1
+
+    async def _write_in_thread(self, batch: list[GenerationRecord])->None:
+        """Write `batch` off the event loop. If cancelled before the thread got
+        to it (the loop may be closed without running it), write it here."""
+        lock = threading.Lock()
+        started = []
+
+        def write_once()->None:
+            with lock:
+                if len(started) > 0:
+                    return
+                started.append(True)
+                self._write(batch)
+        try:
+            await asyncio.to_thread(write_once)
+        except asyncio.CancelledError:
+            try:
+                write_once()  # Or wait for the thread's write to finish
+            except Exception:
+                self.n_dropped += len(batch)
+                logger.exception("Could not write %d generation records at shutdown",
+                                 len(batch))
+            raise
+
+    def _write(self, batch: list[GenerationRecord])->None:
+        with self.engine.begin() as connection:
+            connection.execute(insert(GenerationResults), [r.to_row() for r in batch])
+
+
+def iter_stored_results(engine: Engine, limit: Optional[int]=None,
+                        batch_size: int=1000)->Iterator[TCResult]:
+    """Stored results, most recent first (`limit` of them, if set), fetched
+    `batch_size` rows at a time"""
+    query = select(
+        GenerationResults.target_concept, GenerationResults.component_concepts,
+        GenerationResults.mnemonic, GenerationResults.revisions,
+    ).order_by(GenerationResults.result_id.desc()).limit(limit)
+    with engine.connect() as connection:
+        rows = connection.execution_options(yield_per=batch_size).execute(query)
+        for target_concept, component_concepts, mnemonic, revisions in rows:
+            yield TCResult(
+                target_concept=target_concept,
+                component_concepts=tuple(json.loads(component_concepts or "[]")),
+                mnemonic=mnemonic,
+                revisions=tuple(json.loads(revisions or "[]")),
+            )
+
+
+def register_write_behind_queue(app: "App", queue: WriteBehindQueue)->None:
+    """Start `queue` with `app` (nicegui.app), and flush it when `app` shuts down"""
+    app.on_startup(queue.start)
+    app.on_shutdown(queue.stop)
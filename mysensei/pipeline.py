@@ -0,0 +1,325 @@
+"""
+Multi-stage generation over many items
+
+A pipeline is a graph of stages, each rendering one template. A stage may feed
+its output to the prompt parameters of later stages (e.g., the meaning
+mnemonic becomes the `meaning_mnemonic` of the reading mnemonic.) Every item
+goes through the graph on its own, so that stages of different items overlap;
+each stage has its own concurrency limit.
+
+Each stage output is saved as soon as it is generated. Running the pipeline
+again reuses them, and only generates the stages that failed or did not run.
+
+Example:
+    python -m mysensei.pipeline words.jsonl deck.sqlite --output deck.jsonl
+"""
+import argparse
+import asyncio
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Iterable, Iterator, Optional
+
+import mysensei.io as ms_io
+from mysensei.batch import (TEMPLATE_PARAMS_CLASSES, build_prompt_params,
+    read_rows, render_prompt)
+from mysensei.generation import DEFAULT_TIMEOUT_S, agenerate_with_retries
+
+
+class PipelineError(Exception):
+    """The stages do not form a valid pipeline"""
+    pass
+
+
+class _UpstreamFailed(Exception):
+    """A stage this one depends on failed"""
+    pass
+
+
+# ======
+# Stages
+# ======
+@dataclass(frozen=True)
+class Stage:
+    """A generation step
+
+    `inputs` maps prompt parameter names to the stage whose output fills them
+    out; the other parameters come from the item itself.
+    """
+    name: str
+    template_name: str
+    template_version: int = 0
+    inputs: dict[str, str] = field(default_factory=dict)
+    max_in_flight: int = 4
+
+    def depends_on(self)->set[str]:
+        return set(self.inputs.values())
+
+
+# Full vocabulary card: the meaning mnemonic is both revised and turned into a
+# reading mnemonic
+DECK_STAGES = [
+    Stage(name="meaning", template_name="pure_concepts", template_version=1),
+    Stage(name="revision", template_name="pure_concepts_revision",
+          inputs={"mnemonic": "meaning"}),
+    Stage(name="reading", template_name="reading_mnem", template_version=1,
+          inputs={"meaning_mnemonic": "meaning"}),
+]
+
+
+def sort_stages(stages: list[Stage])->list[Stage]:
+    """Stages in dependency order; raise PipelineError if that is impossible"""
+    by_name = {s.name: s for s in stages}
+    if len(by_name) != len(stages):
+        raise PipelineError("Stage names are not unique")
+    for stage in stages:
+        unknown = stage.depends_on() - by_name.keys()
+        if len(unknown) > 0:
+            raise PipelineError(f"Stage {stage.name} depends on unknown stages {unknown}")
+    ordered = []
+    placed = set()
+    while len(ordered) < len(stages):
+        ready = [s for s in stages
+                 if s.name not in placed and s.depends_on() <= placed]
+        if len(ready) == 0:
+            raise PipelineError("Stages have a dependency cycle")
+        ordered.extend(ready)
+        placed.update(s.name for s in ready)
+    return ordered
+
+
+# =====
+# Store
+# =====
+class StageStore:
+    """SQLite store of the stage outputs (and last errors) of each item"""
+
+    def __init__(self, path: str)->None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False,
+                                           isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS stage_results ("
+            " item_id TEXT NOT NULL,"
+            " stage TEXT NOT NULL,"
+            " output TEXT,"
+            " error TEXT,"
+            " n_attempts INTEGER NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " PRIMARY KEY (item_id, stage))"
+        )
+
+    def get_output(self, item_id: str, stage: str)->Optional[str]:
+        """Output of a stage, or None if it did not succeed yet"""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT output FROM stage_results WHERE item_id = ? AND stage = ?",
+                (item_id, stage),
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def set_output(self, item_id: str, stage: str, output: str)->None:
+        self._upsert(item_id=item_id, stage=stage, output=output, error=None)
+
+    def set_error(self, item_id: str, stage: str, error: str)->None:
+        self._upsert(item_id=item_id, stage=stage, output=None, error=error)
+
+    def get_item_outputs(self)->Iterator[tuple[str, dict[str, str]]]:
+        """(item id, outputs by stage) of all items with some output"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT item_id, stage, output FROM stage_results"
+                " WHERE output IS NOT NULL ORDER BY item_id"
+            ).fetchall()
+        item_id, outputs = None, {}
+        for row_item_id, stage, output in rows:
+            if row_item_id != item_id and item_id is not None:
+                yield item_id, outputs
+                outputs = {}
+            item_id = row_item_id
+            outputs[stage] = output
+        if item_id is not None:
+            yield item_id, outputs
+
+    def _upsert(self, item_id: str, stage: str, output: Optional[str],
+                error: Optional[str])->None:
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO stage_results VALUES (?, ?, ?, ?, 1, ?)"
+                " ON CONFLICT (item_id, stage) DO UPDATE SET"
+                " output = excluded.output, error = excluded.error,"
+                " n_attempts = n_attempts + 1, updated_at = excluded.updated_at",
+                (item_id, stage, output, error, time.time()),
+            )
+
+
+# ===
+# Run
+# ===
+@dataclass
+class StageReport:
+    """Outcome of a stage over all items"""
+    n_generated: int = 0
+    n_reused: int = 0
+    n_failed: int = 0
+    n_skipped: int = 0  # Because a stage it depends on failed
+
+
+@dataclass
+class PipelineReport:
+    """Outcome of a pipeline run, by stage"""
+    stages: dict[str, StageReport] = field(default_factory=dict)
+
+    def n_failed(self)->int:
+        return sum(s.n_failed + s.n_skipped for s in self.stages.values())
+
+
+class Pipeline:
+    """Run stages over items, as a dependency graph
+
+    At most `max_items_in_flight` items are being processed at once (so that
+    the items are never loaded whole), and at most `stage.max_in_flight`
+    generations of each stage are pending.
+    """
+
+    def __init__(
+        self,
+        stages: list[Stage],
+        store: StageStore,
+        max_retries: int=5,
+        timeout: float=DEFAULT_TIMEOUT_S,
+        fresh: bool=False,
+    )->None:
+        self.stages = sort_stages(stages)
+        self.store = store
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.fresh = fresh
+        self._templates = {
+            s.name: ms_io.get_jinja_template(template_name=s.template_name,
+                                             version=s.template_version)
+            for s in self.stages
+        }
+
+    async def run(self, items: Iterable[tuple[str, dict]],
+                  max_items_in_flight: int=16)->PipelineReport:
+        """Run every stage for every (item id, item)"""
+        report = PipelineReport(stages={s.name: StageReport() for s in self.stages})
+        semaphores = {s.name: asyncio.Semaphore(s.max_in_flight) for s in self.stages}
+        items = iter(items)
+
+        async def worker()->None:
+            for item_id, item in items:
+                await self._run_item(item_id=item_id, item=item, report=report,
+                                     semaphores=semaphores)
+
+        await asyncio.gather(*[worker() for _ in range(max_items_in_flight)])
+        return report
+
+    async def _run_item(self, item_id: str, item: dict, report: PipelineReport,
+                        semaphores: dict[str, asyncio.Semaphore])->None:
+        """Run the stages of an item, each as soon as its inputs are ready"""
+        tasks: dict[str, asyncio.Task] = {}
+        for stage in self.stages:  # Dependencies come first
+            tasks[stage.name] = asyncio.create_task(self._run_stage(
+                stage=stage, item_id=item_id, item=item,
+                dependencies={n: tasks[n] for n in stage.depends_on()},
+                stage_report=report.stages[stage.name],
+                semaphore=semaphores[stage.name],
+            ))
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+    async def _run_stage(
+        self,
+        stage: Stage,
+        item_id: str,
+        item: dict,
+        dependencies: dict[str, asyncio.Task],
+        stage_report: StageReport,
+        semaphore: asyncio.Semaphore,
+    )->str:
+        """Output of `stage` for an item, reused from the store if possible"""
+        outputs = {}
+        for name, task in dependencies.items():
+            try:
+                outputs[name] = await task
+            except Exception as e:
+                stage_report.n_skipped += 1
+                raise _UpstreamFailed(name) from e
+        output = self.store.get_output(item_id=item_id, stage=stage.name)
+        if output is not None:
+            stage_report.n_reused += 1
+            return output
+        row = item | {param: outputs[name] for param, name in stage.inputs.items()}
+        try:
+            prompt = render_prompt(
+                template=self._templates[stage.name],
+                prompt_params_lst=build_prompt_params(
+                    row=row, params_classes=TEMPLATE_PARAMS_CLASSES[stage.template_name]
+                ),
+            )
+            async with semaphore:
+                output = await agenerate_with_retries(
+                    prompt=prompt, timeout=self.timeout,
+                    max_retries=self.max_retries, fresh=self.fresh,
+                    template_name=stage.template_name,
+                    template_version=stage.template_version,
+                )
+        except Exception as e:
+            stage_report.n_failed += 1
+            self.store.set_error(item_id=item_id, stage=stage.name, error=repr(e))
+            print(f"Item {item_id}, stage {stage.name} failed: {e!r}", file=sys.stderr)
+            raise
+        self.store.set_output(item_id=item_id, stage=stage.name, output=output)
+        stage_report.n_generated += 1
+        return output
+
+
+def main(argv: Optional[list[str]]=None)->None:
+    """Command-line entry point (runs DECK_STAGES)"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("input_path", help=".csv or .jsonl file of items")
+    parser.add_argument("store_path", help="SQLite file of the stage outputs, reused across runs")
+    parser.add_argument("--output", help=".jsonl file to export the outputs to")
+    parser.add_argument("--max-items-in-flight", type=int, default=16)
+    parser.add_argument("--max-in-flight", type=int, default=4,
+                        help="Max number of concurrent generations per stage")
+    parser.add_argument("--max-retries", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT_S,
+                        help="Timeout of each generation attempt, in seconds")
+    parser.add_argument("--fresh", action="store_true",
+                        help="Do not reuse cached completions")
+    args = parser.parse_args(argv)
+    store = StageStore(path=args.store_path)
+    pipeline = Pipeline(
+        stages=[Stage(name=s.name, template_name=s.template_name,
+                      template_version=s.template_version, inputs=s.inputs,
+                      max_in_flight=args.max_in_flight)
+                for s in DECK_STAGES],
+        store=store,
+        max_retries=args.max_retries,
+        timeout=args.timeout,
+        fresh=args.fresh,
+    )
+    report = asyncio.run(pipeline.run(items=read_rows(args.input_path),
+                                      max_items_in_flight=args.max_items_in_flight))
+    for name, stage_report in report.stages.items():
+        print(f"{name}: {stage_report.n_generated} generated, {stage_report.n_reused}"
+              f" reused, {stage_report.n_failed} failed, {stage_report.n_skipped}"
+              f" skipped", file=sys.stderr)
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            for item_id, outputs in store.get_item_outputs():
+                f.write(json.dumps({"id": item_id, **outputs}, ensure_ascii=False) + "\n")
+    if report.n_failed() > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
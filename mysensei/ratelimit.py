@@ -0,0 +1,311 @@
+"""
+Rate limiting and coalescing of concurrent calls
+
+`RateLimiter` keeps the process under requests/min and tokens/min quotas, with
+one token bucket per quota. A call reserves its share of both buckets up
+front, then waits until the reservation is covered: callers are served in the
+order they asked, from any thread or event loop. The token count of a call is
+an estimate; it is corrected once the actual usage is known.
+`SharedRateLimiter` keeps the buckets in a SQLite file instead, so that the
+worker processes of a deployment share the quotas.
+
+`SingleFlight` makes concurrent calls with the same key share one execution
+(and its result, or error.)
+"""
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Awaitable, Callable, Hashable, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class RateLimitTimeoutError(Exception):
+    """The rate limit would delay a call beyond its timeout"""
+    pass
+
+
+# ==============
+# Token buckets
+# ==============
+class TokenBucket:
+    """Quota refilled at `rate_per_s`, up to `capacity`
+
+    The level can go negative: a call taking more than what is available is
+    in debt, which delays the following calls.
+    """
+
+    def __init__(self, rate_per_s: float, capacity: float)->None:
+        self.rate_per_s = rate_per_s
+        self.capacity = capacity
+        self._level = capacity
+        self._updated_at = time.monotonic()
+
+    def _refill(self, now: float)->None:
+        if self._level < self.capacity:
+            self._level = min(self.capacity,
+                              self._level + (now - self._updated_at) * self.rate_per_s)
+        self._updated_at = now
+
+    def take(self, amount: float, now: float)->float:
+        """Take `amount`; return the wait, in seconds, until it is covered"""
+        self._refill(now)
+        self._level -= amount
+        return max(0., -self._level / self.rate_per_s)
+
+    def wait_s(self, amount: float, now: float)->float:
+        """Wait that taking `amount` would entail, without taking it"""
+        self._refill(now)
+        return max(0., (amount - self._level) / self.rate_per_s)
+
+    def give_back(self, amount: float)->None:
+        self._level = min(self.capacity, self._level + amount)
+
+
+class RateLimiter:
+    """Requests/min and tokens/min quotas (no limit for None)
+
+    Buckets hold `burst_s` seconds worth of quota, so that a quota is not
+    spent in a single burst after an idle period.
+    """
+    _clock = staticmethod(time.monotonic)
+
+    def __init__(self, requests_per_minute: Optional[int]=None,
+                 tokens_per_minute: Optional[int]=None, burst_s: float=10.)->None:
+        self._lock = threading.Lock()
+        self._requests = None if requests_per_minute is None else TokenBucket(
+            rate_per_s=requests_per_minute / 60,
+            capacity=max(1., requests_per_minute * burst_s / 60),
+        )
+        self._tokens = None if tokens_per_minute is None else TokenBucket(
+            rate_per_s=tokens_per_minute / 60,
+            capacity=tokens_per_minute * burst_s / 60,
+        )
+
+    def reserve(self, n_tokens: int, max_wait_s: Optional[float]=None)->float:
+        """Reserve a request of `n_tokens`; return the wait, in seconds, before
+        making it. Raise RateLimitTimeoutError (reserving nothing) if the wait
+        would be longer than `max_wait_s`."""
+        with self._lock:
+            now = self._clock()
+            if max_wait_s is not None and self._wait_s(n_tokens, now) > max_wait_s:
+                raise RateLimitTimeoutError(
+                    f"Rate limit: {n_tokens} tokens would be available after more than"
+                    f" {max_wait_s}s"
+                )
+            wait_s = 0.
+            if self._requests is not None:
+                wait_s = max(wait_s, self._requests.take(1, now))
+            if self._tokens is not None:
+                wait_s = max(wait_s, self._tokens.take(n_tokens, now))
+            return wait_s
+
+    def _wait_s(self, n_tokens: int, now: float)->float:
+        wait_s = 0.
+        if self._requests is not None:
+            wait_s = max(wait_s, self._requests.wait_s(1, now))
+        if self._tokens is not None:
+            wait_s = max(wait_s, self._tokens.wait_s(n_tokens, now))
+        return wait_s
+
+    async def acquire(self, n_tokens: int, max_wait_s: Optional[float]=None)->float:
+        """Wait until a request of `n_tokens` can be made; return the wait"""
+        wait_s = await self._areserve(n_tokens=n_tokens, max_wait_s=max_wait_s)
+        if wait_s > 0:
+            await asyncio.sleep(wait_s)
+        return wait_s
+
+    def acquire_blocking(self, n_tokens: int, max_wait_s: Optional[float]=None)->float:
+        """Blocking counterpart of `acquire`"""
+        wait_s = self.reserve(n_tokens=n_tokens, max_wait_s=max_wait_s)
+        if wait_s > 0:
+            time.sleep(wait_s)
+        return wait_s
+
+    def correct(self, n_tokens_estimated: int, n_tokens: int)->None:
+        """Account for the actual token count of a request made with an
+        estimate"""
+        if self._tokens is None:
+            return
+        with self._lock:
+            self._tokens.give_back(n_tokens_estimated - n_tokens)
+
+    async def acorrect(self, n_tokens_estimated: int, n_tokens: int)->None:
+        """Async counterpart of `correct`"""
+        self.correct(n_tokens_estimated=n_tokens_estimated, n_tokens=n_tokens)
+
+    async def _areserve(self, n_tokens: int, max_wait_s: Optional[float])->float:
+        # In-memory buckets: quick enough to run on the event loop
+        return self.reserve(n_tokens=n_tokens, max_wait_s=max_wait_s)
+
+
+class SharedRateLimiter(RateLimiter):
+    """RateLimiter whose buckets are stored in the SQLite file at `path`, and
+    shared by all the processes using it
+
+    Each reservation is a read-modify-write of the buckets within an
+    exclusive transaction. Bucket times are wall-clock times, comparable
+    across processes.
+    """
+    _clock = staticmethod(time.time)
+
+    def __init__(self, path: str, requests_per_minute: Optional[int]=None,
+                 tokens_per_minute: Optional[int]=None, burst_s: float=10.)->None:
+        super().__init__(requests_per_minute=requests_per_minute,
+                         tokens_per_minute=tokens_per_minute, burst_s=burst_s)
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection_lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False,
+                                           isolation_level=None, timeout=30.)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limit_buckets ("
+            " name TEXT PRIMARY KEY,"
+            " level REAL NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+
+    def _buckets(self)->dict[str, TokenBucket]:
+        return {name: bucket for name, bucket in
+                [("requests", self._requests), ("tokens", self._tokens)]
+                if bucket is not None}
+
+    @contextmanager
+    def _shared_buckets(self)->Iterator[None]:
+        """Load the buckets, and store them back if no error occurred"""
+        with self._connection_lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                buckets = self._buckets()
+                rows = self._connection.execute(
+                    "SELECT name, level, updated_at FROM rate_limit_buckets"
+                ).fetchall()
+                for name, level, updated_at in rows:
+                    if name in buckets:
+                        buckets[name]._level = min(level, buckets[name].capacity)
+                        buckets[name]._updated_at = updated_at
+                yield
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO rate_limit_buckets VALUES (?, ?, ?)",
+                    [(n, b._level, b._updated_at) for n, b in buckets.items()],
+                )
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+
+    def reserve(self, n_tokens: int, max_wait_s: Optional[float]=None)->float:
+        with self._shared_buckets():
+            return super().reserve(n_tokens=n_tokens, max_wait_s=max_wait_s)
+
+    def correct(self, n_tokens_estimated: int, n_tokens: int)->None:
+        if self._tokens is None:
+            return
+        with self._shared_buckets():
+            super().correct(n_tokens_estimated=n_tokens_estimated, n_tokens=n_tokens)
+
+    async def acorrect(self, n_tokens_estimated: int, n_tokens: int)->None:
+        await asyncio.to_thread(self.correct, n_tokens_estimated=n_tokens_estimated,
+                                n_tokens=n_tokens)
+
+    async def _areserve(self, n_tokens: int, max_wait_s: Optional[float])->float:
+        # The transaction may wait for other processes: off the event loop
+        return await asyncio.to_thread(self.reserve, n_tokens=n_tokens, max_wait_s=max_wait_s)
+
+
+# =============
+# Single flight
+# =============
+@dataclass
+class _Flight:
+    """Execution shared by the callers of a key"""
+    task: Optional[asyncio.Task] = None
+    n_waiters: int = 0
+    # Streams: items so far, and event set (then replaced) on each new item
+    # and at the end
+    items: list = field(default_factory=list)
+    changed: asyncio.Event = field(default_factory=asyncio.Event)
+
+    def notify(self)->None:
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+
+class SingleFlight:
+    """Concurrent calls with the same key share one execution
+
+    The execution is cancelled if all its callers are cancelled. Executions
+    are shared within an event loop only.
+    """
+
+    def __init__(self)->None:
+        self._flights: dict[Hashable, _Flight] = {}
+        self.n_coalesced = 0
+
+    def _join(self, key: Hashable, start: Callable[[_Flight], Awaitable])->_Flight:
+        flight = self._flights.get(key)
+        if flight is not None and flight.task.get_loop() is asyncio.get_running_loop():
+            self.n_coalesced += 1
+        else:
+            flight = _Flight()
+            flight.task = asyncio.ensure_future(start(flight))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+        flight.n_waiters += 1
+        return flight
+
+    def _forget(self, key: Hashable, flight: _Flight)->None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    @staticmethod
+    def _leave(flight: _Flight)->None:
+        flight.n_waiters -= 1
+        if flight.n_waiters == 0 and not flight.task.done():
+            flight.task.cancel()
+
+    def is_in_flight(self, key: Hashable)->bool:
+        return key in self._flights
+
+    async def run(self, key: Hashable, func: Callable[[], Awaitable[T]])->T:
+        """Result of `func()`, or of the identical call in flight"""
+        async def start(_: _Flight)->T:
+            return await func()
+
+        flight = self._join(key, start)
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            self._leave(flight)
+
+    async def stream(self, key: Hashable,
+                     func: Callable[[], AsyncIterator[T]])->AsyncIterator[T]:
+        """Items of `func()`, or of the identical stream in flight (from its
+        first item)"""
+        async def start(flight: _Flight)->None:
+            try:
+                async for item in func():
+                    flight.items.append(item)
+                    flight.notify()
+            finally:
+                flight.notify()
+
+        flight = self._join(key, start)
+        try:
+            n_read = 0
+            while True:
+                changed = flight.changed
+                while n_read < len(flight.items):
+                    yield flight.items[n_read]
+                    n_read += 1
+                if flight.task.done():
+                    flight.task.result()  # Raise its error, if any
+                    return
+                await changed.wait()
+        finally:
+            self._leave(flight)
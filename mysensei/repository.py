@@ -0,0 +1,506 @@
+"""
+Database access: pooled engines, sessions and queries
+
+Connection settings are read from the [database] section of config.toml (see
+DatabaseConf.) PostgreSQL is used in deployment; any SQLAlchemy URL works,
+which lets tests run against SQLite.
+"""
+import json
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
+
+from sqlalchemy import Engine, create_engine, delete, event, insert, select, tuple_
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session, sessionmaker
+
+from mysensei.settings import SettingsError, get_settings
+from mysensei.sql import Base, ChangeLog, ReadingAssiociations, UserVersions, VocabNotesJp
+
+T = TypeVar("T")
+
+
+# =============
+# Configuration
+# =============
+@dataclass
+class DatabaseConf:
+    """Connection settings"""
+    url: str
+    async_url: Optional[str] = None
+    password: Optional[str] = None
+    pool_size: int = 5
+    max_overflow: int = 10
+    pool_timeout_s: float = 30.
+    statement_timeout_ms: int = 10000
+
+
+def get_database_conf()->DatabaseConf:
+    """Connection settings, from the [database] settings"""
+    settings = get_settings().database
+    if settings.url is None:
+        raise SettingsError("No database url in the [database] settings")
+    return DatabaseConf(**asdict(settings))
+
+
+# =======
+# Engines
+# =======
+def _engine_kwargs(url: str, conf: DatabaseConf)->dict:
+    """Pool and timeout arguments suited to the dialect and driver of `url`"""
+    url_obj = make_url(url)
+    if url_obj.get_backend_name() == "sqlite":
+        # No server-side statement timeout: use it as the wait on locks
+        kwargs = {"connect_args": {"timeout": conf.statement_timeout_ms / 1000}}
+        if url_obj.database in (None, "", ":memory:"):
+            # In-memory databases live in a single connection
+            return kwargs
+    elif url_obj.get_driver_name() == "asyncpg":
+        kwargs = {"connect_args": {"server_settings": {
+            "statement_timeout": str(conf.statement_timeout_ms)
+        }}}
+    else:
+        kwargs = {"connect_args": {
+            "options": f"-c statement_timeout={conf.statement_timeout_ms}"
+        }}
+    kwargs.update(
+        pool_size=conf.pool_size,
+        max_overflow=conf.max_overflow,
+        pool_timeout=conf.pool_timeout_s,
+        pool_pre_ping=True,
+    )
+    return kwargs
+
+
+def _with_password(url: str, password: Optional[str])->str:
+    """Fill out the password of `url`"""
+    if password is None:
+        return url
+    return make_url(url).set(password=password).render_as_string(hide_password=False)
+
+
+def create_db_engine(conf: DatabaseConf)->Engine:
+    """Create a pooled engine"""
+    url = _with_password(url=conf.url, password=conf.password)
+    return create_engine(url, **_engine_kwargs(url=url, conf=conf))
+
+
+def create_async_db_engine(conf: DatabaseConf)->AsyncEngine:
+    """Create a pooled engine for asyncio, from `conf.async_url`"""
+    if conf.async_url is None:
+        raise ValueError("No `async_url` in the database configuration")
+    url = _with_password(url=conf.async_url, password=conf.password)
+    return create_async_engine(url, **_engine_kwargs(url=url, conf=conf))
+
+
+_ENGINE: Optional[Engine] = None
+_ASYNC_ENGINE: Optional[AsyncEngine] = None
+
+
+def get_engine()->Engine:
+    """Process-wide engine, created from the configuration on first call"""
+    global _ENGINE
+    if _ENGINE is None:
+        _ENGINE = create_db_engine(conf=get_database_conf())
+    return _ENGINE
+
+
+def get_async_engine()->AsyncEngine:
+    """Process-wide asyncio engine, created from the configuration on first
+    call"""
+    global _ASYNC_ENGINE
+    if _ASYNC_ENGINE is None:
+        _ASYNC_ENGINE = create_async_db_engine(conf=get_database_conf())
+    return _ASYNC_ENGINE
+
+
+def init_db(engine: Engine)->None:
+    """Create missing tables"""
+    Base.metadata.create_all(engine)
+
+
+async def ainit_db(engine: AsyncEngine)->None:
+    """Create missing tables"""
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+
+
+@contextmanager
+def _transaction(maker: sessionmaker, session: Optional[Session])->Iterator[Session]:
+    """`session` if given (its owner commits it), else a new transaction"""
+    if session is not None:
+        yield session
+    else:
+        with maker.begin() as session:
+            yield session
+
+
+def _after_commit(session: Session, callback: Callable[[], None])->None:
+    """Call `callback` once the transaction of `session` is committed"""
+    event.listen(session, "after_commit", lambda _session: callback(), once=True)
+
+
+def _batched(items: Iterable[T], batch_size: int)->Iterator[list[T]]:
+    """Yield lists of at most `batch_size` items"""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def _dialect_insert(dialect_name: str, model: type[Base]):
+    """INSERT into `model`, with the ON CONFLICT clauses of the dialect"""
+    if dialect_name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect_name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise NotImplementedError(f"Upserts are not implemented for {dialect_name}")
+    return insert(model)
+
+
+def _upsert_statement(dialect_name: str, model: type[Base], rows: list[dict],
+                      update_columns: list[str]):
+    """INSERT ... ON CONFLICT (primary key) DO UPDATE for `rows`"""
+    statement = _dialect_insert(dialect_name=dialect_name, model=model).values(rows)
+    return statement.on_conflict_do_update(
+        index_elements=[c.name for c in model.__table__.primary_key.columns],
+        set_={c: statement.excluded[c] for c in update_columns},
+    )
+
+
+def _insert_new_statement(dialect_name: str, model: type[Base]):
+    """INSERT ... ON CONFLICT (primary key) DO NOTHING, executed with a list of
+    rows (an executemany: big multi-row VALUES are slow to compile)"""
+    return _dialect_insert(dialect_name=dialect_name, model=model).on_conflict_do_nothing(
+        index_elements=[c.name for c in model.__table__.primary_key.columns],
+    )
+
+
+# ==========
+# Change log
+# ==========
+@dataclass(frozen=True)
+class Change:
+    """A change to one row of a user's data"""
+    entity: str
+    entity_key: tuple
+    op: str  # "upsert" or "delete"
+    payload: Optional[dict] = None
+
+
+def _reserve_versions(session: Session, user_id: int, n: int)->int:
+    """Increment the user's version by `n`, and return the first reserved
+    version. A single upsert, so that concurrent first writers of a user do not
+    race on the insert; its row lock orders concurrent writers."""
+    statement = _dialect_insert(dialect_name=session.get_bind().dialect.name,
+                                model=UserVersions).values(user_id=user_id, version=n)
+    last_version = session.execute(
+        statement.on_conflict_do_update(
+            index_elements=[UserVersions.user_id],
+            set_={"version": UserVersions.version + n},
+        ).returning(UserVersions.version)
+    ).scalar_one()
+    return last_version - n + 1
+
+
+def record_changes(session: Session, user_id: int, changes: list[Change])->None:
+    """Append `changes` to the user's change log, with consecutive versions,
+    within the transaction of `session`"""
+    if len(changes) == 0:
+        return
+    first_version = _reserve_versions(session=session, user_id=user_id, n=len(changes))
+    session.execute(insert(ChangeLog), [
+        {"user_id": user_id, "version": first_version + i, "entity": c.entity,
+         "entity_key": json.dumps(list(c.entity_key), ensure_ascii=False),
+         "op": c.op,
+         "payload": None if c.payload is None else json.dumps(c.payload, ensure_ascii=False)}
+        for i, c in enumerate(changes)
+    ])
+
+
+def get_user_version(session: Session, user_id: int)->int:
+    """Last version of the user's data (0 if never changed)"""
+    version = session.scalar(
+        select(UserVersions.version).where(UserVersions.user_id == user_id)
+    )
+    return 0 if version is None else version
+
+
+# ====================
+# Reading associations
+# ====================
+@dataclass(frozen=True)
+class ReadingAssociation:
+    """A sound paired with a concept (and a description of how to picture it)"""
+    sound: str
+    concept: str
+    descriptor: str = ""
+
+
+READING_ASSOCIATION_ENTITY = "reading_association"
+# Called with (user id, upserted associations, deleted associations) once
+# changes are committed
+AssociationsListener = Callable[
+    [int, list[ReadingAssociation], list[ReadingAssociation]], None
+]
+
+
+def _association_rows(user_id: int, batch: list[ReadingAssociation])->list[dict]:
+    """Rows of the reading_associations_jp table, the last association winning
+    for duplicate keys (a statement cannot upsert the same row twice)"""
+    rows = {
+        (a.sound, a.concept): {"user_id": user_id, "sound": a.sound,
+                               "concept": a.concept, "descriptor": a.descriptor}
+        for a in batch
+    }
+    return list(rows.values())
+
+
+def _association_change(association: ReadingAssociation, op: str)->Change:
+    """Change-log entry for an upserted or deleted association"""
+    return Change(
+        entity=READING_ASSOCIATION_ENTITY,
+        entity_key=(association.sound, association.concept),
+        op=op,
+        payload=None if op == "delete" else {
+            "sound": association.sound, "concept": association.concept,
+            "descriptor": association.descriptor,
+        },
+    )
+
+
+def _delete_statement(user_id: int, batch: list[ReadingAssociation]):
+    """DELETE of the user's associations matching `batch` on sound and
+    concept, returning the deleted rows"""
+    return (
+        delete(ReadingAssiociations)
+        .where(ReadingAssiociations.user_id == user_id)
+        .where(tuple_(ReadingAssiociations.sound, ReadingAssiociations.concept)
+               .in_([(a.sound, a.concept) for a in batch]))
+        .returning(ReadingAssiociations.sound, ReadingAssiociations.concept,
+                   ReadingAssiociations.descriptor)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _to_association(row: ReadingAssiociations)->ReadingAssociation:
+    return ReadingAssociation(sound=row.sound, concept=row.concept,
+                              descriptor=row.descriptor)
+
+
+class ReadingAssociationsRepository:
+    """Queries on the reading associations of users
+
+    Every change is recorded in the user's change log, in the same
+    transaction. Listeners added with `add_listener` are notified of committed
+    changes (e.g., to keep in-memory indexes up to date.)
+    """
+
+    def __init__(self, engine: Engine, batch_size: int=1000)->None:
+        self.engine = engine
+        self.batch_size = batch_size
+        self.sessionmaker = sessionmaker(bind=engine)
+        self.listeners: list[AssociationsListener] = []
+
+    def add_listener(self, listener: AssociationsListener)->None:
+        """Call `listener` after each committed change"""
+        self.listeners.append(listener)
+
+    def upsert(self, user_id: int, associations: Iterable[ReadingAssociation],
+               session: Optional[Session]=None)->int:
+        """Insert associations, or update the descriptor of existing ones.
+
+        Rows are sent `batch_size` at a time, in a single transaction (that of
+        `session`, if given; listeners are then notified once it is committed.)
+        Return the number of associations written."""
+        written = []
+        with _transaction(self.sessionmaker, session=session) as session:
+            for batch in _batched(associations, batch_size=self.batch_size):
+                session.execute(_upsert_statement(
+                    dialect_name=self.engine.dialect.name,
+                    model=ReadingAssiociations,
+                    rows=(rows := _association_rows(user_id=user_id, batch=batch)),
+                    update_columns=["descriptor"],
+                ))
+                written.extend(ReadingAssociation(sound=r["sound"], concept=r["concept"],
+                                                  descriptor=r["descriptor"])
+                               for r in rows)
+            record_changes(session=session, user_id=user_id, changes=[
+                _association_change(association=a, op="upsert") for a in written
+            ])
+            _after_commit(session, lambda: self._notify(user_id, written, []))
+        return len(written)
+
+    def delete(self, user_id: int, associations: Iterable[ReadingAssociation])->int:
+        """Delete associations (matched on sound and concept.) Return the
+        number of deleted rows: only those are logged and notified."""
+        deleted = []
+        with self.sessionmaker.begin() as session:
+            for batch in _batched(associations, batch_size=self.batch_size):
+                result = session.execute(_delete_statement(user_id=user_id, batch=batch))
+                deleted.extend(_to_association(row) for row in result)
+            record_changes(session=session, user_id=user_id, changes=[
+                _association_change(association=a, op="delete") for a in deleted
+            ])
+        if len(deleted) > 0:
+            self._notify(user_id, [], deleted)
+        return len(deleted)
+
+    def _notify(self, user_id: int, written: list[ReadingAssociation],
+                deleted: list[ReadingAssociation])->None:
+        for listener in self.listeners:
+            listener(user_id, written, deleted)
+
+    def get_by_user(self, user_id: int)->list[ReadingAssociation]:
+        """All associations of a user"""
+        with self.sessionmaker() as session:
+            rows = session.scalars(
+                select(ReadingAssiociations)
+                .where(ReadingAssiociations.user_id == user_id)
+                .order_by(ReadingAssiociations.sound, ReadingAssiociations.concept)
+            )
+            return [_to_association(row) for row in rows]
+
+
+class AsyncReadingAssociationsRepository:
+    """asyncio counterpart of ReadingAssociationsRepository, with the same
+    change log and listeners (e.g., pass the `on_associations_change` of a
+    SoundTrieIndex to `add_listener`)"""
+
+    def __init__(self, engine: AsyncEngine, batch_size: int=1000)->None:
+        self.engine = engine
+        self.batch_size = batch_size
+        self.sessionmaker = async_sessionmaker(bind=engine)
+        self.listeners: list[AssociationsListener] = []
+
+    def add_listener(self, listener: AssociationsListener)->None:
+        """Call `listener` after each committed change"""
+        self.listeners.append(listener)
+
+    async def upsert(self, user_id: int, associations: Iterable[ReadingAssociation])->int:
+        """See ReadingAssociationsRepository.upsert"""
+        written = []
+        async with self.sessionmaker.begin() as session:
+            for batch in _batched(associations, batch_size=self.batch_size):
+                await session.execute(_upsert_statement(
+                    dialect_name=self.engine.dialect.name,
+                    model=ReadingAssiociations,
+                    rows=(rows := _association_rows(user_id=user_id, batch=batch)),
+                    update_columns=["descriptor"],
+                ))
+                written.extend(ReadingAssociation(sound=r["sound"], concept=r["concept"],
+                                                  descriptor=r["descriptor"])
+                               for r in rows)
+            changes = [_association_change(association=a, op="upsert") for a in written]
+            await session.run_sync(
+                lambda sync_session: record_changes(
+                    session=sync_session, user_id=user_id, changes=changes
+                )
+            )
+        for listener in self.listeners:
+            listener(user_id, written, [])
+        return len(written)
+
+    async def delete(self, user_id: int, associations: Iterable[ReadingAssociation])->int:
+        """See ReadingAssociationsRepository.delete"""
+        deleted = []
+        async with self.sessionmaker.begin() as session:
+            for batch in _batched(associations, batch_size=self.batch_size):
+                result = await session.execute(_delete_statement(user_id=user_id, batch=batch))
+                deleted.extend(_to_association(row) for row in result)
+            changes = [_association_change(association=a, op="delete") for a in deleted]
+            await session.run_sync(
+                lambda sync_session: record_changes(
+                    session=sync_session, user_id=user_id, changes=changes
+                )
+            )
+        if len(deleted) > 0:
+            for listener in self.listeners:
+                listener(user_id, [], deleted)
+        return len(deleted)
+
+    async def get_by_user(self, user_id: int)->list[ReadingAssociation]:
+        """See ReadingAssociationsRepository.get_by_user"""
+        async with self.sessionmaker() as session:
+            rows = await session.scalars(
+                select(ReadingAssiociations)
+                .where(ReadingAssiociations.user_id == user_id)
+                .order_by(ReadingAssiociations.sound, ReadingAssiociations.concept)
+            )
+            return [_to_association(row) for row in rows]
+
+
+# ===========
+# Vocab notes
+# ===========
+@dataclass(frozen=True)
+class VocabNote:
+    """A word to learn"""
+    lemma: str
+    reading: str = ""
+    meanings: tuple[str, ...] = ()
+    count: Optional[int] = None
+
+
+def _note_rows(user_id: int, batch: list[VocabNote])->list[dict]:
+    """Rows of the vocab_notes_jp table, the first note winning for duplicate
+    lemmas"""
+    rows = {}
+    for note in batch:
+        rows.setdefault(note.lemma, {
+            "user_id": user_id, "lemma": note.lemma, "reading": note.reading,
+            "meanings": json.dumps(list(note.meanings), ensure_ascii=False),
+            "count": note.count,
+        })
+    return list(rows.values())
+
+
+class VocabNotesRepository:
+    """Queries on the vocabulary notes of users"""
+
+    def __init__(self, engine: Engine, batch_size: int=1000)->None:
+        self.engine = engine
+        self.batch_size = batch_size
+        self.sessionmaker = sessionmaker(bind=engine)
+
+    def insert_new(self, user_id: int, notes: Iterable[VocabNote],
+                   session: Optional[Session]=None)->int:
+        """Insert the notes whose lemma the user does not have yet (existing
+        notes are left as they are), in a single transaction (that of
+        `session`, if given). Return the number of notes inserted."""
+        n_inserted = 0
+        statement = _insert_new_statement(dialect_name=self.engine.dialect.name,
+                                          model=VocabNotesJp)
+        with _transaction(self.sessionmaker, session=session) as session:
+            for batch in _batched(notes, batch_size=self.batch_size):
+                rows = _note_rows(user_id=user_id, batch=batch)
+                existing = set(session.scalars(
+                    select(VocabNotesJp.lemma)
+                    .where(VocabNotesJp.user_id == user_id)
+                    .where(VocabNotesJp.lemma.in_([r["lemma"] for r in rows]))
+                ))
+                rows = [r for r in rows if r["lemma"] not in existing]
+                if len(rows) > 0:
+                    # Core executemany: the ORM bulk path is slower
+                    session.connection().execute(statement, rows)
+                n_inserted += len(rows)
+        return n_inserted
+
+    def get_by_user(self, user_id: int)->list[VocabNote]:
+        """All notes of a user, by lemma"""
+        with self.sessionmaker() as session:
+            rows = session.scalars(
+                select(VocabNotesJp)
+                .where(VocabNotesJp.user_id == user_id)
+                .order_by(VocabNotesJp.lemma)
+            )
+            return [VocabNote(lemma=row.lemma, reading=row.reading or "",
+                              meanings=tuple(json.loads(row.meanings or "[]")),
+                              count=row.count)
+                    for row in rows]
@@ -0,0 +1,346 @@
+"""
+Generation results of a session
+
+Each session keeps its most recent results in memory, as compact immutable
+records, and spills older ones to a local SQLite store from which they are
+loaded back on demand. With several worker processes, results are written
+through to a SessionStore shared by the workers, from which a session can be
+restored by any of them.
+"""
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Optional
+
+from mysensei.annotations import ComponentConcept, GeneratedText, TargetConcept
+
+
+@dataclass
+class TCConcepts:
+    """
+    Associate a Target concept (to learn,) with Component concepts (available
+    at the time of recall.)
+    """
+    target_concept: TargetConcept
+    component_concepts: list[ComponentConcept]
+
+    def no_target_concept(self)->bool:
+        return (self.target_concept == "")
+
+    def no_component_concept(self)->bool:
+        return all(c == "" for c in self.component_concepts)
+
+    def nonempty_component_concepts(self)->list[ComponentConcept]:
+        return [c  for c in self.component_concepts if c != ""]
+
+
+@dataclass(frozen=True, slots=True)
+class TCResult:
+    """Generation result for Target/Component mnemonic
+
+    Immutable snapshot of the concepts at generation time. Concepts are
+    interned, so that results sharing them (e.g., alternatives) share memory.
+    """
+    target_concept: TargetConcept
+    component_concepts: tuple[ComponentConcept, ...]
+    mnemonic: GeneratedText
+    revisions: tuple[GeneratedText, ...] = ()
+
+    @classmethod
+    def from_concepts(cls, tc_concepts: TCConcepts, mnemonic: GeneratedText,
+                      revisions: tuple[GeneratedText, ...]=())->"TCResult":
+        """Snapshot `tc_concepts` (which may be modified afterwards)"""
+        return cls(
+            target_concept=sys.intern(tc_concepts.target_concept),
+            component_concepts=tuple(
+                sys.intern(c) for c in tc_concepts.nonempty_component_concepts()
+            ),
+            mnemonic=mnemonic,
+            revisions=revisions,
+        )
+
+    def to_json(self)->str:
+        return json.dumps([self.target_concept, self.component_concepts,
+                           self.mnemonic, self.revisions], ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, s: str)->"TCResult":
+        target_concept, component_concepts, mnemonic, revisions = json.loads(s)
+        return cls(
+            target_concept=sys.intern(target_concept),
+            component_concepts=tuple(sys.intern(c) for c in component_concepts),
+            mnemonic=mnemonic,
+            revisions=tuple(revisions),
+        )
+
+    def memory_usage(self)->int:
+        """Approximate size in bytes (shared interned strings included)"""
+        return (
+            sys.getsizeof(self)
+            + sys.getsizeof(self.target_concept)
+            + sys.getsizeof(self.component_concepts)
+            + sum(sys.getsizeof(c) for c in self.component_concepts)
+            + sys.getsizeof(self.mnemonic)
+            + sys.getsizeof(self.revisions)
+            + sum(sys.getsizeof(r) for r in self.revisions)
+        )
+
+
+class SpillStore:
+    """Local SQLite store of the results evicted from session windows"""
+
+    def __init__(self, path: str)->None:
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False,
+                                           isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=OFF")  # Disposable data
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS spilled_results ("
+            " session_id TEXT NOT NULL,"
+            " idx INTEGER NOT NULL,"
+            " result TEXT NOT NULL,"
+            " PRIMARY KEY (session_id, idx))"
+        )
+
+    def put(self, session_id: str, idx: int, result: TCResult)->None:
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO spilled_results VALUES (?, ?, ?)",
+                (session_id, idx, result.to_json()),
+            )
+
+    def get(self, session_id: str, idx: int)->TCResult:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT result FROM spilled_results WHERE session_id = ? AND idx = ?",
+                (session_id, idx),
+            ).fetchone()
+        if row is None:
+            raise IndexError(f"No result {idx} for session {session_id}")
+        return TCResult.from_json(row[0])
+
+    def drop_session(self, session_id: str)->None:
+        with self._lock:
+            self._connection.execute(
+                "DELETE FROM spilled_results WHERE session_id = ?", (session_id,)
+            )
+
+    def destroy(self)->None:
+        """Close and delete the store"""
+        with self._lock:
+            self._connection.close()
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+
+class SessionStore(SpillStore):
+    """Store of all the results of the sessions, shared by the processes using
+    the same file, and kept until pruned
+
+    Sessions are keyed by something stable across reconnections (e.g., the
+    browser id), so that a session can be restored by another process.
+    """
+
+    def __init__(self, path: str)->None:
+        super().__init__(path=path)
+        self._connection.execute("PRAGMA synchronous=NORMAL")  # Not disposable
+        self._connection.execute("PRAGMA busy_timeout=30000")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS session_activity ("
+            " session_id TEXT PRIMARY KEY,"
+            " n_results INTEGER NOT NULL,"
+            " touched_at REAL NOT NULL)"
+        )
+
+    def put(self, session_id: str, idx: int, result: TCResult)->None:
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            self._connection.execute(
+                "INSERT OR REPLACE INTO spilled_results VALUES (?, ?, ?)",
+                (session_id, idx, result.to_json()),
+            )
+            self._connection.execute(
+                "INSERT INTO session_activity VALUES (?, ?, ?)"
+                " ON CONFLICT (session_id) DO UPDATE SET"
+                " n_results = MAX(n_results, excluded.n_results),"
+                " touched_at = excluded.touched_at",
+                (session_id, idx + 1, time.time()),
+            )
+            self._connection.execute("COMMIT")
+
+    def append(self, session_id: str, result: TCResult)->int:
+        """Add a result after the session's last one, and return its index
+        (allocated in the write's transaction: the pages of a session can
+        append concurrently)"""
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            idx = self._connection.execute(
+                "SELECT COALESCE(MAX(n_results), 0) FROM session_activity"
+                " WHERE session_id = ?",
+                (session_id,),
+            ).fetchone()[0]
+            self._connection.execute(
+                "INSERT OR REPLACE INTO spilled_results VALUES (?, ?, ?)",
+                (session_id, idx, result.to_json()),
+            )
+            self._connection.execute(
+                "INSERT INTO session_activity VALUES (?, ?, ?)"
+                " ON CONFLICT (session_id) DO UPDATE SET"
+                " n_results = excluded.n_results, touched_at = excluded.touched_at",
+                (session_id, idx + 1, time.time()),
+            )
+            self._connection.execute("COMMIT")
+        return idx
+
+    def count(self, session_id: str)->int:
+        """Number of results of the session"""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT n_results FROM session_activity WHERE session_id = ?",
+                (session_id,),
+            ).fetchone()
+        return 0 if row is None else row[0]
+
+    def get_from(self, session_id: str, start_idx: int)->list[TCResult]:
+        """Results `start_idx` and following of the session"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT result FROM spilled_results WHERE session_id = ? AND idx >= ?"
+                " ORDER BY idx",
+                (session_id, start_idx),
+            ).fetchall()
+        return [TCResult.from_json(row[0]) for row in rows]
+
+    def drop_session(self, session_id: str)->None:
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            self._connection.execute(
+                "DELETE FROM spilled_results WHERE session_id = ?", (session_id,)
+            )
+            self._connection.execute(
+                "DELETE FROM session_activity WHERE session_id = ?", (session_id,)
+            )
+            self._connection.execute("COMMIT")
+
+    def prune(self, max_age_s: float)->int:
+        """Drop the sessions without new result for `max_age_s` seconds;
+        return their number"""
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            session_ids = [row[0] for row in self._connection.execute(
+                "SELECT session_id FROM session_activity WHERE touched_at < ?",
+                (time.time() - max_age_s,),
+            )]
+            self._connection.executemany(
+                "DELETE FROM spilled_results WHERE session_id = ?",
+                [(s,) for s in session_ids],
+            )
+            self._connection.executemany(
+                "DELETE FROM session_activity WHERE session_id = ?",
+                [(s,) for s in session_ids],
+            )
+            self._connection.execute("COMMIT")
+        return len(session_ids)
+
+
+@dataclass
+class TCResults:
+    """list of generation results
+
+    Only the last `window_size` results are held in memory; older ones are
+    moved to `spill_store` (or dropped, if there is none) and read back when
+    accessed. With a SessionStore, every result is written to it as soon as
+    added or replaced (see `restore`), and the results added by the other
+    pages of the session are picked up on the next addition.
+    """
+    session_id: str = ""
+    window_size: int = 20
+    spill_store: Optional[SpillStore] = None
+    _window: deque = field(default_factory=deque)
+    _len: int = 0
+
+    @classmethod
+    def restore(cls, session_id: str, window_size: int,
+                spill_store: SessionStore)->"TCResults":
+        """Results of the session held by `spill_store` (none if unknown)"""
+        n_results = spill_store.count(session_id=session_id)
+        window = spill_store.get_from(session_id=session_id,
+                                      start_idx=max(0, n_results - window_size))
+        return cls(session_id=session_id, window_size=window_size, spill_store=spill_store,
+                   _window=deque(window), _len=n_results)
+
+    def _writes_through(self)->bool:
+        return isinstance(self.spill_store, SessionStore)
+
+    def add_result(self, tc_result: TCResult)->int:
+        """Add a result, and return its index"""
+        if self._writes_through():
+            idx = self.spill_store.append(session_id=self.session_id, result=tc_result)
+            if idx != self._len:  # Other pages of the session added results
+                self._resync(n_results=idx + 1)
+                return idx
+        self._window.append(tc_result)
+        self._len += 1
+        if len(self._window) > self.window_size:
+            spilled = self._window.popleft()
+            if self.spill_store is not None and not self._writes_through():
+                self.spill_store.put(session_id=self.session_id,
+                                     idx=self._len - len(self._window) - 1,
+                                     result=spilled)
+        return self._len - 1
+
+    def _resync(self, n_results: int)->None:
+        """Reload the window of the first `n_results` results from the store"""
+        start_idx = max(0, n_results - self.window_size)
+        window = self.spill_store.get_from(session_id=self.session_id, start_idx=start_idx)
+        self._window = deque(window[:n_results - start_idx])
+        self._len = n_results
+
+    def get_result(self, idx: int)->TCResult:
+        if self._len == 0:
+            return ""
+        idx = self._check_idx(idx)
+        window_start = self._len - len(self._window)
+        if idx >= window_start:
+            return self._window[idx - window_start]
+        if self.spill_store is None:
+            raise IndexError(f"Result {idx} was dropped from memory")
+        return self.spill_store.get(session_id=self.session_id, idx=idx)
+
+    def set_result(self, idx: int, tc_result: TCResult)->None:
+        """Replace result `idx` (e.g., by a revised copy)"""
+        idx = self._check_idx(idx)
+        window_start = self._len - len(self._window)
+        if idx >= window_start:
+            self._window[idx - window_start] = tc_result
+        if (idx < window_start and self.spill_store is not None) or self._writes_through():
+            self.spill_store.put(session_id=self.session_id, idx=idx, result=tc_result)
+
+    def len(self)->int:
+        return self._len
+
+    def memory_usage(self)->int:
+        """Approximate size in bytes of the in-memory results"""
+        return sys.getsizeof(self._window) + sum(r.memory_usage() for r in self._window)
+
+    def close(self)->None:
+        """Drop spilled results (once the session is over)"""
+        if self.spill_store is not None:
+            self.spill_store.drop_session(session_id=self.session_id)
+
+    def _check_idx(self, idx: int)->int:
+        """Turn negative indexes into positive ones, and check bounds"""
+        if idx < 0:
+            idx += self._len
+        if not 0 <= idx < self._len:
+            raise IndexError(f"Result index {idx} out of range")
+        return idx
@@ -0,0 +1,155 @@
+"""
+Segmentation of readings into sounds the user already has associations for
+
+Each user's reading associations are indexed in a trie of their sounds. A
+reading (e.g., "はっか") is then split into the fewest known sounds (e.g.,
+"はっ" + "か"), so that the matching concepts can be suggested.
+"""
+from dataclasses import dataclass
+from typing import Optional
+
+from mysensei.repository import ReadingAssociation, ReadingAssociationsRepository
+
+
+@dataclass(frozen=True)
+class Segment:
+    """A piece of a reading, with the associations known for it (none if the
+    sound is unknown to the user)"""
+    sound: str
+    associations: tuple[ReadingAssociation, ...] = ()
+
+    def is_known(self)->bool:
+        return len(self.associations) > 0
+
+
+class _TrieNode:
+    __slots__ = ("children", "associations")
+
+    def __init__(self)->None:
+        self.children: dict[str, "_TrieNode"] = {}
+        # Associations whose sound ends at this node, keyed by concept
+        self.associations: dict[str, ReadingAssociation] = {}
+
+
+class SoundTrie:
+    """Prefix tree of the sounds of reading associations"""
+
+    def __init__(self, associations: Optional[list[ReadingAssociation]]=None)->None:
+        self._root = _TrieNode()
+        self.n_associations = 0
+        for association in associations or []:
+            self.add(association)
+
+    def add(self, association: ReadingAssociation)->None:
+        """Add an association, or replace the one with same sound and concept"""
+        node = self._root
+        for char in association.sound:
+            node = node.children.setdefault(char, _TrieNode())
+        if association.concept not in node.associations:
+            self.n_associations += 1
+        node.associations[association.concept] = association
+
+    def remove(self, association: ReadingAssociation)->None:
+        """Remove the association with same sound and concept, if any"""
+        path = [self._root]
+        for char in association.sound:
+            child = path[-1].children.get(char)
+            if child is None:
+                return
+            path.append(child)
+        if path[-1].associations.pop(association.concept, None) is None:
+            return
+        self.n_associations -= 1
+        # Prune branches left without associations
+        for char, parent, node in zip(reversed(association.sound),
+                                      reversed(path[:-1]), reversed(path[1:])):
+            if node.children or node.associations:
+                break
+            del parent.children[char]
+
+    def get(self, sound: str)->tuple[ReadingAssociation, ...]:
+        """Associations for exactly `sound`"""
+        node = self._root
+        for char in sound:
+            node = node.children.get(char)
+            if node is None:
+                return ()
+        return tuple(node.associations.values())
+
+    def segment(self, reading: str)->list[Segment]:
+        """Split `reading` into the fewest known sounds
+
+        Characters that no known sound covers become one-character unknown
+        segments; covers with fewer unknown characters are always preferred,
+        then covers with fewer segments.
+        """
+        n = len(reading)
+        # best[i]: (n unknown chars, n segments) of the best cover of reading[:i],
+        # and the start of its last segment
+        best: list[Optional[tuple[int, int]]] = [None] * (n + 1)
+        last_start = [0] * (n + 1)
+        best[0] = (0, 0)
+        for start in range(n):
+            if best[start] is None:
+                continue
+            n_unknown, n_segments = best[start]
+            # Known sounds starting at `start`
+            node = self._root
+            end = start
+            while end < n and (node := node.children.get(reading[end])) is not None:
+                end += 1
+                if node.associations:
+                    candidate = (n_unknown, n_segments + 1)
+                    if best[end] is None or candidate < best[end]:
+                        best[end], last_start[end] = candidate, start
+            # Unknown character
+            candidate = (n_unknown + 1, n_segments + 1)
+            if best[start + 1] is None or candidate < best[start + 1]:
+                best[start + 1], last_start[start + 1] = candidate, start
+        # Walk back from the end
+        segments = []
+        end = n
+        while end > 0:
+            start = last_start[end]
+            sound = reading[start:end]
+            segments.append(Segment(sound=sound, associations=self.get(sound)))
+            end = start
+        return segments[::-1]
+
+
+class SoundTrieIndex:
+    """Per-user sound tries, loaded on first use and kept up to date with the
+    changes made through `repository`"""
+
+    def __init__(self, repository: ReadingAssociationsRepository)->None:
+        self.repository = repository
+        self._tries: dict[int, SoundTrie] = {}
+        repository.add_listener(self.on_associations_change)
+
+    def get_trie(self, user_id: int)->SoundTrie:
+        """Trie of the user's sounds"""
+        trie = self._tries.get(user_id)
+        if trie is None:
+            trie = self._tries[user_id] = SoundTrie(
+                associations=self.repository.get_by_user(user_id=user_id)
+            )
+        return trie
+
+    def segment(self, user_id: int, reading: str)->list[Segment]:
+        """See SoundTrie.segment"""
+        return self.get_trie(user_id=user_id).segment(reading=reading)
+
+    def on_associations_change(
+        self,
+        user_id: int,
+        upserted: list[ReadingAssociation],
+        deleted: list[ReadingAssociation],
+    )->None:
+        """Apply committed changes to the user's trie, if loaded"""
+        trie = self._tries.get(user_id)
+        if trie is None:
+            return
+        for association in deleted:
+            trie.remove(association)
+        for association in upserted:
+            trie.add(association)
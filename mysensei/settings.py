@@ -0,0 +1,217 @@
+"""
+Typed settings of the library and apps
+
+Settings are read on first use (not at import time), from config.toml then
+secrets.toml in the configuration folder (both optional; see
+mysensei.io.get_config_path), and overridden by environment variables named
+MYSENSEI__<SECTION>__<KEY>, e.g.:
+    MYSENSEI__GENERATION__BACKEND=fake
+    MYSENSEI__DATABASE__POOL_SIZE=10
+Environment values of non-str settings are parsed as TOML values (10 is an
+int, true a bool.)
+"""
+import os
+import tomllib
+from dataclasses import dataclass, field, fields
+from typing import Any, Mapping, Optional, Union, get_args, get_origin, get_type_hints
+
+import mysensei.io as ms_io
+
+ENV_PREFIX = "MYSENSEI__"
+# Configuration files, later ones taking precedence
+CONF_FILENAMES = ("config.toml", "secrets.toml")
+
+
+class SettingsError(Exception):
+    """A setting is unknown, or of the wrong type"""
+    pass
+
+
+# ========
+# Sections
+# ========
+@dataclass(frozen=True)
+class DatabaseSettings:
+    """[database]: SQLAlchemy URLs and connection pool"""
+    url: Optional[str] = None
+    async_url: Optional[str] = None
+    password: Optional[str] = None  # In secrets.toml
+    pool_size: int = 5
+    max_overflow: int = 10
+    pool_timeout_s: float = 30.
+    statement_timeout_ms: int = 10000
+
+
+@dataclass(frozen=True)
+class GenerationSettings:
+    """[generation]: where completions come from (see
+    mysensei.generation.backend_from_conf)"""
+    backend: str = "openai"
+    model: str = "gpt-4"
+    api_base: Optional[str] = None
+    api_key: Optional[str] = None
+    # Quotas of the process (no limit if None; see mysensei.ratelimit)
+    requests_per_minute: Optional[int] = None
+    tokens_per_minute: Optional[int] = None
+    # Completion length assumed by the tokens/min quota, until the actual one
+    # is known
+    expected_completion_tokens: int = 256
+
+
+@dataclass(frozen=True)
+class FewShotSettings:
+    """[few_shot]: examples added to the prompts of the templates that take
+    some (see mysensei.fewshot)"""
+    k: int = 2
+    max_prompt_tokens: int = 640
+
+
+@dataclass(frozen=True)
+class ServerSettings:
+    """[server]: web app process(es) (see mysensei.launcher)"""
+    host: Optional[str] = None  # All interfaces if None
+    port: int = 8080
+    reload: bool = True  # Restart on code changes (development)
+    # Worker processes started by mysensei.launcher
+    workers: int = 1
+    # SQLite file of the state shared by the workers (sessions' results, rate
+    # limits); in-process state if None
+    shared_state_path: Optional[str] = None
+    # Sessions without new result for that long are dropped from the shared
+    # state
+    session_ttl_s: float = 7 * 24 * 3600.
+
+
+@dataclass(frozen=True)
+class JobsSettings:
+    """[jobs]: queue of generation jobs (see mysensei.jobs)"""
+    # SQLite file of the jobs; the [server] shared_state_path, or a file of
+    # the cache folder, if None
+    path: Optional[str] = None
+    # Jobs run concurrently by each process running them
+    workers: int = 4
+    # Dedicated processes started by mysensei.launcher; the app processes run
+    # the jobs if 0
+    processes: int = 0
+    max_attempts: int = 3
+    # Delay before the first retry, doubled on each attempt
+    retry_delay_s: float = 2.
+    # A job still running after that long is taken over by another worker
+    lease_s: float = 240.
+    poll_interval_s: float = 0.5
+    # Done and dead jobs are dropped after that long
+    retention_s: float = 7 * 24 * 3600.
+
+
+@dataclass(frozen=True)
+class OpenAISettings:
+    """[open_ai]"""
+    api_key: Optional[str] = None  # In secrets.toml
+
+
+@dataclass(frozen=True)
+class CookiesSettings:
+    """[cookies]"""
+    storage_secret: Optional[str] = None  # In secrets.toml
+
+
+@dataclass(frozen=True)
+class Settings:
+    """All settings, by section"""
+    database: DatabaseSettings = field(default_factory=DatabaseSettings)
+    generation: GenerationSettings = field(default_factory=GenerationSettings)
+    few_shot: FewShotSettings = field(default_factory=FewShotSettings)
+    server: ServerSettings = field(default_factory=ServerSettings)
+    jobs: JobsSettings = field(default_factory=JobsSettings)
+    open_ai: OpenAISettings = field(default_factory=OpenAISettings)
+    cookies: CookiesSettings = field(default_factory=CookiesSettings)
+
+
+# =======
+# Loading
+# =======
+def _allowed_types(section_class: type, key: str)->tuple[type, ...]:
+    hint = get_type_hints(section_class)[key]
+    types = get_args(hint) if get_origin(hint) is Union else (hint,)
+    return tuple(t for t in types if t is not type(None))
+
+
+def _checked(section_class: type, section: str, key: str, value: Any)->Any:
+    """`value`, if it fits setting `key` of the section"""
+    if key not in {f.name for f in fields(section_class)}:
+        raise SettingsError(f"Unknown setting {key} in [{section}]")
+    types = _allowed_types(section_class, key)
+    if type(value) is int and float in types:
+        value = float(value)
+    if type(value) not in types:
+        raise SettingsError(
+            f"[{section}] {key} should be {' or '.join(t.__name__ for t in types)},"
+            f" got {value!r}"
+        )
+    return value
+
+
+def _parse_env_value(section_class: type, key: str, value: str)->Any:
+    if key not in {f.name for f in fields(section_class)} \
+            or str in _allowed_types(section_class, key):
+        return value
+    try:
+        return tomllib.loads(f"value = {value}")["value"]
+    except tomllib.TOMLDecodeError:
+        return value  # Rejected by the type check
+
+
+def load_settings(config_path: Optional[str]=None,
+                  environ: Optional[Mapping[str, str]]=None)->Settings:
+    """Read the settings from the configuration files in `config_path` and
+    the `environ` overrides; raise SettingsError on unknown or mistyped
+    settings"""
+    config_path = ms_io.get_config_path() if config_path is None else config_path
+    environ = os.environ if environ is None else environ
+    section_classes = {f.name: f.default_factory for f in fields(Settings)}
+    values: dict[str, dict[str, Any]] = {section: {} for section in section_classes}
+    for filename in CONF_FILENAMES:
+        filepath = os.path.join(config_path, filename)
+        if not os.path.isfile(filepath):
+            continue
+        with open(filepath, "rb") as f:
+            conf = tomllib.load(f)
+        for section, section_conf in conf.items():
+            if section not in section_classes:
+                raise SettingsError(f"Unknown section [{section}] in {filename}")
+            for key, value in section_conf.items():
+                values[section][key] = _checked(section_classes[section], section=section,
+                                                key=key, value=value)
+    for name, value in environ.items():
+        if not name.startswith(ENV_PREFIX):
+            continue
+        section, _, key = name[len(ENV_PREFIX):].lower().partition("__")
+        if section not in section_classes:
+            raise SettingsError(f"Unknown section [{section}] in ${name}")
+        section_class = section_classes[section]
+        values[section][key] = _checked(
+            section_class, section=section, key=key,
+            value=_parse_env_value(section_class, key=key, value=value),
+        )
+    return Settings(**{
+        section: section_class(**values[section])
+        for section, section_class in section_classes.items()
+    })
+
+
+_SETTINGS: Optional[Settings] = None
+
+
+def get_settings()->Settings:
+    """Process-wide settings, read on first call"""
+    global _SETTINGS
+    if _SETTINGS is None:
+        _SETTINGS = load_settings()
+    return _SETTINGS
+
+
+def reset_settings()->None:
+    """Read the settings again on next `get_settings` call (e.g., after
+    changing the environment)"""
+    global _SETTINGS
+    _SETTINGS = None
@@ -0,0 +1,197 @@
+"""
+Similarity index over generation results
+
+Finds the past results whose concepts are close to new ones (same words in
+another order, spelling variants...), so that their mnemonics can be offered
+before generating a new one.
+
+Concepts are compared through their character n-grams (Jaccard similarity.)
+Candidates are found with MinHash signatures and locality-sensitive hashing
+(LSH): signatures are cut into bands, and results sharing a band with the
+query are candidates, then ranked by their exact similarity. Mnemonics are
+MinHashed as well, so that near-identical mnemonics are suggested once.
+Results are indexed one at a time, as they are generated.
+"""
+import random
+import re
+import threading
+import unicodedata
+import zlib
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+from mysensei.results import TCConcepts, TCResult
+
+# Large prime of the hash functions (a * x + b) % _PRIME
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+
+# ========
+# Features
+# ========
+def normalize(text: str)->str:
+    """Text compared: NFKC (e.g., full-width to ASCII), lowercase, single
+    spaces"""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text).lower()).strip()
+
+
+def ngrams(text: str, n: int=3)->set[str]:
+    """Character n-grams of `text`, padded so that word starts and ends count"""
+    padded = f" {normalize(text)} "
+    return {padded[i:i + n] for i in range(max(1, len(padded) - n + 1))}
+
+
+def concepts_features(target_concept: str, component_concepts: Iterable[str],
+                      n: int=3)->set[str]:
+    """N-grams of the concepts, whatever the order of the component concepts
+    (the target concept ones are kept apart)"""
+    features = {"t" + g for g in ngrams(target_concept, n=n)}
+    for concept in component_concepts:
+        if concept != "":
+            features.update("c" + g for g in ngrams(concept, n=n))
+    return features
+
+
+def word_bigrams(text: str)->set[str]:
+    """Pairs of consecutive words of `text` (punctuation ignored)"""
+    words = re.findall(r"\w+", normalize(text)) or [""]
+    return {" ".join(words[i:i + 2]) for i in range(max(1, len(words) - 1))}
+
+
+def jaccard(a: set, b: set)->float:
+    return 0. if len(a) == 0 and len(b) == 0 else len(a & b) / len(a | b)
+
+
+class MinHasher:
+    """MinHash signatures: the share of equal values in the signatures of two
+    sets estimates their Jaccard similarity"""
+
+    def __init__(self, n_hashes: int=64, seed: int=0)->None:
+        rng = random.Random(seed)
+        self._coefs = [(rng.randrange(1, _PRIME), rng.randrange(0, _PRIME))
+                       for _ in range(n_hashes)]
+
+    def signature(self, features: Iterable[str])->tuple[int, ...]:
+        hashes = [zlib.crc32(f.encode()) for f in features]
+        if len(hashes) == 0:
+            return tuple(_MAX_HASH for _ in self._coefs)
+        return tuple(min(((a * h + b) % _PRIME) & _MAX_HASH for h in hashes)
+                     for a, b in self._coefs)
+
+
+def estimated_similarity(signature1: tuple[int, ...], signature2: tuple[int, ...])->float:
+    return sum(x == y for x, y in zip(signature1, signature2)) / len(signature1)
+
+
+# =====
+# Index
+# =====
+@dataclass(frozen=True)
+class SimilarResult:
+    """A past result, and the similarity of its concepts to the query's"""
+    result: TCResult
+    similarity: float
+
+
+@dataclass(frozen=True)
+class _Entry:
+    result: TCResult
+    features: frozenset[str]
+    mnemonic_signature: tuple[int, ...]
+
+
+class SimilarityIndex:
+    """LSH index of results, by concepts
+
+    With `n_bands` bands of `n_hashes / n_bands` rows, results whose concepts
+    are more similar than about (1 / n_bands) ** (n_bands / n_hashes) are
+    found with high probability (0.18 by default: recall matters more than
+    the few extra candidates.)
+    """
+
+    def __init__(self, n_hashes: int=64, n_bands: int=32, ngram_size: int=3,
+                 duplicate_mnemonic_similarity: float=0.8)->None:
+        if n_hashes % n_bands != 0:
+            raise ValueError(f"{n_bands=} does not divide {n_hashes=}")
+        self.n_bands = n_bands
+        self.ngram_size = ngram_size
+        self.duplicate_mnemonic_similarity = duplicate_mnemonic_similarity
+        self._rows_per_band = n_hashes // n_bands
+        self._hasher = MinHasher(n_hashes=n_hashes)
+        # Coarser signatures, enough to tell near-identical mnemonics
+        self._mnemonic_hasher = MinHasher(n_hashes=16)
+        self._entries: list[_Entry] = []
+        self._ids: dict[TCResult, int] = {}
+        self._buckets: dict[tuple[int, tuple[int, ...]], list[int]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self)->int:
+        return len(self._entries)
+
+    def _bands(self, signature: tuple[int, ...])->list[tuple[int, tuple[int, ...]]]:
+        r = self._rows_per_band
+        return [(i, signature[i * r:(i + 1) * r]) for i in range(self.n_bands)]
+
+    def add(self, result: TCResult)->None:
+        """Index `result` (once, whatever its revisions)"""
+        result = TCResult(target_concept=result.target_concept,
+                          component_concepts=result.component_concepts,
+                          mnemonic=result.mnemonic)
+        features = concepts_features(result.target_concept, result.component_concepts,
+                                     n=self.ngram_size)
+        signature = self._hasher.signature(features)
+        mnemonic_signature = self._mnemonic_hasher.signature(word_bigrams(result.mnemonic))
+        with self._lock:
+            if result in self._ids:
+                return
+            entry_id = len(self._entries)
+            self._entries.append(_Entry(result=result, features=frozenset(features),
+                                        mnemonic_signature=mnemonic_signature))
+            self._ids[result] = entry_id
+            for band in self._bands(signature):
+                self._buckets.setdefault(band, []).append(entry_id)
+
+    def add_many(self, results: Iterable[TCResult])->None:
+        for result in results:
+            self.add(result)
+
+    def query(self, concepts: TCConcepts, k: int=3,
+              min_similarity: float=0.3)->list[SimilarResult]:
+        """The `k` results with the most similar concepts (at least
+        `min_similarity`), most similar first, near-identical mnemonics
+        excluded"""
+        features = concepts_features(concepts.target_concept,
+                                     concepts.nonempty_component_concepts(),
+                                     n=self.ngram_size)
+        signature = self._hasher.signature(features)
+        with self._lock:
+            candidate_ids = {
+                entry_id for band in self._bands(signature)
+                for entry_id in self._buckets.get(band, ())
+            }
+            candidates = [self._entries[i] for i in candidate_ids]
+        scored = sorted(
+            ((jaccard(features, e.features), e) for e in candidates),
+            key=lambda x: x[0], reverse=True,
+        )
+        similar: list[tuple[float, _Entry]] = []
+        for similarity, entry in scored:
+            if similarity < min_similarity or len(similar) == k:
+                break
+            if any(estimated_similarity(entry.mnemonic_signature, e.mnemonic_signature)
+                   >= self.duplicate_mnemonic_similarity for _, e in similar):
+                continue
+            similar.append((similarity, entry))
+        return [SimilarResult(result=e.result, similarity=s) for s, e in similar]
+
+
+_SIMILARITY_INDEX: Optional[SimilarityIndex] = None
+
+
+def get_similarity_index()->SimilarityIndex:
+    """Process-wide similarity index"""
+    global _SIMILARITY_INDEX
+    if _SIMILARITY_INDEX is None:
+        _SIMILARITY_INDEX = SimilarityIndex()
+    return _SIMILARITY_INDEX
@@ -1,41 +1,67 @@
-from sqlalchemy import SmallInteger, Integer, String, Column, Table
-from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy import SmallInteger, Integer, String, Text, DateTime, Column
 from sqlalchemy.ext.declarative import declarative_base
-from mysensei.io import get_conf_toml
 
 Base = declarative_base()
 
-secrets : dict = get_conf_toml('secrets.toml')
-# TODO : create connector following https://chat.openai.com/c/92c6accb-2b95-4032-93c3-69d7da2b38e3
+# Engines and queries (and their settings): see mysensei.repository
 
 class ReadingAssiociations(Base):
+    # One row per (user, sound, concept): a user can pair several concepts
+    # with the same sound.
     __tablename__ = "reading_associations_jp"
     user_id = Column(
         Integer,
         primary_key=True,
-        autoincrement=True,
+        autoincrement=False,
     )
-    sound = Column(String)
-    concept = Column(String)
+    sound = Column(String, primary_key=True)
+    concept = Column(String, primary_key=True)
     descriptor = Column(String)
 
 
-## Vocab jp notes
-#user_vocabnotesjp_corr = Table(
-#    name="user_vocabnotesjp",
-#    metadata=Base.metadata,
-#    # TODO: columns
-#)
-#
-#class VocabNotesJp(Base):
-#    __tablename__ = "vocab_notes_jp"
-#    vocabnotesjp_id = Column(
-#        Integer, 
-#        primary_key=True, 
-#        autoincrement=True,
-#    )
-#    lemma = Column(String)
-#    count = Column(SmallInteger)
-#    # TODO: add cols
-#    meanings = Column(ARRAY(String))
-#    # TODO: add cols
+
+class GenerationResults(Base):
+    # Generated mnemonics, with what they were generated from
+    __tablename__ = "generation_results"
+    result_id = Column(Integer, primary_key=True, autoincrement=True)
+    session_id = Column(String, index=True)
+    user_id = Column(Integer, index=True)
+    target_concept = Column(String)
+    component_concepts = Column(Text)  # JSON list
+    template_name = Column(String)
+    template_version = Column(Integer)
+    mnemonic = Column(Text)
+    revisions = Column(Text)  # JSON list
+    created_at = Column(DateTime)
+
+
+# Change log, for client-side cache synchronization
+class UserVersions(Base):
+    # Last version of each user's data, incremented on every change
+    __tablename__ = "user_versions"
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    version = Column(Integer, nullable=False)
+
+
+class ChangeLog(Base):
+    __tablename__ = "change_log"
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    entity = Column(String, nullable=False)  # e.g., "reading_association"
+    entity_key = Column(String, nullable=False)  # JSON of the primary key values
+    op = Column(String, nullable=False)  # "upsert" or "delete"
+    payload = Column(Text)  # JSON of the row, for upserts
+
+
+class VocabNotesJp(Base):
+    # One row per (user, lemma): imports skip the lemmas a user already has
+    __tablename__ = "vocab_notes_jp"
+    user_id = Column(
+        Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+    lemma = Column(String, primary_key=True)
+    reading = Column(String)
+    meanings = Column(Text)  # JSON list
+    count = Column(Integer)  # Occurrences (frequency) in the source, if known
@@ -0,0 +1,168 @@
+"""
+Synchronization of the client-side cache
+
+Every change to a user's data gets a version (see repository.record_changes.)
+A client sends the last version it has seen, and gets either the changes since
+then, or a full snapshot if it has nothing cached yet (version 0) or if those
+changes have been pruned from the log. Responses carry the version as ETag,
+so that an up-to-date client gets a bodyless 304.
+"""
+import gzip
+import json
+from dataclasses import dataclass, field
+from typing import Callable
+
+from fastapi import FastAPI, HTTPException, Request, Response
+from sqlalchemy import Engine, delete, func, select
+from sqlalchemy.orm import Session, sessionmaker
+
+from mysensei.repository import READING_ASSOCIATION_ENTITY, get_user_version
+from mysensei.sql import ChangeLog, ReadingAssiociations
+from mysensei.users import find_user_id
+
+# Responses smaller than that are not worth compressing
+MIN_COMPRESSED_SIZE = 1024
+
+
+# =========
+# Snapshots
+# =========
+def _reading_associations_snapshot(session: Session, user_id: int)->list[dict]:
+    """All reading associations of a user, as change-log payloads"""
+    rows = session.execute(
+        select(ReadingAssiociations.sound, ReadingAssiociations.concept,
+               ReadingAssiociations.descriptor)
+        .where(ReadingAssiociations.user_id == user_id)
+    )
+    return [{"sound": s, "concept": c, "descriptor": d} for s, c, d in rows]
+
+
+# Snapshot of each synchronized entity
+SNAPSHOT_LOADERS: dict[str, Callable[[Session, int], list[dict]]] = {
+    READING_ASSOCIATION_ENTITY: _reading_associations_snapshot,
+}
+
+
+# =======
+# Service
+# =======
+@dataclass
+class SyncPayload:
+    """What a client needs to bring its cache to `version`
+
+    If `full`, `snapshot` holds all rows by entity and replaces the cache.
+    Otherwise, `changes` are to be applied in order.
+    """
+    version: int
+    full: bool
+    snapshot: dict[str, list[dict]] = field(default_factory=dict)
+    changes: list[dict] = field(default_factory=list)
+
+
+class SyncService:
+    """Build full or delta sync payloads from the change log"""
+
+    def __init__(self, engine: Engine)->None:
+        self.sessionmaker = sessionmaker(bind=engine)
+
+    def get_version(self, user_id: int)->int:
+        with self.sessionmaker() as session:
+            return get_user_version(session=session, user_id=user_id)
+
+    def get_payload(self, user_id: int, since: int=0)->SyncPayload:
+        """Changes since version `since`, or a snapshot if they are not all
+        available"""
+        with self.sessionmaker() as session:
+            # Version read first: rows read afterwards can only be newer, and
+            # replaying their changes later on is harmless.
+            version = get_user_version(session=session, user_id=user_id)
+            if since <= 0 or since > version or not self._has_changes_since(
+                session=session, user_id=user_id, since=since
+            ):
+                return SyncPayload(version=version, full=True, snapshot={
+                    entity: load(session, user_id)
+                    for entity, load in SNAPSHOT_LOADERS.items()
+                })
+            rows = session.scalars(
+                select(ChangeLog)
+                .where(ChangeLog.user_id == user_id, ChangeLog.version > since)
+                .order_by(ChangeLog.version)
+            )
+            # Only the last change to each row matters
+            last_changes = {}
+            for row in rows:
+                last_changes.pop((row.entity, row.entity_key), None)
+                last_changes[(row.entity, row.entity_key)] = {
+                    "version": row.version,
+                    "entity": row.entity,
+                    "key": json.loads(row.entity_key),
+                    "op": row.op,
+                    "payload": None if row.payload is None else json.loads(row.payload),
+                }
+            return SyncPayload(version=version, full=False,
+                               changes=list(last_changes.values()))
+
+    def prune(self, user_id: int, up_to_version: int)->int:
+        """Drop the changes up to `up_to_version` (clients older than that get
+        snapshots.) Return the number of dropped changes."""
+        with self.sessionmaker.begin() as session:
+            result = session.execute(
+                delete(ChangeLog)
+                .where(ChangeLog.user_id == user_id, ChangeLog.version <= up_to_version)
+            )
+            return result.rowcount
+
+    @staticmethod
+    def _has_changes_since(session: Session, user_id: int, since: int)->bool:
+        """Are all changes after `since` still in the log?"""
+        oldest_version = session.scalar(
+            select(func.min(ChangeLog.version)).where(ChangeLog.user_id == user_id)
+        )
+        return oldest_version is not None and oldest_version <= since + 1
+
+
+# ========
+# Endpoint
+# ========
+def _etag(version: int)->str:
+    return f'"{version}"'
+
+
+def build_sync_response(request: Request, service: SyncService, user_id: int,
+                        since: int)->Response:
+    """304 if the client's ETag is current, else the (compressed) payload"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        version = service.get_version(user_id=user_id)
+        if _etag(version) in [t.strip() for t in if_none_match.split(",")]:
+            return Response(status_code=304, headers={"ETag": _etag(version)})
+    payload = service.get_payload(user_id=user_id, since=since)
+    body = json.dumps(payload.__dict__, ensure_ascii=False).encode("utf-8")
+    headers = {"ETag": _etag(payload.version), "Vary": "Accept-Encoding",
+               "Cache-Control": "no-cache"}
+    if (len(body) >= MIN_COMPRESSED_SIZE
+            and "gzip" in request.headers.get("accept-encoding", "")):
+        body = gzip.compress(body, compresslevel=6)
+        headers["Content-Encoding"] = "gzip"
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def register_sync_routes(app: FastAPI, get_service: Callable[[], SyncService],
+                         path: str="/api/sync/{user_id}")->None:
+    """Add the sync endpoint to `app` (e.g., nicegui.app)
+
+    `GET <path>?since=<version>` returns the SyncPayload bringing a cache at
+    `since` up to date. Only the user of the session (see mysensei.users) gets
+    their data: other requests are rejected with a 401, or a 403 if they ask
+    for another user's.
+    """
+    @app.get(path)
+    def sync(request: Request, user_id: int, since: int=0)->Response:
+        session = request.scope.get("session")  # None without a storage_secret
+        session_user_id = None if session is None else find_user_id(session)
+        if session_user_id is None:
+            raise HTTPException(status_code=401, detail="No user session")
+        if session_user_id != user_id:
+            raise HTTPException(status_code=403, detail="Not the session's user")
+        return build_sync_response(request=request, service=get_service(),
+                                   user_id=user_id, since=since)
@@ -6,3 +6,9 @@ import re
 def replace_linebreaks_w_br(s):
     """Replace \n with <br>. Useful when leveraging nicegui.ui.markdown"""
     return re.sub(r'(?<!\n)\n(?!\n)', '<br>', s)
+
+
+def estimate_n_tokens(s: str)->int:
+    """Rough number of tokens of `s`, on the high side (English is about 4
+    bytes per token, Japanese about 3)"""
+    return len(s.encode("utf-8")) // 3 + 1
@@ -1,21 +1,85 @@
 """
 UI components
 """
-from nicegui import app, ui
-from typing import Any, Optional
+import asyncio
+import time
+from nicegui import app, ui, Client
+from nicegui.events import ValueChangeEventArguments
+from typing import Any, Awaitable, Optional, TypeVar
 from dataclasses import fields, Field
+from functools import partial
 from jinja2 import Template
-from mysensei.generation import PromptParams, TCParams, TCRevisionParams
+from mysensei.generation import (PromptParams, TCParams, TCRevisionParams,
+    PromptFieldTypeError)
 from mysensei.annotations import PromptParamName, Prompt
+from mysensei.fewshot import render_prompt
 from mysensei.io import get_jinja_template
 from mysensei.text import replace_linebreaks_w_br
 
+T = TypeVar("T")
+# Path to an input within the prompt parameters: (field name, *subfield names)
+LeafKey = tuple[str, ...]
+
+
+async def cancel_on_disconnect(client: Client, awaitable: Awaitable[T])->T:
+    """Await `awaitable`, cancelling it if `client` disconnects in the meantime
+
+    Meant for long-running calls (e.g., generation) made from event handlers,
+    so that work for a closed tab does not keep running on the server.
+    """
+    task = asyncio.ensure_future(awaitable)
+    def _cancel_task():
+        task.cancel()
+    client.on_disconnect(_cancel_task)
+    try:
+        return await task
+    finally:
+        client.disconnect_handlers.remove(_cancel_task)
+
+
+class ThrottledMarkdown:
+    """Append streamed text to a markdown element, with bounded update rate
+
+    The element content is re-sent at most once every `min_interval_s`
+    seconds, whatever the number of appended deltas. Call `flush` once the
+    stream is over to display the remaining text.
+    """
+
+    def __init__(self, markdown: ui.markdown, min_interval_s: float=0.1)->None:
+        self.markdown = markdown
+        self.min_interval_s = min_interval_s
+        self._chunks: list[str] = []
+        self._last_update = float("-inf")
+
+    def append(self, delta: str)->None:
+        """Append `delta`, and update the element if not done recently"""
+        self._chunks.append(delta)
+        if time.perf_counter() - self._last_update >= self.min_interval_s:
+            self._update()
+
+    def flush(self)->str:
+        """Update the element with all text received so far, and return it"""
+        return self._update()
+
+    def _update(self)->str:
+        """Display the text received so far"""
+        text = "".join(self._chunks)
+        self._chunks = [text]
+        self.markdown.set_content(text)
+        self._last_update = time.perf_counter()
+        return text
+
 
 class PromptUI:
     #TODO: docstr (init parameters)
     """UI for generation
 
     Display inputable fields, a prompt rendering button, and the prompt itself
+
+    Whether each input is filled out is tracked as it changes, so that each
+    keystroke costs O(1) instead of a revalidation of all parameters. With
+    `live_preview`, the prompt is re-rendered `preview_debounce_s` seconds
+    after the last change, and only if the rendering inputs changed.
     """
 
     def __init__(self, prompt_params: PromptParams,
@@ -24,10 +88,17 @@ class PromptUI:
                  hidden_fields:Optional[list[PromptParamName]]=None,
                  auxiliary_prompt_params_lst: Optional[list[PromptParams]]=None,
                  multirow_fields:Optional[list[PromptParamName]]=None,
+                 live_preview: bool=False,
+                 preview_debounce_s: float=0.3,
                 )->None:
         # Init
         self.prompt = ""
+        self.prompt_n_tokens = 0  # Estimate
         self.can_gen_prompt = False
+        self.live_preview = live_preview
+        self.preview_debounce_s = preview_debounce_s
+        self._preview_handle: Optional[asyncio.TimerHandle] = None
+        self._last_rendered_inputs: Optional[tuple] = None
         # Attach to self
         self.prompt_params = prompt_params
         self.template_name = template_name
@@ -48,7 +119,7 @@ class PromptUI:
         # Load template
         self.template = self._load_template()
         # Update initial generability
-        self.can_gen_prompt = self._update_can_gen_prompt()
+        self._init_filled_out_state()
 
     def display_whole_ui(self)->None:
         """Display the entire UI"""
@@ -78,10 +149,74 @@ class PromptUI:
                 )
         self.multirow_fields = fields_to_expand
 
-    def _update_can_gen_prompt(self)->bool:
+    def _init_filled_out_state(self)->None:
+        """Record which inputs are filled out, and count them per field"""
+        self._leaf_is_filled_out: dict[LeafKey, bool] = {}
+        self._n_filled_out_leaves: dict[PromptParamName, int] = {}
+        for field_name in self.prompt_params._get_fields_names():
+            self._n_filled_out_leaves[field_name] = 0
+            self._init_leaves(
+                leaf_key=(field_name,),
+                value=self.prompt_params._get_field_attribute(field_name=field_name),
+            )
+        self._non_filled_out_fields = {
+            n for n, count in self._n_filled_out_leaves.items() if count == 0
+        }
+        self._update_can_gen_prompt()
+
+    def _init_leaves(self, leaf_key: LeafKey, value: Any)->None:
+        """Record the filled-out state of the inputs under `leaf_key`"""
+        if isinstance(value, str):
+            self._leaf_is_filled_out[leaf_key] = (value != "")
+            self._n_filled_out_leaves[leaf_key[0]] += (value != "")
+        elif isinstance(value, dict):
+            for subfield_name, subfield_value in value.items():
+                self._init_leaves(leaf_key=leaf_key + (subfield_name,),
+                                  value=subfield_value)
+        else:
+            raise PromptFieldTypeError(
+                f"Field {leaf_key[0]} is not str or a (nested) dict of str"
+            )
+
+    def _on_field_change(self, event: ValueChangeEventArguments, leaf_key: LeafKey)->None:
+        """Update the filled-out state of one input, then generability"""
+        is_filled_out = (event.value is not None and event.value != "")
+        if self._leaf_is_filled_out.get(leaf_key) != is_filled_out:
+            self._leaf_is_filled_out[leaf_key] = is_filled_out
+            field_name = leaf_key[0]
+            self._n_filled_out_leaves[field_name] += 1 if is_filled_out else -1
+            if self._n_filled_out_leaves[field_name] == 0:
+                self._non_filled_out_fields.add(field_name)
+            else:
+                self._non_filled_out_fields.discard(field_name)
+            self._update_can_gen_prompt()
+        if self.live_preview:
+            self._schedule_preview()
+
+    def _update_can_gen_prompt(self)->None:
         """Update self.can_gen_prompt depending on whether all prompt
         parameters have been filled out or non"""
-        self.can_gen_prompt = (len(self.prompt_params.non_filled_out_fields()) == 0)
+        self.can_gen_prompt = (len(self._non_filled_out_fields) == 0)
+
+    def _schedule_preview(self)->None:
+        """(Re)start the countdown before refreshing the prompt preview"""
+        if self._preview_handle is not None:
+            self._preview_handle.cancel()
+        self._preview_handle = asyncio.get_running_loop().call_later(
+            self.preview_debounce_s, self._refresh_preview
+        )
+
+    def _refresh_preview(self)->None:
+        """Re-render the prompt, unless its inputs are the same as last time"""
+        self._preview_handle = None
+        if not self.can_gen_prompt:
+            return
+        prompt_params_dict = self._get_prompt_params_dict()
+        rendered_inputs = _freeze(prompt_params_dict)
+        if rendered_inputs == self._last_rendered_inputs:
+            return
+        self._render_prompt(prompt_params_dict=prompt_params_dict)
+        self._last_rendered_inputs = rendered_inputs
 
     def display_field_values(self)->None:
         """Display value of fields (for quick checks)"""
@@ -90,15 +225,21 @@ class PromptUI:
     def _update_prompt(self)->None:
         """Update self.prompt by rendering the template with self.prompt_params
         and auxiliary_prompt_params_lst"""
-        # Merge auxiliary_prompt_params with prompt_params
+        self._render_prompt(prompt_params_dict=self._get_prompt_params_dict())
+
+    def _get_prompt_params_dict(self)->dict[PromptParamName, Any]:
+        """Merge auxiliary_prompt_params with prompt_params"""
         prompt_params_dict = self.prompt_params.get_filled_out_fields_subfields()
         _ = [prompt_params_dict.update(aux_prompt_params.get_filled_out_fields_subfields()) 
             for aux_prompt_params in self.auxiliary_prompt_params_lst]
-        # Get prompt
-        prompt = self.template.render(
-            **prompt_params_dict
-        )
-        self.prompt = prompt
+        return prompt_params_dict
+
+    def _render_prompt(self, prompt_params_dict: dict[PromptParamName, Any])->None:
+        """Update self.prompt by rendering the template with prompt_params_dict"""
+        rendered_prompt = render_prompt(template=self.template,
+                                        prompt_params_dict=prompt_params_dict)
+        self.prompt = rendered_prompt.prompt
+        self.prompt_n_tokens = rendered_prompt.n_tokens
 
     def _load_template(self)->Template:
         """Load the template based on self.template_name and self.template_version"""
@@ -127,46 +268,55 @@ class PromptUI:
         if isinstance(field_value, str):
             self._field_inputer(field_name=field_name,
                                 binding_target_object=prompt_params,
-                                binding_target_name=field_name)
+                                binding_target_name=field_name,
+                                leaf_key=(field_name,))
         elif isinstance(field_value, dict):
-            self._display_subfields(d=field_value, field_name=field_name)
+            self._display_subfields(d=field_value, field_name=field_name,
+                                    leaf_key=(field_name,))
 
     def _field_inputer(
         self, 
         field_name: PromptParamName, 
         binding_target_object: Any,
-        binding_target_name: str
+        binding_target_name: str,
+        leaf_key: LeafKey,
     ):
         """Display inputation area"""
+        on_change = partial(self._on_field_change, leaf_key=leaf_key)
         if field_name in self.multirow_fields:
-            ui.textarea(on_change=self._update_can_gen_prompt).bind_value(target_object=binding_target_object,
-                                                                          target_name=binding_target_name)
+            ui.textarea(on_change=on_change).bind_value(target_object=binding_target_object,
+                                                        target_name=binding_target_name)
         else:
-            ui.input(on_change=self._update_can_gen_prompt).bind_value(target_object=binding_target_object,
-                                                                       target_name=binding_target_name)
+            ui.input(on_change=on_change).bind_value(target_object=binding_target_object,
+                                                     target_name=binding_target_name)
 
 
-    def _display_subfields(self, field_name: PromptParamName, d: dict[str, Any])->None:
+    def _display_subfields(self, field_name: PromptParamName, d: dict[str, Any],
+                           leaf_key: LeafKey)->None:
         """Display the subfields of field if field is dictionary of subfields"""
         if all(isinstance(e, str) for e in d.values()):
-            self._display_nonnested_subfields(field_name=field_name, d=d)
+            self._display_nonnested_subfields(field_name=field_name, d=d, leaf_key=leaf_key)
         elif all(isinstance(e, dict) for e in d.values()):
-            self._display_nested_subfields(field_name=field_name, d=d)
+            self._display_nested_subfields(field_name=field_name, d=d, leaf_key=leaf_key)
         else: 
             raise TypeError()
 
-    def _display_nonnested_subfields(self, field_name: PromptParamName, d: dict[str, str])->None:
+    def _display_nonnested_subfields(self, field_name: PromptParamName, d: dict[str, str],
+                                     leaf_key: LeafKey)->None:
         """Display when field is dict of str fields"""
         for k in d.keys():
             self._field_inputer(field_name=field_name,
                                 binding_target_object=d,
-                                binding_target_name=k)
+                                binding_target_name=k,
+                                leaf_key=leaf_key + (k,))
 
-    def _display_nested_subfields(self, field_name: PromptParamName, d: dict[str, dict[str, str]])->None:
+    def _display_nested_subfields(self, field_name: PromptParamName, d: dict[str, dict[str, str]],
+                                  leaf_key: LeafKey)->None:
         """Display when field is dict of subfields"""
         for subdict_name, subdict_value in d.items():
             with ui.row():
-                self._display_nonnested_subfields(field_name=field_name, d=subdict_value)
+                self._display_nonnested_subfields(field_name=field_name, d=subdict_value,
+                                                  leaf_key=leaf_key + (subdict_name,))
 
 
     def _display_prompt(self)->None:
@@ -176,6 +326,11 @@ class PromptUI:
             target_name="prompt",
             backward=replace_linebreaks_w_br
         ).bind_visibility_from(target_object=self, target_name="can_gen_prompt")
+        ui.label().classes("text-xs text-gray-500").bind_text_from(
+            target_object=self,
+            target_name="prompt_n_tokens",
+            backward=lambda n: f"~{n} tokens" if n > 0 else "",
+        ).bind_visibility_from(target_object=self, target_name="can_gen_prompt")
 
     def _display_prompt_rendering_button(self)->None:
         """Display prompt rendering button"""
@@ -183,3 +338,10 @@ class PromptUI:
             text="Get prompt", 
             on_click=self._update_prompt
         ).bind_enabled_from(target_object=self, target_name="can_gen_prompt")
+
+
+def _freeze(value: Any)->Any:
+    """Hashable snapshot of (nested) dicts of prompt parameters"""
+    if isinstance(value, dict):
+        return tuple((k, _freeze(v)) for k, v in value.items())
+    return value
@@ -0,0 +1,27 @@
+"""
+Identification of the current user
+
+There are no accounts yet: the user id is kept in the browser's signed session
+cookie (nicegui's `app.storage.browser`, i.e., `request.session`), and set to
+DEFAULT_USER_ID on first visit. A login page would only have to overwrite it.
+Both need a `storage_secret` passed to `ui.run`.
+"""
+from collections.abc import MutableMapping
+from typing import Optional
+
+USER_ID_KEY = "user_id"
+DEFAULT_USER_ID = 0
+
+
+def get_user_id(session: MutableMapping)->int:
+    """User id of a browser session, set to the default one if there is none
+
+    Only call it while the response is built (e.g., from a page function), as
+    the cookie cannot be updated afterwards.
+    """
+    return session.setdefault(USER_ID_KEY, DEFAULT_USER_ID)
+
+
+def find_user_id(session: MutableMapping)->Optional[int]:
+    """User id of a browser session, None if it never got one"""
+    return session.get(USER_ID_KEY)
@@ -0,0 +1,30 @@
+import os
+
+import pytest
+import mysensei.generation as ms_generation
+import mysensei.settings as ms_settings
+from mysensei.cache import CompletionCache
+
+
+@pytest.fixture(autouse=True)
+def completion_cache(tmp_path, monkeypatch):
+    """Isolate tests from the on-disk completion cache"""
+    cache = CompletionCache(path=str(tmp_path / "completions.sqlite"))
+    monkeypatch.setattr(ms_generation, "_COMPLETION_CACHE", cache)
+    return cache
+
+
+@pytest.fixture(autouse=True)
+def settings(tmp_path, monkeypatch):
+    """Isolate tests from the configuration files and overrides: default
+    settings (and backend, rate limiter), from an empty configuration folder"""
+    config_path = tmp_path / "config"
+    config_path.mkdir()
+    monkeypatch.setenv("MYSENSEI_CONFIG_PATH", str(config_path))
+    for name in os.environ:
+        if name.startswith(ms_settings.ENV_PREFIX):
+            monkeypatch.delenv(name)
+    monkeypatch.setattr(ms_settings, "_SETTINGS", None)
+    monkeypatch.setattr(ms_generation, "_BACKEND", None)
+    monkeypatch.setattr(ms_generation, "_RATE_LIMITER", None)
+    return config_path
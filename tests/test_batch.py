@@ -0,0 +1,53 @@
+import asyncio
+import json
+import mysensei.batch as ms_batch
+import mysensei.io as ms_io
+from mysensei.batch import read_rows, run_batch, truncate_partial_line, TEMPLATE_PARAMS_CLASSES
+
+
+def test_read_rows_csv(tmp_path):
+    path = tmp_path / "rows.csv"
+    path.write_text("id,target_concept,component_concepts.0,component_concepts.1\n"
+                    "w1,ignition,departure,fire\n")
+    assert list(read_rows(str(path))) == [
+        ("w1", {"target_concept": "ignition",
+                "component_concepts": {"0": "departure", "1": "fire"}})
+    ]
+
+
+def test_run_batch_resumes_from_checkpoint(tmp_path, monkeypatch):
+    prompts = []
+    async def fake_generate(prompt, **kwargs):
+        prompts.append(prompt)
+        return "mnemonic"
+    monkeypatch.setattr(ms_batch, "agenerate_with_retries", fake_generate)
+    input_path = tmp_path / "rows.jsonl"
+    input_path.write_text("\n".join(json.dumps(
+        {"id": f"w{i}", "target_concept": f"concept{i}",
+         "component_concepts": {"0": "a", "1": ""}}
+    ) for i in range(3)))
+    output_path = tmp_path / "out.jsonl"
+    # Interrupted while writing w2
+    output_path.write_text(json.dumps({"id": "w1", "output": "old"}) + '\n{"id": "w2", "ou')
+    report = asyncio.run(run_batch(
+        rows=read_rows(str(input_path)),
+        template=ms_io.get_jinja_template(template_name="pure_concepts", version=0),
+        params_classes=TEMPLATE_PARAMS_CLASSES["pure_concepts"],
+        output_path=str(output_path),
+        max_in_flight=2,
+    ))
+    assert (report.n_generated, report.n_skipped, report.n_failed) == (2, 1, 0)
+    assert len(prompts) == 2
+    assert {json.loads(l)["id"] for l in output_path.read_text().splitlines()} == {"w0", "w1", "w2"}
+
+
+def test_truncate_partial_line(tmp_path):
+    path = tmp_path / "out.jsonl"
+    path.write_text("a\nbbbbbbbbbb\nc\ncpartial")
+    truncate_partial_line(str(path), chunk_size=4)
+    assert path.read_text() == "a\nbbbbbbbbbb\nc\n"
+    truncate_partial_line(str(path), chunk_size=4)  # Complete lines are kept
+    assert path.read_text() == "a\nbbbbbbbbbb\nc\n"
+    path.write_text("partial")
+    truncate_partial_line(str(path))
+    assert path.read_text() == ""
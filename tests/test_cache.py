@@ -0,0 +1,88 @@
+import asyncio
+import time
+from mysensei.cache import CompletionCache
+
+
+def test_completion_cache_tiers(tmp_path):
+    path = str(tmp_path / "completions.sqlite")
+    cache = CompletionCache(path=path, max_memory_entries=1)
+    key = cache.make_key(model="gpt-4", prompt="bla")
+    assert cache.get(key) is None
+    cache.set(key, "mnemonic")
+    assert cache.get(key) == "mnemonic"
+    # Evicted from memory, still on disk
+    cache.set(cache.make_key(model="gpt-4", prompt="other"), "other mnemonic")
+    assert cache.get(key) == "mnemonic"
+    assert (cache.stats.memory_hits, cache.stats.disk_hits, cache.stats.misses) == (1, 1, 1)
+    # Shared across instances
+    assert CompletionCache(path=path).get(key) == "mnemonic"
+
+
+def test_completion_cache_async_tiers(tmp_path):
+    path = str(tmp_path / "completions.sqlite")
+    cache = CompletionCache(path=path)
+    async def main():
+        assert await cache.aget("k") is None
+        await cache.aset("k", "mnemonic")
+        assert await cache.aget("k") == "mnemonic"
+        return await CompletionCache(path=path).aget("k")
+    assert asyncio.run(main()) == "mnemonic"
+    assert (cache.stats.memory_hits, cache.stats.disk_hits, cache.stats.misses) == (1, 0, 1)
+
+
+def test_completion_cache_key_depends_on_sampling_params():
+    assert (CompletionCache.make_key(model="gpt-4", prompt="bla", n=1)
+            != CompletionCache.make_key(model="gpt-4", prompt="bla", n=2))
+
+
+def test_completion_cache_ttl_and_size_eviction(tmp_path):
+    cache = CompletionCache(path=str(tmp_path / "completions.sqlite"),
+                            max_disk_bytes=10, ttl_s=0.05)
+    cache.set("k1", "12345")
+    cache.set("k2", "123456")
+    assert cache.get("k1") is None
+    assert cache.get("k2") == "123456"
+    assert cache.stats.evictions == 1
+    time.sleep(0.1)
+    assert cache.get("k2") is None
+
+
+def test_completion_cache_evicts_to_low_water_mark(tmp_path):
+    cache = CompletionCache(path=str(tmp_path / "completions.sqlite"), max_disk_bytes=100)
+    for i in range(10):
+        cache.set(f"k{i}", "x" * 10)
+    # Over capacity: evicted down to 90 bytes at most
+    cache.set("k10", "x" * 10)
+    assert cache.stats.evictions == 2
+    # Room left for the next entry, without eviction
+    cache.set("k11", "x" * 5)
+    assert cache.stats.evictions == 2
+    assert cache.get("k1") is None and cache.get("k2") == "x" * 10
+
+
+def test_completion_cache_evicts_by_memory_hits_too(tmp_path):
+    cache = CompletionCache(path=str(tmp_path / "completions.sqlite"), max_disk_bytes=250)
+    cache.set("hot", "x" * 100)
+    cache.set("cold", "x" * 100)
+    for _ in range(50):
+        assert cache.get("hot") == "x" * 100  # Memory hits
+    cache.set("new", "x" * 100)
+    assert cache.get("cold") is None
+    assert cache.get("hot") == "x" * 100
+
+
+def test_generation_uses_cache(completion_cache, monkeypatch):
+    import openai
+    from mysensei.generation import generate_gpt4_simple
+    calls = []
+    def fake_create(**kwargs):
+        calls.append(kwargs)
+        return openai.openai_object.OpenAIObject.construct_from(
+            {"choices": [{"message": {"content": f"mnemonic {len(calls)}"}}]}
+        )
+    monkeypatch.setattr(openai.ChatCompletion, "create", fake_create)
+    assert generate_gpt4_simple(prompt="bla") == "mnemonic 1"
+    assert generate_gpt4_simple(prompt="bla") == "mnemonic 1"
+    assert generate_gpt4_simple(prompt="bla", fresh=True) == "mnemonic 2"
+    assert generate_gpt4_simple(prompt="bla") == "mnemonic 2"
+    assert len(calls) == 2
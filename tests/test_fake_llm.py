@@ -0,0 +1,56 @@
+import asyncio
+import socket
+import threading
+import time
+import pytest
+import uvicorn
+from fastapi.testclient import TestClient
+import mysensei.generation as ms_generation
+from mysensei.fake_llm import FakeLLMConfig, create_app
+from mysensei.generation import (OpenAIBackend, agenerate_gpt4_candidates,
+    astream_gpt4_simple)
+
+FAST = dict(ttft_median_s=0.01, tokens_per_s=1000., min_completion_tokens=5,
+            max_completion_tokens=5, seed=0)
+REQUEST = {"model": "gpt-4", "messages": [{"role": "user", "content": "bla"}]}
+
+
+def test_fake_llm_errors():
+    client = TestClient(create_app(FakeLLMConfig(**FAST, requests_per_minute=2)))
+    assert client.post("/v1/chat/completions", json=REQUEST).status_code == 200
+    assert client.post("/v1/chat/completions", json=REQUEST).status_code == 200
+    response = client.post("/v1/chat/completions", json=REQUEST)
+    assert response.status_code == 429
+    assert response.json()["error"]["type"] == "requests"
+    client = TestClient(create_app(FakeLLMConfig(**FAST, error_rate=1.)))
+    assert client.post("/v1/chat/completions", json=REQUEST).status_code == 500
+
+
+@pytest.fixture
+def fake_llm_backend(monkeypatch):
+    """Fake server on a free port, used as generation backend"""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(create_app(FakeLLMConfig(**FAST)),
+                                           host="127.0.0.1", port=port, log_level="error"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    monkeypatch.setattr(ms_generation, "_BACKEND",
+                        OpenAIBackend(api_base=f"http://127.0.0.1:{port}/v1", api_key="fake"))
+    yield
+    server.should_exit = True
+    thread.join()
+
+
+def test_generation_through_fake_llm(fake_llm_backend):
+    async def run():
+        candidates = await agenerate_gpt4_candidates(prompt="bla", n=2)
+        deltas = [d async for d in astream_gpt4_simple(prompt="bla")]
+        return candidates, deltas
+    candidates, deltas = asyncio.run(run())
+    assert len(candidates) == 2
+    assert all(len(c.split()) == 5 for c in candidates)
+    assert len(deltas) == 5
@@ -0,0 +1,93 @@
+import json
+
+import pytest
+from jinja2 import Template
+
+import mysensei.io as ms_io
+from mysensei.fewshot import (ExampleLibrary, ExampleLibraryError, load_example_library,
+    render_prompt)
+
+IGNITION_PARAMS = {"target_concept": "ignition",
+                   "component_concepts": {"0": "departure", "1": "fire"}}
+
+
+def _library(*examples: tuple[str, list[str], str])->ExampleLibrary:
+    return ExampleLibrary(
+        example_template=Template("{{ example.target_concept }}: {{ example.mnemonic }}"),
+        examples_fields=[
+            {"target_concept": t, "component_concepts": dict(enumerate(cs)), "mnemonic": m}
+            for t, cs, m in examples
+        ],
+    )
+
+
+def test_select_closest_examples_within_budget():
+    library = _library(("volcano", ["fire", "mountain"], "short"),
+                       ("forest", ["tree", "tree"], "short"),
+                       ("ignition", ["departure", "fire"], "long " * 100))
+    params = {"target_concept": "ignite", "component_concepts": {"0": "fire"}}
+    selected = library.select(params=params, k=2, max_tokens=1000)
+    # Closest last
+    assert [e.fields["target_concept"] for e in selected] == ["volcano", "ignition"]
+    # The long example does not fit: the next closest one does
+    selected = library.select(params=params, k=2, max_tokens=20)
+    assert [e.fields["target_concept"] for e in selected] == ["forest", "volcano"]
+    assert library.select(params=params, k=0, max_tokens=1000) == []
+
+
+def test_sounds_count_in_selection():
+    library = ExampleLibrary(
+        example_template=Template("{{ example.target_concept }}"),
+        examples_fields=[
+            {"target_concept": "x", "component_concepts_sounds": {"0": {"concept": "a", "sound": s}}}
+            for s in ["か", "しん"]
+        ],
+    )
+    params = {"target_concept": "y",
+              "component_concepts_sounds": {"0": {"concept": "b", "sound": "しん"}}}
+    assert library.select(params=params, k=1, max_tokens=100)[0].fields[
+        "component_concepts_sounds"]["0"]["sound"] == "しん"
+
+
+def test_render_prompt_with_examples():
+    template = ms_io.get_jinja_template(template_name="pure_concepts", version=1)
+    rendered = render_prompt(template=template, prompt_params_dict={
+        "target_concept": "eruption", "component_concepts": {"0": "fire", "1": "mountain"},
+    })
+    assert rendered.n_examples == 2
+    assert "Main Concept: volcano" in rendered.prompt
+    assert rendered.prompt.endswith("2/ mountain\nYour mnemonic:")
+    hardcoded = render_prompt(template=ms_io.get_jinja_template(template_name="pure_concepts",
+                                                               version=0),
+                              prompt_params_dict=IGNITION_PARAMS)
+    assert hardcoded.n_examples == 0
+    assert rendered.n_tokens < hardcoded.n_tokens
+
+
+def test_render_prompt_budget(settings):
+    template = ms_io.get_jinja_template(template_name="reading_mnem", version=1)
+    params = {"target_concept": "forest", "meaning_mnemonic": "Trees.",
+              "component_concepts_sounds": {"0": {"concept": "shin", "details": "a leg",
+                                                  "sound": "しん"}}}
+    (settings / "config.toml").write_text("[few_shot]\nk = 1\n")
+    zero_shot = render_prompt(template=template, prompt_params_dict=params, max_prompt_tokens=0)
+    assert zero_shot.n_examples == 0
+    assert "examples" not in zero_shot.prompt
+    one_shot = render_prompt(template=template, prompt_params_dict=params)
+    assert one_shot.n_examples == 1
+    assert "(しん)" in one_shot.prompt
+    assert one_shot.n_tokens > zero_shot.n_tokens
+
+
+def test_load_example_library(tmp_path):
+    (tmp_path / "greeting").mkdir()
+    assert load_example_library(template_dirpath=str(tmp_path), template_name="greeting") is None
+    (tmp_path / "greeting" / "example.jinja").write_text("Hi {{ example.target_concept }}")
+    (tmp_path / "greeting" / "examples.jsonl").write_text(
+        json.dumps({"target_concept": "Ken"}) + "\n\n"
+    )
+    library = load_example_library(template_dirpath=str(tmp_path), template_name="greeting")
+    assert [e.text for e in library.examples] == ["Hi Ken"]
+    (tmp_path / "greeting" / "examples.jsonl").write_text("{not json\n")
+    with pytest.raises(ExampleLibraryError):
+        load_example_library(template_dirpath=str(tmp_path), template_name="greeting")
@@ -1,6 +1,10 @@
+import asyncio
+import openai
 import pytest
 from dataclasses import dataclass
-from mysensei.generation import PromptParams, PromptFieldTypeError
+from mysensei.generation import (PromptParams, PromptFieldTypeError,
+    agenerate_gpt4_simple, astream_gpt4_simple, GenerationTimeoutError,
+    StreamStats, agenerate_gpt4_candidates, agenerate_many)
 
 @dataclass
 class SimplePromptParams(PromptParams):
@@ -32,3 +36,103 @@ def test_non_filled_out_fields():
     instance = SimplePromptParams(field1="", field2={"k1": None, "k2": "b"})
     with pytest.raises(PromptFieldTypeError):
         instance.non_filled_out_fields()
+
+
+def test_agenerate_gpt4_simple_timeout(monkeypatch):
+    async def slow_acreate(**kwargs):
+        await asyncio.sleep(1)
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", slow_acreate)
+    with pytest.raises(GenerationTimeoutError):
+        asyncio.run(agenerate_gpt4_simple(prompt="bla", timeout=0.01))
+
+
+def test_astream_gpt4_simple(monkeypatch):
+    async def streaming_acreate(**kwargs):
+        async def chunks():
+            for delta in [{"role": "assistant"}, {"content": "Hey"},
+                          {"content": " there"}, {}]:
+                yield {"choices": [{"delta": delta}]}
+        return chunks()
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", streaming_acreate)
+    async def collect(stats):
+        return [d async for d in astream_gpt4_simple(prompt="bla", stats=stats)]
+    stats = StreamStats()
+    assert asyncio.run(collect(stats)) == ["Hey", " there"]
+    assert stats.time_to_first_token is not None
+    assert stats.total_time >= stats.time_to_first_token
+
+
+@dataclass
+class NestedPromptParams(PromptParams):
+    field1: str
+    field2: dict[str, dict[str, str]]
+
+
+def test_get_filled_out_fields_subfields():
+    full = {"k1": "a", "k2": "b"}
+    instance = SimplePromptParams(field1="", field2=full)
+    output = instance.get_filled_out_fields_subfields()
+    assert output == {"field2": full}
+    # Entirely filled-out values are reused, not copied
+    assert output["field2"] is full
+    instance = SimplePromptParams(field1="bla", field2={"k1": "", "k2": "b"})
+    assert instance.get_filled_out_fields_subfields() == {"field1": "bla",
+                                                          "field2": {"k2": "b"}}
+
+
+def test_nested_fields():
+    # Empty nested dicts are not filled out
+    instance = NestedPromptParams(field1="bla", field2={"0": {"a": "", "b": ""},
+                                                        "1": {"a": "", "b": ""}})
+    assert instance.non_filled_out_fields() == ["field2"]
+    # Empty subfields are dropped at every depth
+    instance = NestedPromptParams(field1="bla", field2={"0": {"a": "x", "b": ""},
+                                                        "1": {"a": "", "b": ""}})
+    assert instance.non_filled_out_fields() == []
+    assert instance.get_filled_out_fields_subfields() == {
+        "field1": "bla", "field2": {"0": {"a": "x"}}
+    }
+    # Type error deep down
+    instance = NestedPromptParams(field1="bla", field2={"0": {"a": "x", "b": 1}})
+    with pytest.raises(PromptFieldTypeError):
+        instance.non_filled_out_fields()
+    # Mixed str and dict subfields
+    instance = NestedPromptParams(field1="bla", field2={"0": {"a": "x"}, "1": "y"})
+    with pytest.raises(PromptFieldTypeError):
+        instance.non_filled_out_fields()
+
+
+def test_agenerate_gpt4_candidates(monkeypatch):
+    calls = []
+    async def acreate(**kwargs):
+        calls.append(kwargs)
+        return openai.openai_object.OpenAIObject.construct_from({"choices": [
+            {"index": i, "message": {"content": f"candidate {i}"}}
+            for i in reversed(range(kwargs["n"]))
+        ]})
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", acreate)
+    expected = ["candidate 0", "candidate 1", "candidate 2"]
+    assert asyncio.run(agenerate_gpt4_candidates(prompt="bla", n=3)) == expected
+    # Cached for the same n only
+    assert asyncio.run(agenerate_gpt4_candidates(prompt="bla", n=3)) == expected
+    assert len(calls) == 1
+    assert asyncio.run(agenerate_gpt4_candidates(prompt="bla", n=2)) == expected[:2]
+    assert len(calls) == 2
+
+
+def test_agenerate_many(monkeypatch):
+    in_flight = []
+    async def acreate(messages, **kwargs):
+        in_flight.append(1)
+        await asyncio.sleep(0.01)
+        max_in_flight = len(in_flight)
+        await asyncio.sleep(0.01)
+        in_flight.pop()
+        return openai.openai_object.OpenAIObject.construct_from({"choices": [
+            {"index": 0, "message": {"content": messages[0]["content"] + f" {max_in_flight}"}}
+        ]})
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", acreate)
+    outputs = asyncio.run(agenerate_many(prompts=["a", "b", "c"], max_concurrency=2))
+    # In order, with at most 2 concurrent requests
+    assert [o.split()[0] for o in outputs] == ["a", "b", "c"]
+    assert max(int(o.split()[1]) for o in outputs) == 2
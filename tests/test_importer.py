@@ -0,0 +1,102 @@
+import json
+import sqlite3
+import zipfile
+
+import pytest
+
+from mysensei import repository
+from mysensei.importer import (import_rows, normalize_row, read_anki_package, read_delimited,
+    read_file)
+from mysensei.repository import (DatabaseConf, ReadingAssociation,
+    ReadingAssociationsRepository, VocabNote, VocabNotesRepository, create_db_engine, init_db)
+
+
+def test_read_anki_text_export(tmp_path):
+    path = tmp_path / "deck.txt"
+    path.write_text("#separator:semicolon\n#html:true\n#columns:Expression;Reading;Meaning\n"
+                    "火事;かじ;fire<br>blaze\n\n食べる;たべる;to eat\n", encoding="utf-8")
+    assert list(read_delimited(str(path))) == [
+        {"Expression": "火事", "Reading": "かじ", "Meaning": "fire<br>blaze"},
+        {"Expression": "食べる", "Reading": "たべる", "Meaning": "to eat"},
+    ]
+
+
+def test_normalize_row():
+    note, association = normalize_row({"Expression": " 火事 ", "Kana": "ｶｼﾞ",
+                                       "Meaning": "fire<br>blaze; conflagration",
+                                       "Freq": "12", "Tags": "n"})
+    assert note == VocabNote(lemma="火事", reading="カジ",
+                             meanings=("fire blaze", "conflagration"), count=12)
+    assert association is None
+    note, association = normalize_row({"sound": "か", "concept": "car", "details": "old"})
+    assert note is None
+    assert association == ReadingAssociation(sound="か", concept="car", descriptor="old")
+    assert normalize_row({"lemma": "", "other": "x"}) == (None, None)
+
+
+def test_import_rows_dedupes_by_user_and_lemma(tmp_path):
+    engine = create_db_engine(conf=DatabaseConf(url=f"sqlite:///{tmp_path / 'db.sqlite'}"))
+    init_db(engine)
+    notes_repository = VocabNotesRepository(engine=engine)
+    notes_repository.insert_new(user_id=1, notes=[VocabNote(lemma="火事", reading="old")])
+    progress = []
+    report = import_rows(
+        rows=iter([{"lemma": "火事", "reading": "かじ"}, {"lemma": "水", "reading": "みず"},
+                   {"lemma": "水", "reading": "すい"}, {"sound": "か", "concept": "car"},
+                   {"comment": "nothing"}]),
+        user_id=1,
+        notes_repository=notes_repository,
+        associations_repository=ReadingAssociationsRepository(engine=engine),
+        chunk_size=2,
+        on_progress=lambda r: progress.append(r.n_rows),
+    )
+    assert progress == [2, 4, 5]
+    assert (report.n_rows, report.n_notes, report.n_duplicate_notes, report.n_associations,
+            report.n_skipped) == (5, 1, 2, 1, 1)
+    assert notes_repository.get_by_user(user_id=1) == [
+        VocabNote(lemma="水", reading="みず"), VocabNote(lemma="火事", reading="old"),
+    ]
+    # Other users are not concerned
+    assert notes_repository.insert_new(user_id=2, notes=[VocabNote(lemma="火事")]) == 1
+
+
+def test_import_rows_writes_each_chunk_in_one_transaction(tmp_path, monkeypatch):
+    engine = create_db_engine(conf=DatabaseConf(url=f"sqlite:///{tmp_path / 'db.sqlite'}"))
+    init_db(engine)
+    notes_repository = VocabNotesRepository(engine=engine)
+    associations_repository = ReadingAssociationsRepository(engine=engine)
+    notified = []
+    associations_repository.add_listener(lambda *change: notified.append(change))
+
+    def failing_record_changes(**kwargs):
+        raise RuntimeError("Change log unavailable")
+    monkeypatch.setattr(repository, "record_changes", failing_record_changes)
+    with pytest.raises(RuntimeError):
+        import_rows(rows=iter([{"lemma": "火事", "sound": "か", "concept": "car"}]),
+                    user_id=1, notes_repository=notes_repository,
+                    associations_repository=associations_repository)
+    # The notes of the chunk are rolled back with its associations
+    assert notes_repository.get_by_user(user_id=1) == []
+    assert notified == []
+
+
+def _write_anki_collection(path)->None:
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE col (models TEXT)")
+    connection.execute("CREATE TABLE notes (mid INTEGER, flds TEXT)")
+    models = {"42": {"flds": [{"name": "Meaning", "ord": 1}, {"name": "Expression", "ord": 0}]}}
+    connection.execute("INSERT INTO col VALUES (?)", (json.dumps(models),))
+    connection.execute("INSERT INTO notes VALUES (42, ?)", ("火事\x1ffire",))
+    connection.commit()
+    connection.close()
+
+
+def test_read_anki_collection_and_package(tmp_path):
+    collection_path = tmp_path / "collection.anki2"
+    _write_anki_collection(str(collection_path))
+    expected = [{"Expression": "火事", "Meaning": "fire"}]
+    assert list(read_file(str(collection_path))) == expected
+    package_path = tmp_path / "deck.apkg"
+    with zipfile.ZipFile(package_path, "w") as package:
+        package.write(collection_path, arcname="collection.anki2")
+    assert list(read_anki_package(str(package_path))) == expected
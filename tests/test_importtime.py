@@ -0,0 +1,10 @@
+import pytest
+
+from benchmarks.importtime import IMPORT_BUDGETS_S, measure_import
+
+
+@pytest.mark.parametrize("module", list(IMPORT_BUDGETS_S))
+def test_import_budget(module):
+    report = measure_import(module)
+    assert report.deferred_imports == []
+    assert report.best_s <= IMPORT_BUDGETS_S[module]
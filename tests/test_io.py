@@ -0,0 +1,29 @@
+import os
+from mysensei.io import TemplateRegistry, get_template_registry
+
+
+def test_template_registry(tmp_path):
+    template_dirpath = tmp_path / "templates"
+    (template_dirpath / "greeting").mkdir(parents=True)
+    (template_dirpath / "greeting" / "0.jinja").write_text("Hi {{ name }}")
+    (template_dirpath / "greeting" / "1.jinja").write_text("Hello {{ name }}")
+    registry = TemplateRegistry(template_dirpath=str(template_dirpath),
+                                bytecode_cache_dirpath=str(tmp_path / "bytecode"))
+    registry.discover()
+    assert registry.list_templates() == ["greeting"]
+    assert registry.list_versions(template_name="greeting") == [0, 1]
+    # Compiled once
+    template = registry.get(template_name="greeting", version=1)
+    assert registry.get(template_name="greeting", version=1) is template
+    assert template.render(name="Ken") == "Hello Ken"
+    # Reloaded on modification
+    filepath = template_dirpath / "greeting" / "1.jinja"
+    filepath.write_text("Howdy {{ name }}")
+    os.utime(filepath, (os.path.getatime(filepath), os.path.getmtime(filepath) + 10))
+    assert registry.get(template_name="greeting", version=1).render(name="Ken") == "Howdy Ken"
+
+
+def test_repo_templates_are_registered():
+    assert {"pure_concepts", "pure_concepts_revision", "reading_mnem"} <= set(
+        get_template_registry().list_templates()
+    )
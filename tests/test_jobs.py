@@ -0,0 +1,111 @@
+import asyncio
+import sqlite3
+import time
+
+import openai
+
+from mysensei.generation import TCParams
+from mysensei.jobs import JobQueue, JobStore
+
+PARAMS = [TCParams(target_concept="ignition", component_concepts={"0": "fire"})]
+
+
+def test_job_store_lease_and_dead_letter(tmp_path):
+    path = str(tmp_path / "jobs.sqlite")
+    store = JobStore(path=path)
+    job = store.add(session_id="s", prompt="p", prompt_params=PARAMS, n=2, max_attempts=2)
+    claimed = store.claim(worker_id="w1", lease_s=60.)
+    assert (claimed.job_id, claimed.status, claimed.n_attempts) == (job.job_id, "running", 1)
+    assert claimed.prompt_params == PARAMS
+    # Shared by another process: nothing else to claim
+    assert JobStore(path=path).claim(worker_id="w2", lease_s=60.) is None
+    assert store.fail(job_id=job.job_id, worker_id="w1", error="boom", retry_delay_s=0.)
+    # Worker lost during the second attempt: taken over, then dead-lettered
+    assert store.claim(worker_id="w2", lease_s=-1.).n_attempts == 2
+    assert store.claim(worker_id="w3", lease_s=60.) is None
+    dead = store.get(job.job_id)
+    assert (dead.status, dead.error) == ("dead", "Worker lost")
+    assert not store.complete(job_id=job.job_id, worker_id="w2", outputs=["late"])
+    assert store.retry(job.job_id)
+    assert store.claim(worker_id="w3", lease_s=60.).n_attempts == 1
+    assert store.complete(job_id=job.job_id, worker_id="w3", outputs=["a", "b"])
+    assert store.undelivered(session_id="s")[0].outputs == ["a", "b"]
+    assert store.mark_delivered(job.job_id)
+    assert not store.mark_delivered(job.job_id)
+    assert store.undelivered(session_id="s") == []
+    assert store.counts() == {"done": 1}
+    assert store.prune(max_age_s=-1.) == 1
+
+
+def test_job_queue_retries(tmp_path, monkeypatch):
+    calls = []
+    async def acreate(**kwargs):
+        calls.append(kwargs)
+        if len(calls) == 1:
+            raise openai.error.ServiceUnavailableError("Overloaded")
+        return openai.openai_object.OpenAIObject.construct_from({"choices": [
+            {"index": i, "message": {"content": f"m{i}"}} for i in range(kwargs["n"])
+        ]})
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", acreate)
+    queue = JobQueue(store=JobStore(path=str(tmp_path / "jobs.sqlite")), n_workers=2,
+                     retry_delay_s=0., poll_interval_s=0.05)
+    updates = []
+    async def main():
+        await queue.start()
+        job = await queue.aenqueue(session_id="s", prompt="p", prompt_params=PARAMS, n=2)
+        try:
+            return await asyncio.wait_for(
+                queue.wait(job.job_id, on_update=lambda j: updates.append(j.n_attempts)), 5.
+            )
+        finally:
+            await queue.stop()
+    job = asyncio.run(main())
+    assert (job.status, job.n_attempts, job.outputs) == ("done", 2, ["m0", "m1"])
+    assert updates[-1] == 2
+
+
+def test_job_queue_stop_releases_running_jobs(tmp_path, monkeypatch):
+    async def acreate(**kwargs):
+        await asyncio.sleep(10.)
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", acreate)
+    store = JobStore(path=str(tmp_path / "jobs.sqlite"))
+    queue = JobQueue(store=store, n_workers=1, poll_interval_s=0.05)
+    async def main():
+        await queue.start()
+        job = queue.enqueue(session_id="s", prompt="p", prompt_params=PARAMS)
+        deadline = time.monotonic() + 5.
+        while store.get(job.job_id).status != "running" and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        await queue.stop()
+        return store.get(job.job_id)
+    job = asyncio.run(main())
+    # Queued again, attempt not counted: run by the next process
+    assert (job.status, job.n_attempts) == ("queued", 0)
+
+
+def test_job_queue_survives_store_errors(tmp_path, monkeypatch):
+    async def acreate(**kwargs):
+        return openai.openai_object.OpenAIObject.construct_from({"choices": [
+            {"index": 0, "message": {"content": "m0"}}
+        ]})
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", acreate)
+    store = JobStore(path=str(tmp_path / "jobs.sqlite"))
+    complete = store.complete
+    n_calls = []
+    def flaky_complete(**kwargs):
+        n_calls.append(1)
+        if len(n_calls) == 1:
+            raise sqlite3.OperationalError("database is locked")
+        return complete(**kwargs)
+    monkeypatch.setattr(store, "complete", flaky_complete)
+    queue = JobQueue(store=store, n_workers=1, lease_s=0.2, poll_interval_s=0.05)
+    async def main():
+        await queue.start()
+        job = queue.enqueue(session_id="s", prompt="p", prompt_params=PARAMS)
+        try:
+            return await asyncio.wait_for(queue.wait(job.job_id), 5.)
+        finally:
+            await queue.stop()
+    job = asyncio.run(main())
+    # Left to its lease, then taken over by the same (still running) worker
+    assert (job.status, job.n_attempts, job.outputs) == ("done", 2, ["m0"])
@@ -0,0 +1,35 @@
+from mysensei.launcher import MIN_RESTART_DELAY_S, WorkerPool, worker_env
+from mysensei.settings import get_settings, reset_settings
+
+
+def test_worker_env(monkeypatch):
+    env = worker_env(port=8082, shared_state_path="/tmp/shared.sqlite", n_job_workers=2)
+    monkeypatch.setattr("os.environ", env)
+    reset_settings()
+    settings = get_settings().server
+    assert (settings.port, settings.reload, settings.shared_state_path) == (
+        8082, False, "/tmp/shared.sqlite")
+    # Jobs are left to the dedicated processes
+    assert get_settings().jobs.processes == 2
+
+
+def test_worker_pool_restarts_exited_workers(tmp_path, monkeypatch):
+    app_path = tmp_path / "app.py"
+    app_path.write_text("import sys; sys.exit(3)\n")
+    pool = WorkerPool(app_path=str(app_path), n_workers=2, base_port=9000,
+                      shared_state_path=str(tmp_path / "shared.sqlite"))
+    pool.start()
+    for worker in pool.workers:
+        worker.process.wait()
+    pool.check()
+    assert [w.port for w in pool.workers] == [9000, 9001]
+    assert all(w.restart_at is not None for w in pool.workers)
+    # The delay doubles on each consecutive crash
+    assert all(w.restart_delay_s == 2 * MIN_RESTART_DELAY_S for w in pool.workers)
+    first_process = pool.workers[0].process
+    pool.workers[0].restart_at = 0.
+    pool.check()
+    assert pool.workers[0].process is not first_process
+    assert pool.workers[1].process.returncode == 3
+    pool.stop()
+    assert pool.workers[0].process.returncode is not None
@@ -0,0 +1,12 @@
+from benchmarks.loadtest import _percentile, worker_urls
+
+
+def test_percentile():
+    assert _percentile([3., 1., 2., 4.], 0.5) == 3.
+    assert _percentile([3., 1., 2., 4.], 0.99) == 4.
+    assert _percentile([], 0.5) != _percentile([], 0.5)  # nan
+
+
+def test_worker_urls():
+    assert worker_urls("http://127.0.0.1:8080/", 2) == ["http://127.0.0.1:8080/",
+                                                         "http://127.0.0.1:8081/"]
@@ -0,0 +1,44 @@
+import asyncio
+import openai
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from mysensei.generation import agenerate_gpt4_simple
+from mysensei.metrics import MetricsRegistry, get_registry, register_metrics_route
+
+
+def test_histogram_rendering():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("latency_seconds", "Latency", ("template",),
+                                   buckets=(1., 2.))
+    for value in [0.5, 1.5, 3.]:
+        histogram.observe(value, template="t")
+    lines = registry.render().splitlines()
+    assert 'latency_seconds_bucket{template="t",le="1"} 1' in lines
+    assert 'latency_seconds_bucket{template="t",le="2"} 2' in lines
+    assert 'latency_seconds_bucket{template="t",le="+Inf"} 3' in lines
+    assert 'latency_seconds_sum{template="t"} 5' in lines
+    assert 'latency_seconds_count{template="t"} 3' in lines
+
+
+def test_generation_metrics(monkeypatch):
+    async def acreate(**kwargs):
+        return openai.openai_object.OpenAIObject.construct_from({
+            "choices": [{"index": 0, "message": {"content": "mnemonic"}}],
+            "usage": {"prompt_tokens": 100, "completion_tokens": 20},
+        })
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", acreate)
+    labels = {"model": "gpt-4", "template": "metrics_test", "version": "3"}
+    requests = get_registry().counter("mysensei_llm_requests_total", "",
+                                      tuple(labels) + ("outcome",))
+    before = requests.get(outcome="success", **labels)
+    for _ in range(2):  # The second one is a cache hit
+        asyncio.run(agenerate_gpt4_simple(prompt="bla", template_name="metrics_test",
+                                          template_version=3))
+    assert requests.get(outcome="success", **labels) == before + 1
+    assert requests.get(outcome="cache_hit", **labels) >= 1
+    app = FastAPI()
+    register_metrics_route(app=app)
+    response = TestClient(app).get("/metrics")
+    assert response.status_code == 200
+    assert ('mysensei_llm_prompt_tokens_sum{model="gpt-4",template="metrics_test",'
+            'version="3"} 100') in response.text.splitlines()
@@ -0,0 +1,15 @@
+from benchmarks.microbench import compare, time_case
+
+
+def test_time_case():
+    calls = []
+    timing = time_case(lambda: calls.append(1), min_run_s=0.001, n_runs=3)
+    assert timing.n_calls >= 1
+    assert 0 < timing.best_s <= timing.median_s
+    assert len(calls) > 3 * timing.n_calls
+
+
+def test_compare():
+    baseline = {"a": {"best_s": 1.}, "b": {"best_s": 1.}}
+    current = {"a": {"best_s": 1.1}, "b": {"best_s": 1.5}, "new": {"best_s": 9.}}
+    assert compare(baseline=baseline, current=current, threshold=0.25) == {"b": 0.5}
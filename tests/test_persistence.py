@@ -0,0 +1,76 @@
+import asyncio
+from dataclasses import replace
+from sqlalchemy import func, select
+from mysensei.persistence import (MAX_WRITE_ATTEMPTS, GenerationRecord, WriteBehindQueue,
+    iter_stored_results)
+from mysensei.repository import DatabaseConf, create_db_engine
+from mysensei.sql import GenerationResults
+
+
+def _record(i: int)->GenerationRecord:
+    return GenerationRecord(session_id="s1", target_concept=f"concept {i}",
+                            component_concepts=("a", "b"), template_name="pure_concepts",
+                            template_version=0, mnemonic=f"mnemonic {i}")
+
+
+def _count(engine)->int:
+    with engine.connect() as connection:
+        return connection.scalar(select(func.count()).select_from(GenerationResults))
+
+
+def test_write_behind_queue(tmp_path):
+    engine = create_db_engine(conf=DatabaseConf(url=f"sqlite:///{tmp_path / 'db.sqlite'}"))
+    queue = WriteBehindQueue(engine=engine, max_batch_size=3, flush_interval_s=0.05)
+    async def scenario():
+        await queue.start()
+        # Flushed on size
+        for i in range(3):
+            queue.put(_record(i))
+        await asyncio.sleep(0.02)
+        assert _count(engine) == 3
+        # Flushed on time
+        queue.put(_record(3))
+        await asyncio.sleep(0.01)
+        assert _count(engine) == 3
+        await asyncio.sleep(0.1)
+        assert _count(engine) == 4
+        # Flushed on stop
+        queue.put(_record(4))
+        await queue.stop()
+    asyncio.run(scenario())
+    assert _count(engine) == 5
+    assert queue.n_written == 5
+
+
+def test_write_behind_queue_sets_bad_records_apart(tmp_path):
+    engine = create_db_engine(conf=DatabaseConf(url=f"sqlite:///{tmp_path / 'db.sqlite'}"))
+    queue = WriteBehindQueue(engine=engine, max_batch_size=2, flush_interval_s=0.01)
+    bad_record = replace(_record(0), created_at="not a datetime")
+    async def scenario():
+        await queue.start()
+        queue.put(bad_record)
+        queue.put(_record(1))
+        await asyncio.sleep(0.1)
+        # The other records of the batch are written nonetheless
+        assert _count(engine) == 1
+        for i in range(2, 2 + MAX_WRITE_ATTEMPTS):
+            queue.put(_record(i))
+            await asyncio.sleep(0.1)
+        await queue.stop()
+    asyncio.run(scenario())
+    assert _count(engine) == 1 + MAX_WRITE_ATTEMPTS
+    assert (queue.n_written, queue.n_dropped) == (1 + MAX_WRITE_ATTEMPTS, 1)
+
+
+def test_iter_stored_results(tmp_path):
+    engine = create_db_engine(conf=DatabaseConf(url=f"sqlite:///{tmp_path / 'db.sqlite'}"))
+    queue = WriteBehindQueue(engine=engine)
+    async def scenario():
+        await queue.start()
+        for i in range(3):
+            queue.put(_record(i))
+        await queue.stop()
+    asyncio.run(scenario())
+    results = list(iter_stored_results(engine=engine, limit=2, batch_size=1))
+    assert [r.mnemonic for r in results] == ["mnemonic 2", "mnemonic 1"]
+    assert results[0].component_concepts == ("a", "b")
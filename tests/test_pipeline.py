@@ -0,0 +1,71 @@
+import asyncio
+import pytest
+import mysensei.pipeline as ms_pipeline
+from mysensei.pipeline import (DECK_STAGES, Pipeline, PipelineError, Stage,
+    StageStore, sort_stages)
+
+
+def _items(n):
+    return [(f"w{i}", {
+        "target_concept": f"concept{i}",
+        "component_concepts": {"0": "departure", "1": "fire"},
+        "component_concepts_sounds": {"0": {"concept": "car", "details": "a car",
+                                            "sound": "か"}},
+    }) for i in range(n)]
+
+
+def test_sort_stages():
+    assert [s.name for s in sort_stages(DECK_STAGES[::-1])][0] == "meaning"
+    with pytest.raises(PipelineError):
+        sort_stages([Stage(name="a", template_name="pure_concepts", inputs={"x": "b"}),
+                     Stage(name="b", template_name="pure_concepts", inputs={"x": "a"})])
+
+
+def test_pipeline_retries_failed_stages_only(tmp_path, monkeypatch):
+    prompts = []
+    fail_reading = [True]
+    async def fake_generate(prompt, **kwargs):
+        await asyncio.sleep(0.01)
+        if "Paired Symbol" in prompt:
+            stage = "reading"
+            assert "Context: meaning output" in prompt
+            if fail_reading[0]:
+                raise RuntimeError("boom")
+        else:
+            stage = "revision" if "criticize" in prompt else "meaning"
+        prompts.append(stage)
+        return f"{stage} output"
+    monkeypatch.setattr(ms_pipeline, "agenerate_with_retries", fake_generate)
+    store = StageStore(path=str(tmp_path / "stages.sqlite"))
+    report = asyncio.run(Pipeline(stages=DECK_STAGES, store=store).run(items=_items(3)))
+    assert report.stages["meaning"].n_generated == 3
+    assert report.stages["revision"].n_generated == 3
+    assert report.stages["reading"].n_failed == 3
+    fail_reading[0] = False
+    prompts.clear()
+    report = asyncio.run(Pipeline(stages=DECK_STAGES, store=store).run(items=_items(3)))
+    assert sorted(prompts) == ["reading"] * 3
+    assert report.stages["meaning"].n_reused == 3
+    assert report.n_failed() == 0
+    assert dict(store.get_item_outputs())["w0"] == {
+        "meaning": "meaning output", "revision": "revision output",
+        "reading": "reading output",
+    }
+
+
+def test_pipeline_overlaps_items(tmp_path, monkeypatch):
+    events = []
+    async def fake_generate(prompt, **kwargs):
+        stage = "reading" if "Paired Symbol" in prompt else "meaning"
+        events.append(("start", stage))
+        await asyncio.sleep(0.02)
+        return "output"
+    monkeypatch.setattr(ms_pipeline, "agenerate_with_retries", fake_generate)
+    stages = [Stage(name="meaning", template_name="pure_concepts", max_in_flight=1),
+              Stage(name="reading", template_name="reading_mnem", max_in_flight=1,
+                    inputs={"meaning_mnemonic": "meaning"})]
+    store = StageStore(path=str(tmp_path / "stages.sqlite"))
+    asyncio.run(Pipeline(stages=stages, store=store).run(items=_items(3)))
+    # Some item's meaning started after another item's reading
+    first_reading = events.index(("start", "reading"))
+    assert ("start", "meaning") in events[first_reading:]
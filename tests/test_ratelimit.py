@@ -0,0 +1,155 @@
+import asyncio
+import sqlite3
+
+import openai
+import pytest
+
+from mysensei.generation import (GenerationTimeoutError, agenerate_gpt4_simple,
+    astream_gpt4_simple, set_rate_limiter)
+from mysensei.ratelimit import (RateLimiter, RateLimitTimeoutError, SharedRateLimiter,
+    SingleFlight)
+
+
+def test_rate_limiter_requests():
+    limiter = RateLimiter(requests_per_minute=60, burst_s=1.)
+    assert limiter.reserve(n_tokens=1000) == 0.
+    assert limiter.reserve(n_tokens=1000) == pytest.approx(1., abs=0.01)
+    assert limiter.reserve(n_tokens=1000) == pytest.approx(2., abs=0.01)
+
+
+def test_rate_limiter_tokens():
+    limiter = RateLimiter(tokens_per_minute=600, burst_s=10.)  # 10/s, up to 100
+    assert limiter.reserve(n_tokens=100) == 0.
+    assert limiter.reserve(n_tokens=50) == pytest.approx(5., abs=0.01)
+    # 40 of the 50 tokens were not used
+    limiter.correct(n_tokens_estimated=50, n_tokens=10)
+    assert limiter.reserve(n_tokens=10) == pytest.approx(2., abs=0.01)
+    # Too long a wait: nothing reserved
+    with pytest.raises(RateLimitTimeoutError):
+        limiter.reserve(n_tokens=10, max_wait_s=1.)
+    assert limiter.reserve(n_tokens=10) == pytest.approx(3., abs=0.01)
+
+
+def test_shared_rate_limiter(tmp_path):
+    path = str(tmp_path / "shared_state.sqlite")
+    worker_1 = SharedRateLimiter(path=path, requests_per_minute=60, burst_s=1.)
+    worker_2 = SharedRateLimiter(path=path, requests_per_minute=60, burst_s=1.)
+    assert worker_1.reserve(n_tokens=10) == 0.
+    # The quota is shared
+    assert worker_2.reserve(n_tokens=10) == pytest.approx(1., abs=0.05)
+    assert worker_1.reserve(n_tokens=10) == pytest.approx(2., abs=0.05)
+
+
+def test_shared_rate_limiter_waits_off_the_event_loop(tmp_path):
+    path = str(tmp_path / "shared_state.sqlite")
+    limiter = SharedRateLimiter(path=path, requests_per_minute=600)
+    other_process = sqlite3.connect(path, isolation_level=None)
+    other_process.execute("BEGIN IMMEDIATE")  # Holds the buckets
+    ticks = []
+    async def tick():
+        for _ in range(5):
+            ticks.append(1)
+            await asyncio.sleep(0.02)
+        other_process.execute("COMMIT")
+    async def main():
+        await asyncio.gather(limiter.acquire(n_tokens=10), tick())
+    asyncio.run(main())
+    assert len(ticks) == 5
+
+
+def test_single_flight_run():
+    calls = []
+    async def func():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return len(calls)
+    async def main():
+        single_flight = SingleFlight()
+        results = await asyncio.gather(single_flight.run("a", func),
+                                       single_flight.run("a", func),
+                                       single_flight.run("b", func))
+        return results, single_flight.n_coalesced
+    results, n_coalesced = asyncio.run(main())
+    assert len(calls) == 2
+    assert results[0] == results[1]
+    assert n_coalesced == 1
+
+
+def test_single_flight_cancellation():
+    async def func():
+        await asyncio.sleep(0.05)
+        return "done"
+    async def main():
+        single_flight = SingleFlight()
+        first = asyncio.create_task(single_flight.run("a", func))
+        second = asyncio.create_task(single_flight.run("a", func))
+        await asyncio.sleep(0.01)
+        first.cancel()  # The other caller still gets the result
+        assert await second == "done"
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        # Cancelled once all its callers are
+        third = asyncio.create_task(single_flight.run("a", func))
+        await asyncio.sleep(0.01)
+        third.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await third
+        await asyncio.sleep(0.001)
+        assert not single_flight.is_in_flight("a")
+    asyncio.run(main())
+
+
+def test_single_flight_stream():
+    async def func():
+        for i in range(3):
+            await asyncio.sleep(0.01)
+            yield i
+    async def collect(single_flight, delay_s):
+        await asyncio.sleep(delay_s)
+        return [i async for i in single_flight.stream("a", func)]
+    async def main():
+        single_flight = SingleFlight()
+        results = await asyncio.gather(collect(single_flight, 0.),
+                                       collect(single_flight, 0.015))
+        return results, single_flight.n_coalesced
+    results, n_coalesced = asyncio.run(main())
+    assert results == [[0, 1, 2], [0, 1, 2]]
+    assert n_coalesced == 1
+
+
+def test_generation_coalescing(monkeypatch):
+    calls = []
+    async def acreate(**kwargs):
+        calls.append(kwargs)
+        await asyncio.sleep(0.01)
+        if kwargs.get("stream"):
+            async def chunks():
+                for delta in [{"content": "Hey"}, {"content": " there"}]:
+                    yield {"choices": [{"delta": delta}]}
+            return chunks()
+        return openai.openai_object.OpenAIObject.construct_from({"choices": [
+            {"index": 0, "message": {"content": "Hey there"}}
+        ]})
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", acreate)
+    async def collect(prompt):
+        return "".join([d async for d in astream_gpt4_simple(prompt=prompt, fresh=True)])
+    async def main():
+        return await asyncio.gather(
+            agenerate_gpt4_simple(prompt="a", fresh=True),
+            agenerate_gpt4_simple(prompt="a", fresh=True),
+            collect("b"), collect("b"),
+        )
+    assert asyncio.run(main()) == ["Hey there"] * 4
+    assert len(calls) == 2
+
+
+def test_generation_rate_limit(monkeypatch):
+    async def acreate(**kwargs):
+        return openai.openai_object.OpenAIObject.construct_from({"choices": [
+            {"index": 0, "message": {"content": "Hey there"}}
+        ]})
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", acreate)
+    set_rate_limiter(RateLimiter(requests_per_minute=1, burst_s=1.))
+    assert asyncio.run(agenerate_gpt4_simple(prompt="a", timeout=1.)) == "Hey there"
+    with pytest.raises(GenerationTimeoutError):
+        asyncio.run(agenerate_gpt4_simple(prompt="b", timeout=1.))
@@ -0,0 +1,88 @@
+import asyncio
+from sqlalchemy.orm import Session
+from mysensei.repository import (DatabaseConf, ReadingAssociation,
+    ReadingAssociationsRepository, AsyncReadingAssociationsRepository,
+    create_db_engine, create_async_db_engine, get_user_version, init_db, ainit_db)
+
+
+def _conf(tmp_path)->DatabaseConf:
+    db_path = tmp_path / "mysensei.sqlite"
+    return DatabaseConf(url=f"sqlite:///{db_path}",
+                        async_url=f"sqlite+aiosqlite:///{db_path}",
+                        pool_size=2, statement_timeout_ms=1000)
+
+
+def test_reading_associations_upsert(tmp_path):
+    engine = create_db_engine(conf=_conf(tmp_path))
+    init_db(engine)
+    repository = ReadingAssociationsRepository(engine=engine, batch_size=2)
+    n_written = repository.upsert(user_id=1, associations=[
+        ReadingAssociation(sound="か", concept="car", descriptor="old"),
+        ReadingAssociation(sound="か", concept="mosquito"),
+        ReadingAssociation(sound="きょう", concept="Kyoto"),
+    ])
+    assert n_written == 3
+    repository.upsert(user_id=2, associations=[ReadingAssociation(sound="か", concept="car")])
+    # Existing association: descriptor updated
+    repository.upsert(user_id=1, associations=[
+        ReadingAssociation(sound="か", concept="car", descriptor="from the 80s"),
+    ])
+    assert repository.get_by_user(user_id=1) == [
+        ReadingAssociation(sound="か", concept="car", descriptor="from the 80s"),
+        ReadingAssociation(sound="か", concept="mosquito"),
+        ReadingAssociation(sound="きょう", concept="Kyoto"),
+    ]
+
+
+def test_async_reading_associations_upsert(tmp_path):
+    async def scenario():
+        engine = create_async_db_engine(conf=_conf(tmp_path))
+        await ainit_db(engine)
+        repository = AsyncReadingAssociationsRepository(engine=engine)
+        changes = []
+        repository.add_listener(lambda *change: changes.append(change))
+        await repository.upsert(user_id=1, associations=[
+            ReadingAssociation(sound="はっ", concept="small hammer"),
+            ReadingAssociation(sound="か", concept="car"),
+        ])
+        assert await repository.delete(user_id=1, associations=[
+            ReadingAssociation(sound="か", concept="car"),
+            ReadingAssociation(sound="か", concept="mosquito"),  # Not there
+        ]) == 1
+        assert await repository.delete(user_id=1, associations=[
+            ReadingAssociation(sound="か", concept="car"),
+        ]) == 0
+        associations = await repository.get_by_user(user_id=1)
+        await engine.dispose()
+        return associations, changes
+    associations, changes = asyncio.run(scenario())
+    assert associations == [ReadingAssociation(sound="はっ", concept="small hammer")]
+    # Listeners are notified as by the sync repository
+    assert changes == [
+        (1, [ReadingAssociation(sound="はっ", concept="small hammer"),
+             ReadingAssociation(sound="か", concept="car")], []),
+        (1, [], [ReadingAssociation(sound="か", concept="car")]),
+    ]
+
+
+def test_reading_associations_delete_logs_deleted_rows_only(tmp_path):
+    engine = create_db_engine(conf=_conf(tmp_path))
+    init_db(engine)
+    repository = ReadingAssociationsRepository(engine=engine)
+    changes = []
+    repository.add_listener(lambda *change: changes.append(change))
+    repository.upsert(user_id=1, associations=[
+        ReadingAssociation(sound="か", concept="car", descriptor="red"),
+    ])
+    assert repository.delete(user_id=1, associations=[
+        ReadingAssociation(sound="か", concept="car"),
+        ReadingAssociation(sound="か", concept="mosquito"),
+    ]) == 1
+    assert repository.delete(user_id=1, associations=[
+        ReadingAssociation(sound="か", concept="car"),
+    ]) == 0
+    assert changes[1:] == [
+        (1, [], [ReadingAssociation(sound="か", concept="car", descriptor="red")]),
+    ]
+    with Session(engine) as session:
+        assert get_user_version(session=session, user_id=1) == 2
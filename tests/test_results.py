@@ -0,0 +1,70 @@
+import pytest
+from mysensei.results import SessionStore, SpillStore, TCConcepts, TCResult, TCResults
+
+
+def test_result_is_a_snapshot():
+    concepts = TCConcepts(target_concept="ignition", component_concepts=["fire", ""])
+    result = TCResult.from_concepts(tc_concepts=concepts, mnemonic="m")
+    concepts.target_concept = "microscope"
+    assert result.target_concept == "ignition"
+    assert result.component_concepts == ("fire",)
+    assert TCResult.from_json(result.to_json()) == result
+
+
+def test_results_window_and_spill(tmp_path):
+    spill_store = SpillStore(path=str(tmp_path / "spilled.sqlite"))
+    results = TCResults(session_id="s1", window_size=2, spill_store=spill_store)
+    assert results.get_result(idx=-1) == ""
+    concepts = TCConcepts(target_concept="t", component_concepts=["c"])
+    for i in range(5):
+        results.add_result(TCResult.from_concepts(tc_concepts=concepts, mnemonic=f"m{i}"))
+    assert results.len() == 5
+    assert len(results._window) == 2
+    assert [results.get_result(idx=i).mnemonic for i in range(5)] == [f"m{i}" for i in range(5)]
+    assert results.get_result(idx=-1).mnemonic == "m4"
+    # Spilled results can be replaced too
+    revised = TCResult.from_concepts(tc_concepts=concepts, mnemonic="m0", revisions=("r",))
+    results.set_result(idx=0, tc_result=revised)
+    assert results.get_result(idx=0) == revised
+    assert results.memory_usage() > 0
+    results.close()
+    with pytest.raises(IndexError):
+        results.get_result(idx=0)
+    with pytest.raises(IndexError):
+        results.get_result(idx=5)
+
+
+def test_session_store_restore_and_prune(tmp_path):
+    path = str(tmp_path / "shared_state.sqlite")
+    concepts = TCConcepts(target_concept="t", component_concepts=["c"])
+    results = TCResults(session_id="browser", window_size=2,
+                        spill_store=SessionStore(path=path))
+    for i in range(3):
+        results.add_result(TCResult.from_concepts(tc_concepts=concepts, mnemonic=f"m{i}"))
+    revised = TCResult.from_concepts(tc_concepts=concepts, mnemonic="m2", revisions=("r",))
+    results.set_result(idx=2, tc_result=revised)
+    # Another worker restores the session, last results in memory
+    other_store = SessionStore(path=path)
+    restored = TCResults.restore(session_id="browser", window_size=2, spill_store=other_store)
+    assert restored.len() == 3
+    assert list(restored._window) == [results.get_result(idx=1), revised]
+    assert restored.get_result(idx=0).mnemonic == "m0"
+    assert TCResults.restore(session_id="other", window_size=2, spill_store=other_store).len() == 0
+    assert other_store.prune(max_age_s=3600.) == 0
+    assert other_store.prune(max_age_s=-1.) == 1
+    assert TCResults.restore(session_id="browser", window_size=2, spill_store=other_store).len() == 0
+
+
+def test_pages_of_a_session_do_not_overwrite_each_other(tmp_path):
+    store = SessionStore(path=str(tmp_path / "shared_state.sqlite"))
+    concepts = TCConcepts(target_concept="t", component_concepts=["c"])
+    # Two tabs of the same browser
+    tab_1 = TCResults.restore(session_id="browser", window_size=2, spill_store=store)
+    tab_2 = TCResults.restore(session_id="browser", window_size=2, spill_store=store)
+    assert tab_1.add_result(TCResult.from_concepts(tc_concepts=concepts, mnemonic="m0")) == 0
+    assert tab_2.add_result(TCResult.from_concepts(tc_concepts=concepts, mnemonic="m1")) == 1
+    assert tab_1.add_result(TCResult.from_concepts(tc_concepts=concepts, mnemonic="m2")) == 2
+    assert [tab_1.get_result(idx=i).mnemonic for i in range(tab_1.len())] == ["m0", "m1", "m2"]
+    assert tab_2.len() == 2
+    restored = TCResults.restore(session_id="browser", window_size=2, spill_store=store)
+    assert [restored.get_result(idx=i).mnemonic for i in range(3)] == ["m0", "m1", "m2"]
@@ -0,0 +1,47 @@
+from mysensei.repository import (DatabaseConf, ReadingAssociation,
+    ReadingAssociationsRepository, create_db_engine, init_db)
+from mysensei.segmentation import Segment, SoundTrie, SoundTrieIndex
+
+HAMMER = ReadingAssociation(sound="はっ", concept="small hammer")
+CAR = ReadingAssociation(sound="か", concept="car")
+HA = ReadingAssociation(sound="は", concept="tooth")
+KYOTO = ReadingAssociation(sound="きょう", concept="Kyoto")
+
+
+def test_segment_fewest_pieces():
+    trie = SoundTrie(associations=[HAMMER, CAR, HA, KYOTO])
+    assert trie.segment("はっか") == [Segment("はっ", (HAMMER,)), Segment("か", (CAR,))]
+    assert trie.segment("きょうか") == [Segment("きょう", (KYOTO,)), Segment("か", (CAR,))]
+
+
+def test_segment_unknown_sounds():
+    trie = SoundTrie(associations=[CAR])
+    assert trie.segment("かに") == [Segment("か", (CAR,)), Segment("に")]
+    assert trie.segment("") == []
+
+
+def test_trie_remove_and_replace():
+    trie = SoundTrie(associations=[HAMMER, HA])
+    trie.remove(HAMMER)
+    assert trie.get("はっ") == ()
+    assert trie.get("は") == (HA,)
+    assert trie.n_associations == 1
+    new_ha = ReadingAssociation(sound="は", concept="tooth", descriptor="a molar")
+    trie.add(new_ha)
+    assert trie.get("は") == (new_ha,)
+    assert trie.n_associations == 1
+
+
+def test_index_follows_repository_changes(tmp_path):
+    engine = create_db_engine(conf=DatabaseConf(url=f"sqlite:///{tmp_path / 'db.sqlite'}"))
+    init_db(engine)
+    repository = ReadingAssociationsRepository(engine=engine)
+    repository.upsert(user_id=1, associations=[CAR])
+    index = SoundTrieIndex(repository=repository)
+    assert index.segment(user_id=1, reading="はっか") == [
+        Segment("は"), Segment("っ"), Segment("か", (CAR,))
+    ]
+    repository.upsert(user_id=1, associations=[HAMMER])
+    assert index.segment(user_id=1, reading="はっか")[0] == Segment("はっ", (HAMMER,))
+    repository.delete(user_id=1, associations=[HAMMER])
+    assert index.get_trie(user_id=1).get("はっ") == ()
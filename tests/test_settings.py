@@ -0,0 +1,50 @@
+import pytest
+
+import mysensei.generation as ms_generation
+from mysensei.settings import SettingsError, get_settings, load_settings, reset_settings
+
+
+def test_load_settings(tmp_path):
+    (tmp_path / "config.toml").write_text(
+        '[database]\nurl = "sqlite://"\npool_size = 3\npool_timeout_s = 2\n'
+        '[generation]\nbackend = "openai"\n'
+    )
+    (tmp_path / "secrets.toml").write_text('[database]\npassword = "pwd"\n')
+    settings = load_settings(config_path=str(tmp_path), environ={
+        "MYSENSEI__GENERATION__BACKEND": "fake",
+        "MYSENSEI__DATABASE__POOL_SIZE": "10",
+        "MYSENSEI__COOKIES__STORAGE_SECRET": "123",  # str setting: not parsed
+        "OTHER": "ignored",
+    })
+    assert settings.database.url == "sqlite://"
+    assert settings.database.password == "pwd"
+    assert settings.database.pool_size == 10
+    assert settings.database.pool_timeout_s == 2.
+    assert settings.database.max_overflow == 10  # Default
+    assert settings.generation.backend == "fake"
+    assert settings.cookies.storage_secret == "123"
+    assert settings.open_ai.api_key is None
+
+
+def test_load_settings_errors(tmp_path):
+    with pytest.raises(SettingsError):
+        load_settings(config_path=str(tmp_path),
+                      environ={"MYSENSEI__DATABASE__POOL_SIZE": "many"})
+    with pytest.raises(SettingsError):
+        load_settings(config_path=str(tmp_path), environ={"MYSENSEI__DATABASE__PORT": "1"})
+    with pytest.raises(SettingsError):
+        load_settings(config_path=str(tmp_path), environ={"MYSENSEI__DB__URL": "sqlite://"})
+    (tmp_path / "config.toml").write_text('[database]\npool_size = "5"\n')
+    with pytest.raises(SettingsError):
+        load_settings(config_path=str(tmp_path), environ={})
+
+
+def test_get_settings_is_lazy_and_cached(settings, monkeypatch):
+    (settings / "config.toml").write_text('[generation]\nbackend = "fake"\n')
+    assert get_settings() is get_settings()
+    assert isinstance(ms_generation.get_backend(), ms_generation.OpenAIBackend)
+    assert ms_generation.get_backend().api_base == ms_generation.FAKE_LLM_API_BASE
+    monkeypatch.setenv("MYSENSEI__GENERATION__MODEL", "other")
+    assert get_settings().generation.model == "gpt-4"
+    reset_settings()
+    assert get_settings().generation.model == "other"
@@ -0,0 +1,38 @@
+from mysensei.results import TCConcepts, TCResult
+from mysensei.similarity import SimilarityIndex, concepts_features, jaccard
+
+
+def _concepts(target_concept, *component_concepts):
+    return TCConcepts(target_concept=target_concept,
+                      component_concepts=list(component_concepts) + [""])
+
+
+def test_concepts_features():
+    features = concepts_features("Ignition", ["fire", "departure"])
+    assert features == concepts_features("ignition", ["departure", "fire", ""])
+    assert features == concepts_features("ｉｇｎｉｔｉｏｎ ", ["departure", "fire"])
+    assert jaccard(features, concepts_features("fire", ["ignition", "departure"])) < 0.5
+
+
+def test_similarity_index():
+    index = SimilarityIndex()
+    ignition = TCResult(target_concept="ignition", component_concepts=("departure", "fire"),
+                        mnemonic="A DEPARTURE of FIRE: the fuse IGNITES.")
+    index.add(ignition)
+    index.add(TCResult(target_concept="ignition", component_concepts=("departure", "fire"),
+                       mnemonic="A DEPARTURE of FIRE: the fuse IGNITES!"))
+    index.add(TCResult(target_concept="ignition", component_concepts=("leave", "fire"),
+                       mnemonic="LEAVE the FIRE"))
+    index.add(TCResult(target_concept="library", component_concepts=("book", "house"),
+                       mnemonic="A HOUSE of BOOKS"))
+    index.add(ignition)
+    assert len(index) == 4
+    # Another order, a spelling variant
+    similar = index.query(_concepts("Ignitoin", "fire", "departure"), min_similarity=0.2)
+    # Near-identical mnemonics are suggested once; unrelated results never
+    assert [s.result.mnemonic for s in similar] == ["A DEPARTURE of FIRE: the fuse IGNITES.",
+                                                    "LEAVE the FIRE"]
+    assert 0.5 < similar[0].similarity < 1
+    assert index.query(_concepts("ignition", "departure", "fire"))[0].similarity == 1.
+    assert len(index.query(_concepts("ignition", "departure", "fire"), k=1)) == 1
+    assert index.query(_concepts("window", "glass")) == []
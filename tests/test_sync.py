@@ -0,0 +1,80 @@
+import gzip
+import json
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+from starlette.middleware.sessions import SessionMiddleware
+from mysensei.repository import (DatabaseConf, ReadingAssociation,
+    ReadingAssociationsRepository, create_db_engine, init_db)
+from mysensei.sync import SyncService, register_sync_routes
+from mysensei.users import USER_ID_KEY
+
+CAR = ReadingAssociation(sound="か", concept="car")
+HAMMER = ReadingAssociation(sound="はっ", concept="small hammer")
+
+
+def _client(service):
+    """Test client of an app with the sync routes, and a /login/{user_id}"""
+    app = FastAPI()
+    register_sync_routes(app=app, get_service=lambda: service)
+
+    @app.get("/login/{user_id}")
+    def login(request: Request, user_id: int)->None:
+        request.session[USER_ID_KEY] = user_id
+    app.add_middleware(SessionMiddleware, secret_key="test")
+    return TestClient(app)
+
+
+def _setup(tmp_path):
+    engine = create_db_engine(conf=DatabaseConf(url=f"sqlite:///{tmp_path / 'db.sqlite'}"))
+    init_db(engine)
+    return ReadingAssociationsRepository(engine=engine), SyncService(engine=engine)
+
+
+def test_sync_payloads(tmp_path):
+    repository, service = _setup(tmp_path)
+    repository.upsert(user_id=1, associations=[CAR, HAMMER])
+    repository.upsert(user_id=2, associations=[CAR])
+    # Cold client
+    payload = service.get_payload(user_id=1)
+    assert (payload.version, payload.full) == (2, True)
+    assert len(payload.snapshot["reading_association"]) == 2
+    # Warm client: only the last change to each row
+    repository.upsert(user_id=1, associations=[ReadingAssociation("か", "car", "red")])
+    repository.delete(user_id=1, associations=[CAR])
+    payload = service.get_payload(user_id=1, since=2)
+    assert (payload.version, payload.full) == (4, False)
+    assert [(c["key"], c["op"]) for c in payload.changes] == [(["か", "car"], "delete")]
+    # Pruned changes: back to a snapshot
+    service.prune(user_id=1, up_to_version=3)
+    assert service.get_payload(user_id=1, since=2).full
+    assert not service.get_payload(user_id=1, since=3).full
+
+
+def test_sync_endpoint_etag_and_compression(tmp_path):
+    repository, service = _setup(tmp_path)
+    repository.upsert(user_id=1, associations=[
+        ReadingAssociation(sound=f"s{i}", concept=f"concept {i}") for i in range(100)
+    ])
+    client = _client(service)
+    client.get("/login/1")
+    response = client.get("/api/sync/1", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.json()["version"] == 100
+    etag = response.headers["ETag"]
+    response = client.get("/api/sync/1?since=100", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    repository.upsert(user_id=1, associations=[CAR])
+    response = client.get("/api/sync/1?since=100", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert [c["key"] for c in response.json()["changes"]] == [["か", "car"]]
+
+
+def test_sync_endpoint_only_serves_the_session_user(tmp_path):
+    repository, service = _setup(tmp_path)
+    repository.upsert(user_id=1, associations=[CAR])
+    client = _client(service)
+    assert client.get("/api/sync/1").status_code == 401
+    client.get("/login/2")
+    assert client.get("/api/sync/1").status_code == 403
+    assert client.get("/api/sync/2").json()["snapshot"] == {"reading_association": []}
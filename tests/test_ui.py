@@ -0,0 +1,62 @@
+import asyncio
+from types import SimpleNamespace
+from mysensei.generation import TCParams
+from mysensei.ui import PromptUI
+
+
+def _make_prompt_ui(**kwargs)->PromptUI:
+    tc_params = TCParams(target_concept="",
+                         component_concepts={"0": "", "1": ""})
+    return PromptUI(prompt_params=tc_params, template_name="pure_concepts",
+                    template_version=0, **kwargs)
+
+
+def _type(prompt_ui: PromptUI, leaf_key: tuple, value: str)->None:
+    """Mimic an input change (binding, then on_change)"""
+    target = prompt_ui.prompt_params
+    for name in leaf_key[:-1]:
+        target = getattr(target, name) if not isinstance(target, dict) else target[name]
+    if isinstance(target, dict):
+        target[leaf_key[-1]] = value
+    else:
+        setattr(target, leaf_key[-1], value)
+    prompt_ui._on_field_change(SimpleNamespace(value=value), leaf_key=leaf_key)
+
+
+def test_prompt_ui_tracks_filled_out_fields():
+    prompt_ui = _make_prompt_ui()
+    assert not prompt_ui.can_gen_prompt
+    _type(prompt_ui, ("target_concept",), "ignition")
+    assert not prompt_ui.can_gen_prompt
+    _type(prompt_ui, ("component_concepts", "0"), "fire")
+    _type(prompt_ui, ("component_concepts", "1"), "departure")
+    assert prompt_ui.can_gen_prompt
+    _type(prompt_ui, ("component_concepts", "0"), "")
+    assert prompt_ui.can_gen_prompt
+    _type(prompt_ui, ("component_concepts", "1"), "")
+    assert not prompt_ui.can_gen_prompt
+    assert prompt_ui._non_filled_out_fields == set(
+        prompt_ui.prompt_params.non_filled_out_fields()
+    )
+
+
+def test_prompt_ui_live_preview_is_debounced():
+    prompt_ui = _make_prompt_ui(live_preview=True, preview_debounce_s=0.01)
+    renders = []
+    render_prompt = prompt_ui._render_prompt
+    def counting_render_prompt(prompt_params_dict):
+        renders.append(prompt_params_dict)
+        render_prompt(prompt_params_dict=prompt_params_dict)
+    prompt_ui._render_prompt = counting_render_prompt
+    async def scenario():
+        _type(prompt_ui, ("component_concepts", "0"), "fire")
+        for partial_word in ["i", "ig", "ign", "ignition"]:
+            _type(prompt_ui, ("target_concept",), partial_word)
+        await asyncio.sleep(0.05)
+        # Same inputs as the last rendering
+        _type(prompt_ui, ("target_concept",), "ignitio")
+        _type(prompt_ui, ("target_concept",), "ignition")
+        await asyncio.sleep(0.05)
+    asyncio.run(scenario())
+    assert len(renders) == 1
+    assert "Main Concept: ignition" in prompt_ui.prompt
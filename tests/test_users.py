@@ -0,0 +1,10 @@
+from mysensei.users import DEFAULT_USER_ID, find_user_id, get_user_id
+
+
+def test_user_id_is_set_on_first_visit():
+    session = {}
+    assert find_user_id(session) is None
+    assert get_user_id(session) == DEFAULT_USER_ID
+    assert find_user_id(session) == DEFAULT_USER_ID
+    session["user_id"] = 3  # E.g., by a login page
+    assert get_user_id(session) == 3